@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# 重複しない値の数が行数のこの割合以下の文字列の列はカテゴリ型にする（0ならカテゴリ型にしない）
+CATEGORY_RATIO = 0.5
+
+
+def is_text(series):
+    # 欠損値以外がすべて文字列の列
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return False
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return False
+    return pd.api.types.infer_dtype(series, skipna=True) == "string"
+
+
+def downcast_float(series, exact=True):
+    # float16はpandasの集計（unique・value_countsなど）で使えないことがあるので使わない
+    # float64は値が変わらないときだけfloat32にする。exact=Falseなら範囲に収まれば値が少し変わってもfloat32にする
+    if series.dtype != np.float64:
+        return series
+    values = series.to_numpy()
+    finite = values[np.isfinite(values)]
+    if len(finite) != 0 and np.abs(finite).max() > np.finfo(np.float32).max:
+        return series
+    converted = values.astype(np.float32)
+    if exact and not np.array_equal(converted.astype(np.float64), values, equal_nan=True):
+        return series
+    return pd.Series(converted, index=series.index, name=series.name)
+
+
+def optimize_column(series, category_ratio=CATEGORY_RATIO, exact=True):
+    if pd.api.types.is_bool_dtype(series):
+        return series
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast="integer")
+    if pd.api.types.is_float_dtype(series):
+        return downcast_float(series, exact)
+    if category_ratio > 0 and is_text(series) and series.nunique() <= category_ratio * len(series):
+        return series.astype("category")
+    return series
+
+
+def memory_report(before_dtypes, before, df):
+    # 列ごとの型とメモリ使用量（MB）の変換前後
+    after = df.memory_usage(deep=True, index=False)
+    return pd.DataFrame({
+        "before_dtype": before_dtypes.astype(str).to_numpy(),
+        "after_dtype": df.dtypes.astype(str).to_numpy(),
+        "before_MB": before.to_numpy() / 1024 ** 2,
+        "after_MB": after.to_numpy() / 1024 ** 2
+    }, index=df.columns)
+
+
+def report_message(report):
+    # ページに表示する、全体のメモリ使用量の変換前後
+    return f"メモリ使用量を{report['before_MB'].sum():.1f}MBから{report['after_MB'].sum():.1f}MBに減らしました"
+
+
+def optimize_columns(df, category_ratio=CATEGORY_RATIO, exact=True):
+    # 列を1つずつ置き換える（同じ名前の列があっても位置で置き換える）
+    for position in range(len(df.columns)):
+        df.isetitem(position, optimize_column(df.iloc[:, position], category_ratio, exact))
+    return df
+
+
+def optimize(df, category_ratio=CATEGORY_RATIO, exact=True):
+    """
+    Downcast the columns of df in place and return (df, report).
+    Integers are downcast with pd.to_numeric, float64 becomes float32 (only when no
+    value changes unless exact=False), and text columns with few distinct values become
+    category. report holds the dtype and memory of each column before and after.
+    """
+    before_dtypes = df.dtypes
+    before = df.memory_usage(deep=True, index=False)
+    df = optimize_columns(df, category_ratio, exact)
+    return df, memory_report(before_dtypes, before, df)
+
+
+def reduce_mem_usage(df, verbose=True, category_ratio=CATEGORY_RATIO, exact=True):
+    # (df, report)を返す。文字列の列のメモリ使用量を数えるのは時間がかかるので、verboseでなければreportはNone
+    if verbose:
+        return optimize(df, category_ratio, exact)
+    return optimize_columns(df, category_ratio, exact), None
+
+
+def concat_chunks(parts):
+    # 列ごとに結合する。どのチャンクでもカテゴリ型の列はカテゴリをまとめてから結合し、
+    # 一部のチャンクだけカテゴリ型の列は文字列に戻して結合する
+    columns = []
+    for position in range(len(parts[0].columns)):
+        pieces = [part.iloc[:, position] for part in parts]
+        if all(isinstance(piece.dtype, pd.CategoricalDtype) for piece in pieces):
+            columns.append(pd.Series(union_categoricals(pieces)))
+        else:
+            pieces = [piece.astype(object) if isinstance(piece.dtype, pd.CategoricalDtype) else piece for piece in pieces]
+            columns.append(pd.concat(pieces, ignore_index=True))
+    df = pd.concat(columns, axis=1, ignore_index=True)
+    df.columns = parts[0].columns
+    return df
+
+
+def optimize_chunks(chunks, category_ratio=CATEGORY_RATIO, exact=True, verbose=True):
+    """
+    Optimize each chunk (e.g. of pd.read_csv(chunksize=...)) as soon as it is read and
+    combine them, so that only one chunk is held with the parsed dtypes at a time.
+    Returns (df, report) like reduce_mem_usage (report is None unless verbose).
+    """
+    parts, before_dtypes, before = [], None, None
+    for chunk in chunks:
+        if verbose:
+            memory = chunk.memory_usage(deep=True, index=False)
+            before_dtypes = chunk.dtypes if before_dtypes is None else before_dtypes
+            before = memory if before is None else before + memory
+        parts.append(optimize_columns(chunk, category_ratio, exact))
+    if len(parts) == 0:
+        return pd.DataFrame(), None
+
+    # チャンクごとに型が違った列（結合で広い型になった列など）をもう一度まとめて変換する
+    df = optimize_columns(concat_chunks(parts), category_ratio, exact)
+    if before is None:
+        return df, None
+    return df, memory_report(before_dtypes, before, df)
@@ -1,4 +1,6 @@
 import streamlit as st
+import csv_loader
+import dtype_optimizer
 import seaborn as sns
 import matplotlib.pyplot as plt
 import numpy as np
@@ -36,37 +38,12 @@ st.markdown(hide_menu_style, unsafe_allow_html=True)
 if 'select_mode' not in st.session_state:  # 初期化
     st.session_state.select_mode = "***CSVファイル***"
 
-def reduce_mem_usage(df, verbose=True):
-    numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
-    start_mem = df.memory_usage().sum() / 1024**2
-    for col in df.columns:
-        col_type = df[col].dtypes
-        if col_type in numerics:
-            c_min = df[col].min()
-            c_max = df[col].max()
-            if str(col_type)[:3] == 'int':
-                if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
-                    df[col] = df[col].astype(np.int8)
-                elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
-                    df[col] = df[col].astype(np.int16)
-                elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
-                    df[col] = df[col].astype(np.int32)
-                elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
-                    df[col] = df[col].astype(np.int64)
-            else:
-                if c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max:
-                    df[col] = df[col].astype(np.float16)
-                elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max:
-                    df[col] = df[col].astype(np.float32)
-                else:
-                    df[col] = df[col].astype(np.float64)
-    end_mem = df.memory_usage().sum() / 1024**2
-    return df
-
 def upload_csv():
     # csvがアップロードされたとき
     st.session_state['df'] = list()
     st.session_state["ja_honyaku"] = list()
+    # 読み込みの情報はコールバックの中で表示すると次の再実行で消えるので、保存しておいてページで表示する
+    st.session_state["load_info"] = list()
     
     if st.session_state['upload_csvfile'] is not None:
         st.session_state["ja_honyaku"] += [False] * len(st.session_state['upload_csvfile'])
@@ -74,22 +51,21 @@ def upload_csv():
             # アップロードされたファイルデータを読み込む
             file_data = uploaddata.read()
             # バイナリデータからPandas DataFrameを作成
-            try:
-                df = pd.read_csv(io.BytesIO(file_data), encoding="utf-8", engine="python")
-                st.session_state["ja_honyaku"][idx] = False
-            except UnicodeDecodeError:
-                # UTF-8で読み取れない場合はShift-JISエンコーディングで再試行
-                df = pd.read_csv(io.BytesIO(file_data), encoding="shift-jis", engine="python")
-                st.session_state["ja_honyaku"][idx] = True
-
-            # カラムの型を自動で適切に変換
-            st.session_state[f'df_{idx+1}'] = reduce_mem_usage(df)
+            # 文字コードは先頭の部分から判定する（UTF-8で読めなければShift-JIS）
+            # 表を編集して値を追加できるよう、文字列の列はカテゴリ型にしない
+            df, encoding, info = csv_loader.read_csv(file_data, combine=lambda chunks: dtype_optimizer.optimize_chunks(chunks, category_ratio=0))
+            st.session_state["load_info"].append((uploaddata.name, info))
+            st.session_state["ja_honyaku"][idx] = encoding != "utf-8"
+
+            # カラムの型は読み込みながらチャンクごとに変換している
+            st.session_state[f'df_{idx+1}'] = df
             st.session_state['df'].append(st.session_state[f'df_{idx+1}'])
 
 def upload_xlsx():
     # xlsxがアップロードされたとき
     st.session_state['df'] = list()
     st.session_state["ja_honyaku"] = list()
+    st.session_state["load_info"] = list()
 
     if st.session_state['upload_xlsxfile'] is not None:
         # Excelファイルを読み込む
@@ -100,8 +76,10 @@ def upload_xlsx():
             # Pandas DataFrameを作成
             df = pd.read_excel(xls, sheet_name=sheet_name)
 
-            # カラムの型を自動で適切に変換
-            st.session_state[f'df_{idx+1}'] = reduce_mem_usage(df)
+            # カラムの型を自動で適切に変換し、シートごとにメモリ使用量の変換前後を表示する
+            df, report = dtype_optimizer.reduce_mem_usage(df, category_ratio=0)
+            st.session_state["load_info"].append((sheet_name, {"message": None, "report": report}))
+            st.session_state[f'df_{idx+1}'] = df
             st.session_state['df'].append(st.session_state[f'df_{idx+1}'])
 
 
@@ -130,8 +108,17 @@ else:
 # ファイル形式が変更された場合にdfを空にする
 if st.session_state.select_mode != select_mode:
     st.session_state['df'] = None
+    st.session_state["load_info"] = list()
     st.session_state.select_mode = select_mode
 
+# ファイル（シート）ごとに、読み込みに時間がかかったときや読み飛ばした行があるとき、列の型を変換したときはその情報を表示する
+for name, info in st.session_state.get("load_info", list()):
+    if info["message"] is not None:
+        st.caption(f"{name}：{info['message']}")
+    if info["report"] is not None:
+        st.caption(f"{name}：{dtype_optimizer.report_message(info['report'])}")
+        st.dataframe(info["report"])
+
 try: 
     if len(st.session_state['df']) != 0:
         final_dfs, code = spreadsheet(*st.session_state['df'])
@@ -1,4 +1,5 @@
 import json
+import hashlib
 import random
 from datetime import datetime, timedelta
 from collections import defaultdict
@@ -8,11 +9,13 @@ import plotly
 import matplotlib.pyplot as plt
 import japanize_matplotlib
 import pandas as pd
+import numpy as np
 import folium
 from folium import plugins
 from folium.plugins import Draw, TimestampedGeoJson
-from turfpy.measurement import boolean_point_in_polygon
-from geojson import Point, Polygon, Feature
+from folium.elements import JSCSSMixin
+from branca.element import MacroElement
+from jinja2 import Template, UndefinedError
 import streamlit as st
 from streamlit_folium import st_folium
 import base64
@@ -22,6 +25,8 @@ import io
 from io import BytesIO
 import itertools
 import os
+import threading
+from collections import OrderedDict
 
 # 画像ファイルのパス
 image_path = os.path.join(os.path.dirname(__file__), '..', 'icon_image.png')
@@ -73,6 +78,17 @@ if 'df' not in st.session_state:  # 初期化
 if 'sorted_df' not in st.session_state:  # 初期化
     df = pd.DataFrame()
     st.session_state['sorted_df'] = df
+# 読み込んだCSVの中身のハッシュと、sorted_dfの内容を表すキー（レイヤーのキャッシュに使う）
+if 'data_key' not in st.session_state:  # 初期化
+    st.session_state['data_key'] = None
+if 'sorted_key' not in st.session_state:  # 初期化
+    st.session_state['sorted_key'] = None
+# ユーザーごと・時刻順に並べたデータフレームを管理する
+if 'user_df' not in st.session_state:  # 初期化
+    st.session_state['user_df'] = pd.DataFrame()
+# ユーザーごとの外接矩形・期間・点数・user_dfでの行の範囲を管理する
+if 'user_summary' not in st.session_state:  # 初期化
+    st.session_state['user_summary'] = pd.DataFrame()
 # tab2に実際に表示するデータフレーム
 if 'df_new' not in st.session_state:  # 初期化
     df = pd.DataFrame()
@@ -83,9 +99,6 @@ if 'draw_data' not in st.session_state:  # 初期化
 # それぞれの緯度経度のみの図形情報を管理する
 if 'gate_data' not in st.session_state:  # 初期化
     st.session_state['gate_data'] = list()
-# 軌跡の情報を管理する
-if 'kiseki_data' not in st.session_state:  # 初期化
-    st.session_state['kiseki_data'] = dict()
 # 軌跡を描画するモードか管理する
 if 'kiseki_flag' not in st.session_state:  # 初期化
     st.session_state['kiseki_flag'] = False
@@ -95,6 +108,9 @@ if "line_geojson" not in st.session_state:  # 初期化
 # 当たり判定のゲートごとの人数を管理する
 if "tuuka_list" not in st.session_state:  # 初期化
     st.session_state['tuuka_list'] = list()
+# 当たり判定に使う軌跡の線分の配列を管理する
+if "segments" not in st.session_state:  # 初期化
+    st.session_state['segments'] = None
 # tab3に表示する選択された図形の緯度経度情報を管理する
 if "selected_shape" not in st.session_state:  # 初期化
     st.session_state["selected_shape"] = list()
@@ -110,6 +126,117 @@ if "delete_shape_id" not in st.session_state:  # 初期化
     st.session_state["delete_shape_id"] = ""
 if "select_data_id" not in st.session_state:  # 初期化
     st.session_state["select_data_id"] = list()
+# シリアライズ済みの地図レイヤーを管理する
+if "layer_cache" not in st.session_state:  # 初期化
+    st.session_state["layer_cache"] = dict()
+
+# キャッシュしておくレイヤーのスクリプトの合計サイズ（バイト）
+LAYER_CACHE_BYTES = 64 * 1024 * 1024
+# キャッシュしたスクリプト中の親要素（地図）の名前の目印
+LAYER_PARENT = "__layer_parent__"
+
+
+# シリアライズ済みのスクリプトをそのまま地図に描画するレイヤー
+class CachedLayer(JSCSSMixin, MacroElement):
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this.layer_script.replace(this.layer_parent, this._parent.get_name()) }}
+        {% endmacro %}
+    """)
+
+    def __init__(self, kind, layer_script, default_js, default_css):
+        super().__init__()
+        self._name = "CachedLayer"
+        self.kind = kind
+        self.layer_script = layer_script
+        self.layer_parent = LAYER_PARENT
+        self.default_js = default_js
+        self.default_css = default_css
+
+
+# シリアライズ時に地図の代わりに親要素にする
+class LayerParent:
+    def get_name(self):
+        return LAYER_PARENT
+
+
+# レイヤーとその子要素のスクリプトを文字列にする
+def layer_script(element):
+    try:
+        script = element._template.module.script(element, {})
+    except UndefinedError:
+        script = element._template.render(this=element, kwargs={})
+    for child in element._children.values():
+        script += "\n" + layer_script(child)
+    return script
+
+
+# レイヤーが必要とするJavaScriptとCSSを集める
+def collect_assets(element, js, css):
+    js.extend(item for item in getattr(element, "default_js", []) if item not in js)
+    css.extend(item for item in getattr(element, "default_css", []) if item not in css)
+    for child in element._children.values():
+        collect_assets(child, js, css)
+    return js, css
+
+
+# 内容が変わっていないレイヤーはシリアライズ済みのものを使い回す
+def add_cached_layer(kind, layer_key, make_layer):
+    cache = st.session_state["layer_cache"]
+    if layer_key in cache:
+        script, js, css, size = cache[layer_key]
+    else:
+        layer = make_layer()
+        layer._parent = LayerParent()
+        js, css = collect_assets(layer, [], [])
+        script = layer_script(layer)
+        size = len(script.encode())
+        # 合計サイズが上限を超えないように古いものから捨てる（上限より大きいレイヤーはキャッシュしない）
+        if size <= LAYER_CACHE_BYTES:
+            while cache and sum(entry[3] for entry in cache.values()) + size > LAYER_CACHE_BYTES:
+                del cache[next(iter(cache))]
+            cache[layer_key] = (script, js, css, size)
+    CachedLayer(kind, script, js, css).add_to(st.session_state['map'])
+
+
+# 種類を指定してキャッシュしたレイヤーを地図から削除する
+def remove_layers(kind):
+    layers_to_remove = []
+    for key, value in st.session_state['map']._children.items():
+        if isinstance(value, CachedLayer) and value.kind == kind:
+            layers_to_remove.append(key)
+    for key in layers_to_remove:
+        del st.session_state['map']._children[key]
+
+
+# プロットのレイヤーを追加
+def add_points_layer():
+    def make_layer():
+        # プロットデータをまとめる
+        geojson = {"type": "FeatureCollection", "features": features_maker()}
+        # TimestampedGeoJsonの作成
+        return TimestampedGeoJson(
+            geojson,
+            period="PT1M",
+            duration='PT1M',
+            auto_play=False,
+            loop=False,
+            transition_time=500
+        )
+
+    remove_layers("points")
+    add_cached_layer("points", ("points", st.session_state['sorted_key']), make_layer)
+
+
+# ゲートのレイヤーを追加
+def add_gate_layer(sdata, tooltip_html, popup_html=None):
+    def make_layer():
+        if popup_html is None:
+            return folium.GeoJson(sdata, tooltip=tooltip_html)
+        return folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html))
+
+    layer_key = ("gate", hashlib.sha1(json.dumps([sdata, tooltip_html, popup_html], sort_keys=True).encode()).hexdigest())
+    add_cached_layer("gate", layer_key, make_layer)
 
 
 # 描画するプロットデータの作成
@@ -146,65 +273,23 @@ def features_maker():
     return features
 
 
-# 描画する軌跡データの作成
-def line_features_maker(kiseki):
-    for itr, group in st.session_state['sorted_df'].groupby(st.session_state['sorted_df'].columns[0]):
-        rows = list(group.iterrows())  # グループ内の行の情報をリストに取得
-        for i, (index, zahyou) in enumerate(rows):
-            if i < len(rows) - 1:  # 次の行が存在する場合
-                next_index, next_zahyou = rows[i + 1]
-                if kiseki:
-                    st.session_state['kiseki_data'][str(itr)].append(
-                        {'座標': [[zahyou["longitude"], zahyou["latitude"]], [next_zahyou["longitude"], next_zahyou["latitude"]]], '日時': datetime.strptime(str(zahyou["datetime"]), '%Y-%m-%d %H:%M:%S').strftime('%Y/%m/%d %H:%M')})
-                else:
-                    pass
-                
-    # line_features = []
-
-    # index_map = {value: index for index, value in enumerate(st.session_state['sorted_df']["uid"].unique())}
-
-    # # データをIDでグループ化する
-    # grouped_data = st.session_state['sorted_df'].groupby(st.session_state['sorted_df'].columns[0])
-
-    # for itr in st.session_state['sorted_df']["uid"].unique():
-    #     if itr in grouped_data.groups:
-    #         indexNum = index_map[itr]
-    #         group_df = grouped_data.get_group(itr)
-    #         # group_df[group_df.columns[0]].dt.strftime("%Y-%m-%dT%H:%M:%S")
-    #         coords = group_df[[group_df.columns[3], group_df.columns[2]]].values.tolist()
-    #         times = group_df[group_df.columns[1]].values.tolist()
-
-    #         # 各行の座標データから軌跡データを作成
-    #         for i in range(len(coords) - 1):
-    #         #     line_feature = {
-    #         #         'type': 'Feature',
-    #         #         'geometry': {
-    #         #             'type': 'LineString',
-    #         #             'coordinates': [coords[i], coords[i + 1]]
-    #         #         },
-    #         #         'properties': {
-    #         #             'time': times[i],
-    #         #             "popup": f"{indexNum + 1} - {itr}"
-    #         #         }
-    #         #     }
-    #         #     line_features.append(line_feature)
-
-    #             if kiseki:                   
-    #                 # 軌跡データをセッションの状態に保存
-    #                 st.session_state['kiseki_data'][str(itr)].append({'座標': [coords[i], coords[i + 1]],
-    #                                                                   '日時':  times[i]})
-    # return line_features
-
 def polylines_maker():
-    # ユニークなIDの最大文字数を取得
-    max_id_length = max(len(str(user_id)) for user_id in st.session_state['sorted_df']["userid"].unique())  
-    # 文字数に基づいて最適なポップアップの幅を計算
-    popup_width = max_id_length * 14  # 1文字あたりの幅を14pxと仮定
-    
-    for user_id, user_data in st.session_state['sorted_df'].groupby("userid"):
-        popup_html = f'<div style="font-size: 14px; font-weight: bold; width: {int(popup_width)}px; height: 15px; color: black;">UserID：{user_id}</div>'
-        folium.PolyLine(locations=user_data[['latitude', 'longitude']].values.tolist(), color='#01bfff', weight=3, opacity=0.9,
-                        popup=folium.Popup(popup_html)).add_to(st.session_state['map'])
+    def make_layer():
+        # ユニークなIDの最大文字数を取得
+        max_id_length = max(len(str(user_id)) for user_id in st.session_state['sorted_df']["userid"].unique())
+        # 文字数に基づいて最適なポップアップの幅を計算
+        popup_width = max_id_length * 14  # 1文字あたりの幅を14pxと仮定
+
+        # 全ユーザーの軌跡を1つのレイヤーにまとめる
+        layer = folium.FeatureGroup()
+        for user_id, user_data in st.session_state['sorted_df'].groupby("userid"):
+            popup_html = f'<div style="font-size: 14px; font-weight: bold; width: {int(popup_width)}px; height: 15px; color: black;">UserID：{user_id}</div>'
+            folium.PolyLine(locations=user_data[['latitude', 'longitude']].values.tolist(), color='#01bfff', weight=3, opacity=0.9,
+                            popup=folium.Popup(popup_html)).add_to(layer)
+        return layer
+
+    remove_layers("kiseki")
+    add_cached_layer("kiseki", ("kiseki", st.session_state['sorted_key']), make_layer)
 
 def change_mapinfo():
     change_dict = dict()
@@ -216,109 +301,142 @@ def change_mapinfo():
     except:
         pass
 
+# 日時の書式を指定して高速に変換する（書式が違うときは推定に任せる）
+def parse_datetime(values):
+    try:
+        return pd.to_datetime(values, format='%Y/%m/%d %H:%M')
+    except ValueError:
+        return pd.to_datetime(values)
+
+
+# CSVをチャンクごとに読み込み、型を固定した列だけを保持する
+# 読み込んだ点は通過時間で並べ替えて返す
+def read_gps_csv(file, chunk_rows=500000):
+    file.seek(0)
+    # アップロードされたファイルはsize、BytesIOはバッファの長さを全体の大きさにする
+    total_size = getattr(file, "size", None)
+    if total_size is None and hasattr(file, "getbuffer"):
+        total_size = len(file.getbuffer())
+    progress_bar = st.progress(0.0, text="CSVファイルを読み込み中")
+    names = ['userid', 'datetime', 'latitude', 'longitude']
+    chunks = []
+    reader = pd.read_csv(file, header=0, names=names,
+                         dtype={'userid': str, 'datetime': str, 'latitude': np.float64, 'longitude': np.float64},
+                         chunksize=chunk_rows)
+    for chunk in reader:
+        # IDが空の行は使わない
+        chunk['userid'] = chunk['userid'].str.strip()
+        chunk['datetime'] = parse_datetime(chunk['datetime'])
+        chunks.append(chunk[chunk['userid'].mask(chunk['userid'] == "").notna()])
+        if total_size:
+            progress_bar.progress(min(file.tell() / total_size, 1.0), text="CSVファイルを読み込み中")
+    progress_bar.empty()
+    if not chunks:
+        return pd.DataFrame(columns=names)
+
+    # 全体を結合してから並べ替えると2回コピーするので、並べ替えの順番を先に求めて列ごとに結合する
+    order = np.argsort(pd.concat([chunk['datetime'] for chunk in chunks]).to_numpy(), kind="stable")
+    columns = dict()
+    for name in names:
+        columns[name] = pd.concat([chunk.pop(name) for chunk in chunks], ignore_index=True).take(order)
+    return pd.DataFrame(columns)
+
+# 同じCSVを開いたセッションの間で共有するデータの数
+SHARED_DATASETS = 4
+
+@st.cache_resource
+def dataset_registry():
+    # 読み込んだデータフレームをCSVの中身のハッシュごとに1つだけ持つ（全セッションで共有する）
+    # loadingは読み込み中のCSVごとのロック（同じCSVを同時に開いたときに1回だけ読み込む）
+    return {"lock": threading.Lock(), "datasets": OrderedDict(), "loading": dict()}
+
+def shared_dataset(registry, key):
+    with registry["lock"]:
+        if key in registry["datasets"]:
+            registry["datasets"].move_to_end(key)
+            return registry["datasets"][key]
+    return None
+
+def load_dataset(file):
+    # 他のセッションが同じ中身のCSVを読み込んでいれば、そのデータフレームをコピーせずに使う
+    key = hashlib.sha256(file.getvalue()).hexdigest()
+    registry = dataset_registry()
+    dataset = shared_dataset(registry, key)
+    if dataset is not None:
+        return key, dataset
+
+    with registry["lock"]:
+        loading = registry["loading"].setdefault(key, threading.Lock())
+    # 他のセッションが同じCSVを読み込み中なら、終わるのを待ってそのデータを使う
+    with loading:
+        dataset = shared_dataset(registry, key)
+        if dataset is None:
+            try:
+                dataset = parse_dataset(file)
+                # 最後に開かれてから長いものから消す（消しても開いているセッションのデータはそのまま残る）
+                with registry["lock"]:
+                    registry["datasets"][key] = dataset
+                    while len(registry["datasets"]) > SHARED_DATASETS:
+                        registry["datasets"].popitem(last=False)
+            finally:
+                with registry["lock"]:
+                    registry["loading"].pop(key, None)
+    return key, dataset
+
+def parse_dataset(file):
+    # アップロードされたファイルをチャンクごとに読み込み、通過時間でソートする
+    df = read_gps_csv(file)
+
+    # ユニークなIDを取得
+    unique_values = df.iloc[:, 0].unique()
+    # IDのデータフレームを作成
+    df_new = pd.DataFrame(unique_values, columns=["newid"])
+
+    # 1からスタートするようにインデックスを設定
+    df_new.index = range(1, len(df_new) + 1)
+
+    user_df, user_summary = summarize_users(df)
+    # 当たり判定に使う軌跡の線分もデータごとに1回だけ作る
+    return df, df_new, user_df, user_summary, segments_maker(user_df, user_summary)
+
 # csvのuploaderの状態が変化したときに呼ばれるcallback関数
 def upload_csv():
     # csvがアップロードされたとき
     if st.session_state["upload_csvfile"] is not None:
-        # アップロードされたファイルデータを読み込む
-        file_data = st.session_state["upload_csvfile"].read()
-        # バイナリデータからPandas DataFrameを作成
-        df = pd.read_csv(io.BytesIO(file_data))
-        df.columns = ['userid', 'datetime', 'latitude', 'longitude']
-        df['datetime'] = pd.to_datetime(df['datetime'])
-        # 通過時間でソート
-        df.sort_values(by=[df.columns[1]], inplace=True)
-
-        # ユニークなIDを取得
-        unique_values = df.iloc[:, 0].unique()
-        # IDのデータフレームを作成
-        df_new = pd.DataFrame(unique_values, columns=["newid"])
-
-        # 1からスタートするようにインデックスを設定
-        df_new.index = range(1, len(df_new) + 1)
+        key, (df, df_new, user_df, user_summary, segments) = load_dataset(st.session_state["upload_csvfile"])
+        # CSVの中身のハッシュは読み込み時に1回だけ求め、表示するデータのキーにする
+        st.session_state['data_key'] = key
+        st.session_state['sorted_key'] = key
 
-        # データフレームをセッションの状態に保存
-        st.session_state['df'] = df.copy()
+        # データフレームをセッションの状態に保存（読み込み専用なのでコピーせずに共有する）
+        st.session_state['df'] = df
         # st.session_state['df'] = TrajDataFrame(df_normal, datetime='datetime', latitude='latitude', longitude='longitude', user_id='userid')
-        st.session_state['df_new'] = df_new.copy()
-        st.session_state['sorted_df'] = df.copy()
+        st.session_state['df_new'] = df_new
+        st.session_state['sorted_df'] = df
+        st.session_state['user_df'], st.session_state['user_summary'] = user_df, user_summary
+        st.session_state['segments'] = segments
         # st.session_state['sorted_df'] = TrajDataFrame(df_sorted, datetime='datetime', latitude='latitude', longitude='longitude', user_id='userid')
         # st.session_state['sorted_df'].sort_values(by=[st.session_state['sorted_df'].columns[1]], inplace=True)
 
-        st.session_state['kiseki_data'] = {str(itr): [] for itr in unique_values}
-
-        features = features_maker()
-        line_features_maker(True)
-
-        # プロットデータをまとめる
-        geojson = {"type": "FeatureCollection", "features": features}
-        # 軌跡データをまとめる
-        # line_geojson = {'type': 'FeatureCollection', 'features': line_features}
-        # st.session_state["line_geojson"] = line_geojson
-
-        # 地図のレイヤーを削除
-        if 'map' in st.session_state:
-            layers_to_remove = []
-            for key, value in st.session_state['map']._children.items():
-                if isinstance(value, TimestampedGeoJson):
-                    layers_to_remove.append(key)
-            for key in layers_to_remove:
-                del st.session_state['map']._children[key]
-
-        # TimestampedGeoJsonの作成
-        timestamped_geojson = TimestampedGeoJson(
-            geojson,
-            period="PT1M",
-            duration='PT1M',
-            auto_play=False,
-            loop=False,
-            transition_time=500
-        )
-
-        # TimestampedGeoJsonをマップに追加
-        timestamped_geojson.add_to(st.session_state['map'])
+        # プロットのレイヤーを追加（内容が同じならシリアライズ済みのものを使う）
+        add_points_layer()
 
         # 軌跡のGeoJSONを削除する
-        line_layers_to_remove = []
-        for key, value in st.session_state['map']._children.items():
-            if isinstance(value, folium.features.GeoJson):
-                line_layers_to_remove.append(key)
-        for key in line_layers_to_remove:
-            del st.session_state['map']._children[key]
+        remove_layers("gate")
 
         # 地図に図形情報を追加
         if len(st.session_state['draw_data']) != 0:
-            for idx, sdata in enumerate(st.session_state['draw_data']):
-
-                # 通過人数カウントの準備
-                append_list = [dict() for _ in range(len(st.session_state['draw_data']))]
-                st.session_state['tuuka_list'] = append_list
-
-                # ゲートとIDの組み合わせごとにループ
-                for idx1, gates in enumerate(st.session_state['gate_data']):
-                    for key, values in st.session_state['kiseki_data'].items():
-
-                        # ポリゴンゲートのときは初期座標をチェック
-                        if gates[0] == gates[-1]:
-                            if ingate(values[0]["座標"][0], gates):
-                                st.session_state['tuuka_list'][idx1][key] = values[0]["日時"]
-                                continue  # このIDのループを終了
-                            else:
-                                pass
-
-                        kekka = cross_judge(gates, values)
-                        if kekka[0]:
-                            st.session_state['tuuka_list'][idx1][key] = values[kekka[1]]["日時"]
-                            continue  # このIDのループを終了
+            # ゲートごとに通過人数をカウント
+            count_gates()
 
+            for idx, sdata in enumerate(st.session_state['draw_data']):
                 # 図形IDを表示するツールチップを設定
                 tooltip_html = '<div style="font-size: 16px;">gateid：{}</div>'.format(idx + 1)
                 # 通過人数を表示するポップアップを指定
                 popup_html = '<div style="font-size: 16px; font-weight: bold; width: 110px; height: 20px;  color: #27b9cc;">通過人数：{}人</div>'.format(
                     len(st.session_state['tuuka_list'][idx]))
                 # 地図にツールチップとポップアップを追加する
-                folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html)).add_to(
-                    st.session_state['map'])
+                add_gate_layer(sdata, tooltip_html, popup_html)
 
     
     else:
@@ -327,108 +445,136 @@ def upload_csv():
         st.session_state['df'] = df.copy()
         st.session_state['df_new'] = df.copy()
         st.session_state['sorted_df'] = df.copy()
+        st.session_state['data_key'] = None
+        st.session_state['sorted_key'] = None
+        st.session_state['user_df'] = df.copy()
+        st.session_state['user_summary'] = df.copy()
 
         st.session_state["graph_data"] = dict()
 
         # TimestampedGeoJsonレイヤーを削除
         if 'map' in st.session_state:
-            layers_to_remove = []
-            for key, value in st.session_state['map']._children.items():
-                if isinstance(value, TimestampedGeoJson):
-                    layers_to_remove.append(key)
-            for key in layers_to_remove:
-                del st.session_state['map']._children[key]
+            remove_layers("points")
 
         # 軌跡のデータを削除
-        st.session_state['kiseki_data'] = dict()
-        line_layers_to_remove = []
-        for key, value in st.session_state['map']._children.items():
-            if isinstance(value, folium.features.GeoJson):
-                line_layers_to_remove.append(key)
-        for key in line_layers_to_remove:
-            del st.session_state['map']._children[key]
+        st.session_state['segments'] = None
+        remove_layers("gate")
 
         # 地図に図形情報を追加
         if len(st.session_state['draw_data']) != 0:
+            # ゲートごとに通過人数をカウント
+            count_gates()
+
             for idx, sdata in enumerate(st.session_state['draw_data']):
 
                 if len(st.session_state['df_new']) != 0:
-                    # 通過人数カウントの準備
-                    append_list = [dict() for _ in range(len(st.session_state['draw_data']))]
-                    st.session_state['tuuka_list'] = append_list
-        
-                    # ゲートとIDの組み合わせごとにループ
-                    for idx1, gates in enumerate(st.session_state['gate_data']):
-                        for key, values in st.session_state['kiseki_data'].items():
-        
-                            # ポリゴンゲートのときは初期座標をチェック
-                            if gates[0] == gates[-1]:
-                                if ingate(values[0]["座標"][0], gates):
-                                    st.session_state['tuuka_list'][idx1][key] = values[0]["日時"]
-                                    continue  # このIDのループを終了
-                                else:
-                                    pass
-        
-                            kekka = cross_judge(gates, values)
-                            if kekka[0]:
-                                st.session_state['tuuka_list'][idx1][key] = values[kekka[1]]["日時"]
-                                continue  # このIDのループを終了
-                            else:
-                                pass
-        
                     # 図形IDを表示するツールチップを設定
                     tooltip_html = '<div style="font-size: 16px;">gateid：{}</div>'.format(idx + 1)
                     # 通過人数を表示するポップアップを指定
                     popup_html = '<div style="font-size: 16px; font-weight: bold; width: 110px; height: 20px;  color: #27b9cc;">通過人数：{}人</div>'.format(
                         len(st.session_state['tuuka_list'][idx]))
-                    folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html)).add_to(st.session_state['map'])
+                    add_gate_layer(sdata, tooltip_html, popup_html)
         
                 else:
                     # 図形IDを表示するツールチップを設定
                     tooltip_html = '<div style="font-size: 16px;">gateid：{}</div>'.format(idx + 1)
-                    folium.GeoJson(sdata, tooltip=tooltip_html).add_to(st.session_state['map'])
+                    add_gate_layer(sdata, tooltip_html)
 
         # 線のPolyLineを削除する
-        line_layers_to_remove = []
-        for key, value in st.session_state['map']._children.items():
-            if isinstance(value, folium.vector_layers.PolyLine):
-                line_layers_to_remove.append(key)
-        for key in line_layers_to_remove:
-            del st.session_state['map']._children[key]
+        remove_layers("kiseki")
             
     change_mapinfo()
 
+# ユーザーごと・時刻順に並べたデータフレームと、ユーザーごとの要約表を作る
+def summarize_users(df):
+    codes, uniques = pd.factorize(df["userid"])
+    times = df["datetime"].values.astype('datetime64[s]').astype(np.int64)
+    order = np.lexsort((times, codes))
+    user_df = df.iloc[order].reset_index(drop=True)
+
+    counts = np.bincount(codes, minlength=len(uniques))
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    starts, stops = offsets[:-1], offsets[1:]
+    lon, lat, times = user_df["longitude"].to_numpy(), user_df["latitude"].to_numpy(), times[order]
+    user_summary = pd.DataFrame({
+        "min_lon": np.minimum.reduceat(lon, starts) if len(lon) else lon,
+        "max_lon": np.maximum.reduceat(lon, starts) if len(lon) else lon,
+        "min_lat": np.minimum.reduceat(lat, starts) if len(lat) else lat,
+        "max_lat": np.maximum.reduceat(lat, starts) if len(lat) else lat,
+        "first_time": times[starts] if len(times) else times,
+        "last_time": times[stops - 1] if len(times) else times,
+        "points": counts,
+        "start": starts,
+        "stop": stops
+    }, index=pd.Index(uniques, name="userid"))
+    return user_df, user_summary
+
+
+# 各ユーザーの範囲 [lows, highs) の中で時刻がvalue以上（rightならvalueより後）になる最初の行を同時に二分探索する
+def bisect_ranges(times, lows, highs, value, right=False):
+    lows, highs = lows.astype(np.int64), highs.astype(np.int64)
+    while (lows < highs).any():
+        active = lows < highs
+        mids = (lows + highs) // 2
+        mid_times = times[np.minimum(mids, len(times) - 1)]
+        before = (mid_times <= value) if right else (mid_times < value)
+        lows = np.where(active & before, mids + 1, lows)
+        highs = np.where(active & ~before, mids, highs)
+    return lows
+
+
+# 要約表で絞り込んだユーザーの行の範囲をつなげて取り出す（期間があれば範囲をその期間に切り詰める）
+def slice_users(selected_values, window=None):
+    summary = st.session_state['user_summary']
+    if len(selected_values) != 0:
+        summary = summary[summary.index.isin(selected_values)]
+    starts, stops = summary["start"].to_numpy(), summary["stop"].to_numpy()
+    if window is not None:
+        keep = (summary["first_time"].to_numpy() <= window[1]) & (summary["last_time"].to_numpy() >= window[0])
+        starts, stops = starts[keep], stops[keep]
+        # 期間の端はユーザーごとの時刻の並びから、全ユーザー同時に二分探索で求める
+        times = st.session_state['user_df']["datetime"].values
+        first, last = (np.datetime64(value, 's') for value in window)
+        starts, stops = bisect_ranges(times, starts, stops, first), bisect_ranges(times, starts, stops, last, right=True)
+    lengths = stops - starts
+    rows = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return st.session_state['user_df'].iloc[rows]
+
+
+# 読み込んだデータ全体の期間
+def data_time_range():
+    summary = st.session_state['user_summary']
+    return int(summary["first_time"].min()), int(summary["last_time"].max())
+
+
 def select_data():
     # プロット・軌跡を描画するデータの選択
     selected_values = st.session_state["select_data_id"]
 
+    # 期間が全体のままのときは期間で絞り込まない
+    window = tuple(int(pd.Timestamp(value).timestamp()) for value in st.session_state["select_data_window"])
+    if window == data_time_range():
+        window = None
+
     # 選択されていない場合はそのままのデータ
-    if len(selected_values) == 0:
+    if len(selected_values) == 0 and window is None:
         st.session_state['sorted_df'] = st.session_state['df']
+        st.session_state['sorted_key'] = st.session_state['data_key']
         # ユニークなIDを取得
         # unique_values = st.session_state['sorted_df'].iloc[:, 0].unique()
 
-    # 選択された場合はデータをソート
+    # 選択された場合は要約表の行の範囲から取り出して時刻順に並べる
     else:
-        st.session_state['sorted_df'] = st.session_state['df'][st.session_state['df'].iloc[:, 0].isin(selected_values)]
-        st.session_state['sorted_df'] = st.session_state['sorted_df'].reset_index(drop=True)
-        st.session_state['sorted_df'].sort_values(by=[st.session_state['sorted_df'].columns[1]], inplace=True)
+        st.session_state['sorted_df'] = slice_users(selected_values, window)
+        st.session_state['sorted_df'] = st.session_state['sorted_df'].sort_values(by=[st.session_state['sorted_df'].columns[1]], kind="stable").reset_index(drop=True)
+        # 内容はCSVと選択したIDと期間で決まるので、データをハッシュせずにキーにする
+        st.session_state['sorted_key'] = (st.session_state['data_key'], tuple(selected_values), window)
 
         # 図形のジオJSONを削除する
-        line_layers_to_remove = []
-        for key, value in st.session_state['map']._children.items():
-            if isinstance(value, folium.features.GeoJson):
-                line_layers_to_remove.append(key)
-        for key in line_layers_to_remove:
-            del st.session_state['map']._children[key]
+        remove_layers("gate")
 
         # 線のPolyLineを削除する
-        line_layers_to_remove = []
-        for key, value in st.session_state['map']._children.items():
-            if isinstance(value, folium.vector_layers.PolyLine):
-                line_layers_to_remove.append(key)
-        for key in line_layers_to_remove:
-            del st.session_state['map']._children[key]
+        remove_layers("kiseki")
 
         # ユニークなIDのリスト
         # unique_values = selected_values
@@ -438,75 +584,28 @@ def select_data():
     
     # 描画するプロットデータ
     # features = features_maker(unique_values)
-    features = features_maker()
-    line_features_maker(False)
     # line_features = line_features_maker(unique_values, False)
 
-    # プロットデータをまとめる
-    geojson = {"type": "FeatureCollection", "features": features}
-    # 軌跡データをまとめる
-    # line_geojson = {'type': 'FeatureCollection', 'features': line_features}
-    # st.session_state["line_geojson"] = line_geojson
-
-    # TimestampedGeoJsonの作成
-    timestamped_geojson = TimestampedGeoJson(
-        geojson,
-        period="PT1M",
-        duration='PT1M',
-        auto_play=False,
-        loop=False,
-        transition_time=500
-    )
-
-    # TimestampedGeoJsonレイヤーを削除
-    if 'map' in st.session_state:
-        layers_to_remove = []
-        for key, value in st.session_state['map']._children.items():
-            if isinstance(value, TimestampedGeoJson):
-                layers_to_remove.append(key)
-        for key in layers_to_remove:
-            del st.session_state['map']._children[key]
-
-    # TimestampedGeoJsonをマップに追加
-    timestamped_geojson.add_to(st.session_state['map'])
+    # プロットのレイヤーを追加（内容が同じならシリアライズ済みのものを使う）
+    add_points_layer()
+
+    # ゲートごとに通過人数をカウント
+    count_gates()
 
     # 地図に図形情報を追加
     for idx, sdata in enumerate(st.session_state['draw_data']):
         if len(st.session_state['df_new']) != 0:
-            # 通過人数カウントの準備
-            append_list = [dict() for _ in range(len(st.session_state['draw_data']))]
-            st.session_state['tuuka_list'] = append_list
-
-            # ゲートとIDの組み合わせごとにループ
-            for idx1, gates in enumerate(st.session_state['gate_data']):
-                for key, values in st.session_state['kiseki_data'].items():
-
-                    # ポリゴンゲートのときは初期座標をチェック
-                    if gates[0] == gates[-1]:
-                        if ingate(values[0]["座標"][0], gates):
-                            st.session_state['tuuka_list'][idx1][key] = values[0]["日時"]
-                            continue  # このIDのループを終了
-                        else:
-                            pass
-
-                    kekka = cross_judge(gates, values)
-                    if kekka[0]:
-                        st.session_state['tuuka_list'][idx1][key] = values[kekka[1]]["日時"]
-                        continue  # このIDのループを終了
-                    else:
-                        pass
-
             # 図形IDを表示するツールチップを設定
             tooltip_html = '<div style="font-size: 16px;">gateid：{}</div>'.format(idx + 1)
             # 通過人数を表示するポップアップを指定
             popup_html = '<div style="font-size: 16px; font-weight: bold; width: 110px; height: 20px;  color: #27b9cc;">通過人数：{}人</div>'.format(
                 len(st.session_state['tuuka_list'][idx]))
-            folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html)).add_to(st.session_state['map'])
+            add_gate_layer(sdata, tooltip_html, popup_html)
 
         else:
             # 図形IDを表示するツールチップを設定
             tooltip_html = '<div style="font-size: 16px;">gateid：{}</div>'.format(idx + 1)
-            folium.GeoJson(sdata, tooltip=tooltip_html).add_to(st.session_state['map'])
+            add_gate_layer(sdata, tooltip_html)
 
     # 軌跡の追加
     if st.session_state['kiseki_flag']:
@@ -523,6 +622,37 @@ def select_data():
 
     change_mapinfo()
 
+# グラフで選べる集計の幅（秒）
+BIN_WIDTHS = {"5分": 300, "15分": 900, "1時間": 3600, "1日": 86400}
+
+# 通過時刻（エポック秒）から1分ごとの累積人数を作る
+# 通過のあった1分(bins)だけについて、cumulative[i]は bins[i] より前に通過した人数（通過のない分の配列は作らない）
+# 集計範囲(origin, end)は最初の通過日の0時から最後の通過日の翌日0時まで
+def cumulative_counts(times):
+    times = np.asarray(times, dtype=np.int64)
+    if len(times) == 0:
+        return {"origin": 0, "end": 0, "bins": np.zeros(0, dtype=np.int64), "cumulative": np.zeros(1, dtype=np.int64)}
+    origin = int(times.min()) // 86400 * 86400
+    end = (int(times.max()) // 86400 + 1) * 86400
+    bins, counts = np.unique((times - origin) // 60, return_counts=True)
+    return {"origin": origin, "end": end, "bins": bins, "cumulative": np.concatenate(([0], np.cumsum(counts)))}
+
+
+# start から end までを bin_seconds ごとに区切り、区間の人数を累積人数の差で求める
+def window_counts(graph, start, end, bin_seconds):
+    edges = np.append(np.arange(start, end, bin_seconds, dtype=np.int64), end)
+    idx = np.searchsorted(graph["bins"], -(-(edges - graph["origin"]) // 60))
+    return edges[:-1], np.diff(graph["cumulative"][idx])
+
+
+# 選択された図形全体の集計範囲
+def graph_time_range():
+    graphs = [st.session_state['graph_data'][idx] for idx in st.session_state["select_graph_ids"]]
+    start = min(graph["origin"] for graph in graphs)
+    end = max(graph["end"] for graph in graphs)
+    return int(start), int(end)
+
+
 def select_graph():
     # st.session_state["cols"][1].selectbox("グラフを表示したい図形のIDを選択してください", [""]+ [str(value) for value in range(1, len(st.session_state['gate_data']) + 1)],
     #                        key="select_graph_id",
@@ -533,54 +663,11 @@ def select_graph():
     if len(st.session_state['select_graph_ids']) != 0:
         for idx in st.session_state['select_graph_ids']:
             data = st.session_state['tuuka_list'][int(idx) - 1]
-            dates = data.values()
-            first_date_str = next(iter(dates))
-            start_date = datetime.strptime(first_date_str, '%Y/%m/%d %H:%M').date()
-
-            # 日付と時間帯ごとに人数をカウントする辞書を初期化
-            hourly_counts = defaultdict(lambda: defaultdict(int))
-
-            # 日付ごとにデータを処理して人数をカウント
-            for date_str in dates:
-                dt = datetime.strptime(date_str, '%Y/%m/%d %H:%M')
-                date = dt.date()
-                hour = dt.hour
-                hourly_counts[date][hour] += 1
-
-            # print(hourly_counts.items())
-            # 結果を表示
-            counts_dict = dict()
-            for date, counts in hourly_counts.items():
-                for hour in range(24):
-                    counts_dict[f"{date.strftime('%m/%d')} {hour:02d}時"] = counts[hour]
-
-            # データを時刻順にソート
-            sorted_data = sorted(counts_dict.items())
-
-            # 折れ線グラフのトレースを作成
-            trace = go.Scatter(x=[f"{start_date.strftime('%m/%d')} {hour:02d}:00" for hour in range(24)],
-                               y=[counts for hour, counts in sorted_data],
-                               mode='lines', name='通過人数[人]')
+            # 通過時刻をエポック秒の配列にする
+            times = parse_datetime(list(data.values())).values.astype('datetime64[s]').astype(np.int64)
 
-            # グラフのレイアウトを設定
-            layout = go.Layout(
-                title='通過人数',
-                xaxis=dict(title='日時'),
-                yaxis=dict(
-                    title='通過人数[人]',
-                    tickvals=list(range(max([counts for hour, counts in sorted_data]) + 1)),  # 整数のリストを設定
-                    tickformat='d',  # 整数表示に設定
-                )
-            )
-
-            # グラフオブジェクトを作成
-            fig = go.Figure(data=[trace], layout=layout)
-
-            # グラフをJSON形式に変換
-            graph_json = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
-
-            # JSONをst.session_stateに保存
-            st.session_state["graph_data"][idx] = graph_json
+            # 累積人数の配列をst.session_stateに保存（集計の幅を変えても作り直さない）
+            st.session_state["graph_data"][idx] = cumulative_counts(times)
 
     else:
         # グラフを空にする
@@ -594,12 +681,7 @@ def kiseki_draw():
 
     else:
         # 線のPolyLineを削除する
-        line_layers_to_remove = []
-        for key, value in st.session_state['map']._children.items():
-            if isinstance(value, folium.vector_layers.PolyLine):
-                line_layers_to_remove.append(key)
-        for key in line_layers_to_remove:
-            del st.session_state['map']._children[key]
+        remove_layers("kiseki")
             
     change_mapinfo()
     
@@ -637,15 +719,8 @@ def delete_shape():
         # 削除対象の図形を特定
         delete_shape = st.session_state['draw_data'][delete_shape_id - 1]
 
-        # 図形をマップから削除するためのキーを記録
-        keys_to_remove = []
-        for key, value in st.session_state['map']._children.items():
-            if isinstance(value, folium.features.GeoJson) and value.data == delete_shape:
-                keys_to_remove.append(key)
-
-        # マップから図形を削除
-        for key in keys_to_remove:
-            del st.session_state['map']._children[key]
+        # 図形をマップから削除（残りの図形は後で追加し直す）
+        remove_layers("gate")
 
         # draw_dataから図形を削除
         st.session_state['draw_data'].remove(delete_shape)
@@ -655,108 +730,142 @@ def delete_shape():
         if len(st.session_state['selected_shape']) != 0:
             st.session_state["selected_shape"].pop(delete_shape_id - 1)
 
+        # 残ったゲートの通過人数はそのまま使えるので、数が合わないときだけ数え直す
+        if len(st.session_state['tuuka_list']) != len(st.session_state['gate_data']):
+            count_gates()
+
         for idx, sdata in enumerate(st.session_state['draw_data']):
             if len(st.session_state['df_new']) != 0:
-                # 通過人数カウントの準備
-                append_list = [dict() for _ in range(len(st.session_state['draw_data']))]
-                st.session_state['tuuka_list'] = append_list
-
-                # ゲートとIDの組み合わせごとにループ
-                for idx1, gates in enumerate(st.session_state['gate_data']):
-                    for key, values in st.session_state['kiseki_data'].items():
-
-                        # ポリゴンゲートのときは初期座標をチェック
-                        if gates[0] == gates[-1]:
-                            if ingate(values[0]["座標"][0], gates):
-                                st.session_state['tuuka_list'][idx1][key] = values[0]["日時"]
-                                continue  # このIDのループを終了
-                            else:
-                                pass
-
-                        kekka = cross_judge(gates, values)
-                        if kekka[0]:
-                            st.session_state['tuuka_list'][idx1][key] = values[kekka[1]]["日時"]
-                            continue  # このIDのループを終了
-
                 # 図形IDを表示するツールチップを設定
                 tooltip_html = '<div style="font-size: 16px;">gateid：{}</div>'.format(idx + 1)
                 # 通過人数を表示するポップアップを指定
                 popup_html = '<div style="font-size: 16px; font-weight: bold; width: 110px; height: 20px;  color: #27b9cc;">通過人数：{}人</div>'.format(
                     len(st.session_state['tuuka_list'][idx]))
-                folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html)).add_to(
-                    st.session_state['map'])
+                add_gate_layer(sdata, tooltip_html, popup_html)
 
 
             else:
                 # 図形IDを表示するツールチップを設定
                 tooltip_html = '<div style="font-size: 16px;">gateid：{}</div>'.format(idx + 1)
-                folium.GeoJson(sdata, tooltip=tooltip_html).add_to(st.session_state['map'])
+                add_gate_layer(sdata, tooltip_html)
 
             # x座標、y座標ごとに座標が一切被っていない場合はfalseを返す
 
     change_mapinfo()
     
 
-def max_min_cross(p1, p2, p3, p4):
-    min_ab, max_ab = min(p1, p2), max(p1, p2)
-    min_cd, max_cd = min(p3, p4), max(p3, p4)
-
-    # それぞれの最大値と最小値を比較
-    # 最大値 < 最小値の時にfalseを返す
-    if min_ab > max_cd or max_ab < min_cd:
-        return False
-
-    return True
-
-
-# 2つの線分の交差判定
-def cross_judge(gates, values):
-    flag = False
-    idx = -1
-    # ゲートとIDの組み合わせごとにループ
-    for idx1 in range(len(gates) - 1):
-        # ゲートを構成する線分の一つ
-        line1 = [
-            (gates[idx1][0], gates[idx1][1]),
-            (gates[idx1 + 1][0], gates[idx1 + 1][1])
-        ]
-        for idx2 in range(len(values)):
-            # 軌跡の線分の一つ
-            line2 = [
-                (values[idx2]["座標"][0][0], values[idx2]["座標"][0][1]),
-                (values[idx2]["座標"][1][0], values[idx2]["座標"][1][1])
-            ]
-            (a, b, c, d) = (line1[0], line1[1], line2[0], line2[1])
-
-            # x座標による判定
-            if not max_min_cross(a[0], b[0], c[0], d[0]):
-                continue
-
-            # y座標による判定
-            if not max_min_cross(a[1], b[1], c[1], d[1]):
-                continue
-
-            tc1 = (a[0] - b[0]) * (c[1] - a[1]) + (a[1] - b[1]) * (a[0] - c[0])
-            tc2 = (a[0] - b[0]) * (d[1] - a[1]) + (a[1] - b[1]) * (a[0] - d[0])
-            td1 = (c[0] - d[0]) * (a[1] - c[1]) + (c[1] - d[1]) * (c[0] - a[0])
-            td2 = (c[0] - d[0]) * (b[1] - c[1]) + (c[1] - d[1]) * (c[0] - b[0])
-            if tc1 * tc2 <= 0 and td1 * td2 <= 0:
-                flag = True
-                idx = idx2
-                break
-        if flag:
-            break
-    return (flag, idx)
-
-
-# プロットの初期座標がゲート内にあるか判定
-def ingate(plot_point, gate_polygon):
-    # plot_point = [float(plot_point)]
-    point = Feature(geometry=Point(plot_point))
-    polygon = Polygon(
-        [gate_polygon]
-    )
-    return boolean_point_in_polygon(point, polygon)
+# 軌跡の線分を連続した配列にまとめる
+# ユーザーごと・時刻順に並んだuser_dfの隣り合う行を線分にする（ユーザーの最後の行から始まる線分はない）
+def segments_maker(user_df, user_summary):
+    counts = np.maximum(user_summary["points"].to_numpy() - 1, 0)
+    starts = np.ones(len(user_df), dtype=bool)
+    starts[user_summary["stop"].to_numpy()[user_summary["points"].to_numpy() > 0] - 1] = False
+    starts = np.flatnonzero(starts)
+    lon, lat = user_df["longitude"].to_numpy(np.float64), user_df["latitude"].to_numpy(np.float64)
+
+    return {
+        "keys": [str(key) for key in user_summary.index],
+        "offsets": np.concatenate(([0], np.cumsum(counts))),  # ユーザーごとの線分の開始位置
+        "user": np.repeat(np.arange(len(counts)), counts),  # 線分ごとのユーザー番号
+        "x1": lon[starts],
+        "y1": lat[starts],
+        "x2": lon[starts + 1],
+        "y2": lat[starts + 1],
+        "times": user_df["datetime"].iloc[starts].dt.strftime('%Y/%m/%d %H:%M').to_numpy(dtype=object)
+    }
+
+
+# ゲートの全ての辺と全ての線分の交差判定
+def cross_judge(gates, segments, chunk_size=1 << 18):
+    n_segments = len(segments["x1"])
+    no_cross = np.iinfo(np.int64).max
+    best = np.full(len(segments["keys"]), no_cross, dtype=np.int64)
+
+    gate = np.asarray(gates, dtype=np.float64)
+    ax, ay = gate[:-1, 0, None], gate[:-1, 1, None]
+    bx, by = gate[1:, 0, None], gate[1:, 1, None]
+
+    # メモリを抑えるため線分をchunk_sizeずつ判定する
+    for start in range(0, n_segments, chunk_size):
+        stop = min(start + chunk_size, n_segments)
+        cx, cy = segments["x1"][start:stop], segments["y1"][start:stop]
+        dx, dy = segments["x2"][start:stop], segments["y2"][start:stop]
+
+        # x座標、y座標による判定
+        hit = (np.maximum(ax, bx) >= np.minimum(cx, dx)) & (np.minimum(ax, bx) <= np.maximum(cx, dx))
+        hit &= (np.maximum(ay, by) >= np.minimum(cy, dy)) & (np.minimum(ay, by) <= np.maximum(cy, dy))
+
+        tc1 = (ax - bx) * (cy - ay) + (ay - by) * (ax - cx)
+        tc2 = (ax - bx) * (dy - ay) + (ay - by) * (ax - dx)
+        td1 = (cx - dx) * (ay - cy) + (cy - dy) * (cx - ax)
+        td2 = (cx - dx) * (by - cy) + (cy - dy) * (cx - bx)
+        hit &= (tc1 * tc2 <= 0) & (td1 * td2 <= 0)
+
+        # 番号の小さいゲートの辺を優先し、その辺で最初に交差した線分を記録
+        edge_idx, seg_idx = np.nonzero(hit)
+        seg_idx += start
+        np.minimum.at(best, segments["user"][seg_idx], edge_idx * n_segments + seg_idx)
+
+    # ユーザーごとの線分番号（交差なしは-1）
+    first = np.full(len(segments["keys"]), -1, dtype=np.int64)
+    found = best != no_cross
+    first[found] = best[found] % n_segments - segments["offsets"][:-1][found]
+    return first
+
+
+# ゲートを通過したIDと通過時刻の辞書を作成
+def judge_gate(gates):
+    segments = st.session_state['segments']
+    offsets = segments["offsets"]
+    first = cross_judge(gates, segments)
+
+    # ポリゴンゲートのときは全ユーザーの初期座標をまとめてチェック
+    inside = np.zeros(len(segments["keys"]), dtype=bool)
+    if gates[0] == gates[-1]:
+        has_segments = offsets[:-1] < offsets[1:]
+        starts = offsets[:-1][has_segments]
+        inside[has_segments] = points_in_polygon(segments["x1"][starts], segments["y1"][starts], gates)
+
+    tuuka = dict()
+    for user, key in enumerate(segments["keys"]):
+        start = offsets[user]
+        if start == offsets[user + 1]:
+            continue
+
+        if inside[user]:
+            tuuka[key] = segments["times"][start]
+        elif first[user] >= 0:
+            tuuka[key] = segments["times"][start + first[user]]
+    return tuuka
+
+
+# 全てのゲートの通過者をまとめて求める（データがないときは何もしない）
+def count_gates():
+    if len(st.session_state['df_new']) != 0:
+        st.session_state['tuuka_list'] = [judge_gate(gates) for gates in st.session_state['gate_data']]
+
+
+# 点の配列がポリゴンの内側にあるかをレイキャスティング法でまとめて判定
+def points_in_polygon(x, y, polygon):
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    ring = np.asarray(polygon, dtype=np.float64)
+    if len(ring) and (ring[0] != ring[-1]).any():
+        ring = np.vstack((ring, ring[:1]))
+
+    inside = np.zeros(len(x), dtype=bool)
+    if len(ring) < 4:
+        return inside
+    # 外接矩形の外にある点は判定しない
+    idx = np.flatnonzero((x >= ring[:, 0].min()) & (x <= ring[:, 0].max()) &
+                         (y >= ring[:, 1].min()) & (y <= ring[:, 1].max()))
+    px, py = x[idx], y[idx]
+    result = np.zeros(len(idx), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+        # 点から右に伸ばした半直線と辺が交差する回数の偶奇を数える
+        crosses = np.flatnonzero((y1 > py) != (y2 > py))
+        result[crosses] ^= px[crosses] < (x2 - x1) * (py[crosses] - y1) / (y2 - y1) + x1
+    inside[idx] = result
+    return inside
 
 
 # 表示する地図
@@ -789,12 +898,7 @@ try:
             st.session_state['draw_data'].append(st.session_state["data"]["all_drawings"][0])
 
             # 図形のジオJSONを削除する
-            line_layers_to_remove = []
-            for key, value in st.session_state['map']._children.items():
-                if isinstance(value, folium.features.GeoJson):
-                    line_layers_to_remove.append(key)
-            for key in line_layers_to_remove:
-                del st.session_state['map']._children[key]
+            remove_layers("gate")
 
             # st.session_state['gate_data']に追加するための加工
             gate_append_list = list()
@@ -809,40 +913,21 @@ try:
             # st.session_state['gate_data']に追加
             st.session_state['gate_data'] = gate_append_list
 
+            # データがあるときは当たり判定を行う（ゲートごとに通過人数をカウント）
+            count_gates()
+
             for idx, sdata in enumerate(st.session_state['draw_data']):
-                # データがあるときは当たり判定を行う
                 if len(st.session_state['df_new']) != 0:
-                    # 通過人数カウントの準備
-                    append_list = [dict() for _ in range(len(st.session_state['draw_data']))]
-                    st.session_state['tuuka_list'] = append_list
-
-                    # ゲートとIDの組み合わせごとにループ
-                    for idx1, gates in enumerate(st.session_state['gate_data']):
-                        for key, values in st.session_state['kiseki_data'].items():
-
-                            # ポリゴンゲートのときは初期座標をチェック
-                            if gates[0] == gates[-1]:
-                                if ingate(values[0]["座標"][0], gates):
-                                    st.session_state['tuuka_list'][idx1][key] = values[0]["日時"]
-                                    continue  # このIDのループを終了
-                                else:
-                                    pass
-
-                            kekka = cross_judge(gates, values)
-                            if kekka[0]:
-                                st.session_state['tuuka_list'][idx1][key] = values[kekka[1]]["日時"]
-                                continue  # このIDのループを終了
-
                     # 図形IDを表示するツールチップを設定
                     tooltip_html = '<div style="font-size: 16px;">gateid：{}</div>'.format(idx + 1)
                     # 通過人数を表示するポップアップを指定
                     popup_html = '<div style="font-size: 16px; font-weight: bold; width: 110px; height: 20px;  color: #27b9cc;">通過人数：{}人</div>'.format(len(st.session_state['tuuka_list'][idx]))
-                    folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html)).add_to(st.session_state['map'])
+                    add_gate_layer(sdata, tooltip_html, popup_html)
 
                 else:
                     # 図形IDを表示するツールチップを設定
                     tooltip_html = '<div style="font-size: 16px;">gateid：{}</div>'.format(idx + 1)
-                    folium.GeoJson(sdata, tooltip=tooltip_html).add_to(st.session_state['map'])
+                    add_gate_layer(sdata, tooltip_html)
 
             change_mapinfo()
 
@@ -882,32 +967,29 @@ try:
         )
     
         if len(st.session_state["select_graph_ids"]) != 0:
+            # 集計の間隔と表示する期間を選ぶ
+            st.selectbox("集計の間隔", list(BIN_WIDTHS.keys()), index=2, key="graph_bin_width")
+            start, end = graph_time_range()
+            window = st.slider("表示する期間",
+                               min_value=pd.Timestamp(start, unit="s").to_pydatetime(),
+                               max_value=pd.Timestamp(end, unit="s").to_pydatetime(),
+                               value=(pd.Timestamp(start, unit="s").to_pydatetime(), pd.Timestamp(end, unit="s").to_pydatetime()),
+                               step=timedelta(hours=1),
+                               format="MM/DD HH:mm")
+            start, end = (int(pd.Timestamp(value).timestamp()) for value in window)
+
             fig = go.Figure()
-            diff = len(st.session_state['tuuka_list']) - len(st.session_state["select_graph_ids"])
-            y_values = []  # 全折れ線のy値を保持するリストを初期化
+            max_y_value = 0  # 全折れ線のy値の最大値
             for idx in st.session_state["select_graph_ids"]:
-                # st.session_stateから選択された図形のIDに対応するグラフのJSONデータを取得
-                graph_json = st.session_state['graph_data'][idx]
-    
-                # JSONデータをPythonオブジェクトに変換
-                fig_dict = json.loads(graph_json)
-    
-                # 折れ線のy値をリストに追加
-                y_values.extend(trace['y'] for trace in fig_dict['data'])
-    
-                # PlotlyのFigureオブジェクトにトレースを追加
-                for trace in fig_dict['data']:
-                    # 凡例を変更する場合は、nameプロパティを設定する
-                    name = f"図形{idx}"
-                    fig.add_trace(go.Scatter(x=trace['x'], y=trace['y'], mode=trace['mode'], name=name))
-    
-                # PlotlyのFigureオブジェクトに戻す
-                # fig = go.Figure(fig_dict)
-    
-                # fig_list.append(fig)
-    
-            # 全折れ線のy値の最大値を取得
-            max_y_value = max(max(y) for y in y_values)
+                # 全ての図形で同じ区切りを使い、累積人数の差から区間の人数を求める
+                graph = st.session_state['graph_data'][idx]
+                bins, counts = window_counts(graph, start, end,
+                                             BIN_WIDTHS[st.session_state["graph_bin_width"]])
+                max_y_value = max(max_y_value, int(counts.max(initial=0)))
+
+                # 凡例を変更する場合は、nameプロパティを設定する
+                name = f"図形{idx}"
+                fig.add_trace(go.Scatter(x=pd.to_datetime(bins, unit="s"), y=counts, mode='lines', name=name))
     
             # 目盛りの間隔を設定
             if max_y_value > 5:
@@ -918,7 +1000,7 @@ try:
             # グラフのレイアウトを設定
             layout = go.Layout(
                 title='通過人数',
-                xaxis=dict(title='日時', dtick=6),
+                xaxis=dict(title='日時', tickformat='%m/%d %H:%M'),
                 yaxis=dict(
                     title='通過人数[人]',
                     tickvals=list(range(0, max_y_value + 1, dtick_value)) + [max_y_value],  # 目盛りの間隔を設定
@@ -951,14 +1033,17 @@ with st.sidebar:
             st.write(st.session_state['df_new'])
             # st.write(st.session_state['sorted_df'])
             if len(st.session_state['df']) != 0:
-                st.multiselect("選択してください", st.session_state['df'].iloc[:, 0].unique(), key="select_data_id",
+                st.multiselect("選択してください", st.session_state['user_summary'].index, key="select_data_id",
                                on_change=select_data)
-                # データフレームをCSVファイルに保存
-                st.session_state['sorted_df'] = st.session_state['sorted_df'].sort_values(by=st.session_state['sorted_df'].columns[1])
-                # st.session_state['sorted_df'].sort_values(by=st.session_state['sorted_df'].columns[1])
-                csv_file = st.session_state['sorted_df'].to_csv(index=False)
+                # 期間で絞り込む
+                start, end = (pd.Timestamp(value, unit="s").to_pydatetime() for value in data_time_range())
+                st.slider("期間で絞り込む", min_value=start, max_value=end, value=(start, end),
+                          step=timedelta(minutes=1), format="MM/DD HH:mm",
+                          key="select_data_window", on_change=select_data)
     
                 if len(st.session_state["select_data_id"]) != 0:
+                    # データフレームをCSVファイルに保存（sorted_dfは時刻順に並んでいる）
+                    csv_file = st.session_state['sorted_df'].to_csv(index=False)
                     # ダウンロードボタンを追加
                     st.download_button(label="Download CSV", data=csv_file, file_name='sorted.csv')
             
@@ -2,6 +2,8 @@
 import numpy as np
 import pandas as pd
 import streamlit as st
+import csv_loader
+import dtype_optimizer
 import streamlit.components.v1 as components
 import pygwalker as pyg
 from pygwalker.api.streamlit import init_streamlit_comm, get_streamlit_html
@@ -39,50 +41,22 @@ st.markdown(hide_menu_style, unsafe_allow_html=True)
 
 init_streamlit_comm()
 
-def reduce_mem_usage(df, verbose=True):
-    numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
-    start_mem = df.memory_usage().sum() / 1024**2
-    for col in df.columns:
-        col_type = df[col].dtypes
-        if col_type in numerics:
-            c_min = df[col].min()
-            c_max = df[col].max()
-            if str(col_type)[:3] == 'int':
-                if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
-                    df[col] = df[col].astype(np.int8)
-                elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
-                    df[col] = df[col].astype(np.int16)
-                elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
-                    df[col] = df[col].astype(np.int32)
-                elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
-                    df[col] = df[col].astype(np.int64)
-            else:
-                if c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max:
-                    df[col] = df[col].astype(np.float16)
-                elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max:
-                    df[col] = df[col].astype(np.float32)
-                else:
-                    df[col] = df[col].astype(np.float64)
-    end_mem = df.memory_usage().sum() / 1024**2
-    return df
-
 def upload_csv():
     # csvがアップロードされたとき
+    st.session_state["load_info"] = None
     if st.session_state['upload_csvfile'] is not None:
         # アップロードされたファイルデータを読み込む
         file_data = st.session_state['upload_csvfile'].read()
         # バイナリデータからPandas DataFrameを作成
-        try:
-            df = pd.read_csv(io.BytesIO(file_data), encoding="utf-8", engine="python")
-            st.session_state["ja_honyaku"] = False
-        except UnicodeDecodeError:
-            # UTF-8で読み取れない場合はShift-JISエンコーディングで再試行
-            df = pl.read_csv(io.BytesIO(file_data), encoding="shift-jis")
-            # df = pd.read_csv(io.BytesIO(file_data), encoding="shift-jis", engine="python")
-            st.session_state["ja_honyaku"] = True
+        # 文字コードは先頭の部分から判定する（UTF-8で読めなければShift-JIS）
+        # 表示・集計に使うだけなので、小数の列は値が少し変わってもfloat32にする
+        df, encoding, info = csv_loader.read_csv(file_data, combine=lambda chunks: dtype_optimizer.optimize_chunks(chunks, exact=False))
+        # 読み込みの情報はコールバックの中で表示すると次の再実行で消えるので、保存しておいてページで表示する
+        st.session_state["load_info"] = info
+        st.session_state["ja_honyaku"] = encoding != "utf-8"
 
-        # カラムの型を自動で適切に変換
-        st.session_state['df'] = reduce_mem_usage(df)
+        # カラムの型は読み込みながらチャンクごとに変換している
+        st.session_state['df'] = df
 
             
 st.title('Pygwalker')
@@ -92,6 +66,15 @@ st.file_uploader("CSVファイルをアップロード",
                        on_change=upload_csv
                        )
 
+# 読み込みに時間がかかったときや読み飛ばした行があるとき、列の型を変換したときはその情報を表示する
+info = st.session_state.get("load_info")
+if info is not None:
+    if info["message"] is not None:
+        st.caption(info["message"])
+    if info["report"] is not None:
+        st.caption(dtype_optimizer.report_message(info["report"]))
+        st.dataframe(info["report"])
+
 # Graphic Walker 操作（メインパネル）
 if st.session_state['upload_csvfile'] is not None:
     pyg_html = get_streamlit_html(st.session_state['df'], spec="./gw0.json", use_kernel_calc=True, debug=False)
@@ -2,12 +2,14 @@ import numpy as np
 import pandas as pd
 import streamlit as st
 import streamlit_pandas_kaoru as spk
+import csv_loader
 from datetime import datetime, timedelta
 
 import re
 import requests
 from PIL import Image
 import io
+import hashlib
 from io import BytesIO
 
 # 画像URLを指定
@@ -85,17 +87,18 @@ def decide_dtypes(df):
 
 def upload_csv():
     # csvがアップロードされたとき
+    st.session_state["load_message"] = None
     if st.session_state['upload_csvfile'] is not None:
         # アップロードされたファイルデータを読み込む
         file_data = st.session_state['upload_csvfile'].read()
+        # ウィジェットと絞り込みのキャッシュはファイルの中身が同じ間だけ使う
+        st.session_state["data_key"] = hashlib.sha256(file_data).hexdigest()
         # バイナリデータからPandas DataFrameを作成
-        try:
-            df = pd.read_csv(io.BytesIO(file_data), encoding="utf-8", engine="python")
-            st.session_state["ja_honyaku"] = False
-        except UnicodeDecodeError:
-            # UTF-8で読み取れない場合はShift-JISエンコーディングで再試行
-            df = pd.read_csv(io.BytesIO(file_data), encoding="shift-jis", engine="python")
-            st.session_state["ja_honyaku"] = True
+        # 文字コードは先頭の部分から判定する（UTF-8で読めなければShift-JIS）
+        df, encoding, info = csv_loader.read_csv(file_data)
+        # 読み込みのメッセージはコールバックの中で表示すると次の再実行で消えるので、保存しておいてページで表示する
+        st.session_state["load_message"] = info["message"]
+        st.session_state["ja_honyaku"] = encoding != "utf-8"
 
         # カラムの型を自動で適切に変換
         df = df.infer_objects()
@@ -106,20 +109,26 @@ def upload_csv():
             pass
 
         # df = df.applymap(lambda x: str(x) if not pd.isnull(x) else x)
-        st.session_state["uploaded_df"] = df.copy()
         st.session_state["all_df"] = df.copy()
         create_data = decide_dtypes(df)
         # st.session_state["all_df"] = st.session_state["all_df"].applymap(lambda x: str(x) if not pd.isnull(x) else x)
 
+        # 文字列の列はカテゴリ型にして、絞り込みを整数のコードで行う
+        text_columns = [column for column in df.columns if create_data[column] == "text"]
+        spk.categorize(df, text_columns)
+        spk.categorize(st.session_state["all_df"], text_columns)
+        st.session_state["uploaded_df"] = df.copy()
+
         st.session_state["filtered_columns"] = st.session_state["uploaded_df"].columns
 
-        st.session_state["column_data"] = decide_dtypes(df)
+        st.session_state["column_data"] = create_data
 
     else:
         st.session_state["uploaded_df"] = pd.DataFrame()
         st.session_state["all_df"] = pd.DataFrame()
         st.session_state["column_data"] = dict()
         st.session_state["filtered_columns"] = list()
+        st.session_state["data_key"] = None
 
 
 def select_column():
@@ -140,6 +149,9 @@ tab1.file_uploader("CSVファイルをアップロード",
                    key="upload_csvfile",
                    on_change=upload_csv
                    )
+# 読み込みに時間がかかったときや読み飛ばした行があるときは表示する
+if st.session_state.get("load_message") is not None:
+    tab1.caption(st.session_state["load_message"])
 
 if st.session_state["upload_csvfile"] is not None:
     tab2.multiselect(label="表示したいカラムを選択してください",
@@ -163,9 +175,9 @@ if st.session_state["upload_csvfile"] is not None:
 
 
     create_data = st.session_state["column_data"]
-    all_widgets = spk.create_widgets(df, create_data)
+    all_widgets = spk.create_widgets(df, create_data, key=st.session_state.get("data_key"))
     # st.write(create_data)
-    show_df = spk.filter_df(df, all_widgets)
+    show_df = spk.filter_df(df, all_widgets, key=st.session_state.get("data_key"))
 
     for column in show_df[st.session_state["filtered_columns"]].columns:
         if create_data[column] == "datetime":
@@ -18,9 +18,42 @@ if 'main_df' not in st.session_state:  # 初期化
 # タブ
 # tab1, tab2, tab3 = st.sidebar.tabs(["Uploader", "Select_Values", "Downloader"])
 
+def category_column(series):
+    return isinstance(series.dtype, pd.CategoricalDtype)
+
+
+def categorize(df, columns, max_ratio=0.5):
+    """
+    Convert the text columns whose distinct values are at most max_ratio of the rows
+    into pandas Categorical in place, so that the text filter works on integer codes.
+    """
+    # カテゴリ型は整数のコードと値の一覧で持つので、同じ文字列を何度も持たずに済む
+    for column in columns:
+        series = df[column]
+        if category_column(series) or not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+            continue
+        if series.nunique() <= max_ratio * len(series):
+            df[column] = series.astype("category")
+    return df
+
+
+def text_mask(series, selected_list):
+    # 選んだ値の行のマスク。カテゴリ型の列は選択肢（文字列）からコードの表を作り、コードで引く
+    if not category_column(series):
+        return series.isin(selected_list).to_numpy()
+    labels = pd.Index(series.cat.categories.astype(str))
+    selected = [value for value in selected_list if not pd.isna(value)]
+    table = np.zeros(len(labels) + 1, dtype=bool)
+    # コード-1（欠損値）は表の先頭
+    table[0] = len(selected) < len(selected_list)
+    positions = labels.get_indexer(selected)
+    table[1:][positions[positions >= 0]] = True
+    return table[series.cat.codes.to_numpy().astype(np.intp) + 1]
+
+
 def filter_string(df, column, selected_list):
     if len(selected_list) != 0:
-        res = df[df[column].isin(selected_list)]
+        res = df[text_mask(df[column], selected_list)]
     else:
         res = df.copy()
     return res
@@ -35,30 +68,26 @@ def is_integer(n):
         return float(n).is_integer()
 
 
-def number_widget(df, column, ss_name):
-    temp_df = pd.DataFrame()
-    temp_df = df.dropna(subset=[column])
-
-    if temp_df[column].apply(is_integer).sum() == len(temp_df[column]):
-        df[f'{column}_numeric'] = pd.to_numeric(df[column], errors="coerce")
-        # temp_df[f'{column}_numeric'] = temp_df[column].copy()
-        # temp_df = temp_df.astype({f'{column}_numeric': float})
-        temp_df[f'{column}_numeric'] = pd.to_numeric(temp_df[column], errors="coerce")
-        try:
-            max_value = int(max(temp_df[f'{column}_numeric'].unique()))
-            min_value = int(min(temp_df[f'{column}_numeric'].unique()))
-        except:
-            pass
-    else:
-        df[f'{column}_numeric'] = pd.to_numeric(df[column], errors="coerce")
-        # temp_df[f'{column}_numeric'] = temp_df[column].copy()
-        # temp_df = temp_df.astype({f'{column}_numeric': float})
-        temp_df[f'{column}_numeric'] = pd.to_numeric(temp_df[column], errors="coerce")
-        try:
-            max_value = float(max(temp_df[f'{column}_numeric'].unique()))
-            min_value = float(min(temp_df[f'{column}_numeric'].unique()))
-        except:
-            pass
+def number_meta(series):
+    # 数値に変換した列と、最小値・最大値・整数だけの列かどうか
+    values = pd.to_numeric(series, errors="coerce")
+    numbers = values.to_numpy(dtype=np.float64, na_value=np.nan)[series.notna().to_numpy()]
+    # 数値にできない値（NaNになる）や無限大があれば整数の列とはみなさない
+    integer = bool(np.isfinite(numbers).all() and (numbers == np.floor(numbers)).all())
+    numbers = numbers[~np.isnan(numbers)]
+    if len(numbers) == 0:
+        return {"values": values, "integer": integer, "min": None, "max": None}
+    cast = int if integer else float
+    return {"values": values, "integer": integer, "min": cast(numbers.min()), "max": cast(numbers.max())}
+
+
+def number_widget(df, column, ss_name, meta=None):
+    if meta is None:
+        meta = number_meta(df[column])
+    df[f'{column}_numeric'] = meta["values"].array
+    min_value, max_value = meta["min"], meta["max"]
+    if min_value is None:
+        return df
 
     try:
         if max_value!=min_value:
@@ -71,18 +100,28 @@ def number_widget(df, column, ss_name):
     return df
 
 
-def datetime_widget(df, column, ss_name):
-    temp_df = pd.DataFrame()
-    if df[column].isna().any():
-        temp_df = df.dropna(subset=[column])
-    else:
-        temp_df = df.copy()
-    # カラムを日付型に変換
+def datetime_meta(series):
+    # 日時に変換した列と、最初・最後の日時、隣り合う日時の最小の間隔（秒）
+    values = pd.to_datetime(series, errors="coerce")
+    valid = values.dropna()
+    if len(valid) == 0:
+        return {"values": values, "start": None, "end": None, "min_diff": None}
+    # 重複を除いて並べた日時（ナノ秒の整数）の差を一度に求める
+    stamps = np.unique(valid.to_numpy(dtype="datetime64[ns]").view(np.int64))
+    min_diff = np.diff(stamps).min() / 1e9 if len(stamps) > 1 else None
+    return {"values": values, "start": valid.min(), "end": valid.max(), "min_diff": min_diff}
 
-    df[f'{column}_datetime'] = pd.to_datetime(df[column], errors='coerce')
-    temp_df[f'{column}_datetime'] = pd.to_datetime(temp_df[column], errors="coerce")
-    start_date = df[f'{column}_datetime'].min()
-    end_date = df[f'{column}_datetime'].max()
+
+def datetime_widget(df, column, ss_name, meta=None):
+    if meta is None:
+        meta = datetime_meta(df[column])
+    # カラムを日付型に変換
+    df[f'{column}_datetime'] = meta["values"].array
+    # 日時が1種類しかなければスライダーは作らない
+    if meta["min_diff"] is None:
+        return df
+    start_date = meta["start"]
+    end_date = meta["end"]
     first_date = start_date.to_pydatetime()
     last_date = end_date.to_pydatetime()
 
@@ -133,18 +172,8 @@ def datetime_widget(df, column, ss_name):
             if unit1 == max_unit and unit2 == min_unit:
                 return unit  # 単位名の調整
 
-    # ユニークな日付を取り出す
-    unique_dates = temp_df[f'{column}_datetime'].unique()
-
-    # ユニークな日付をソート
-    unique_dates = sorted(unique_dates)
-
-    # 隣接する日付の差を計算（秒単位）
-    date_diffs_seconds = [(unique_dates[i + 1] - unique_dates[i]) / np.timedelta64(1, 's') for i in
-                          range(len(unique_dates) - 1)]
-
-    # 最小間隔を計算（秒単位）
-    min_date_diff = min(date_diffs_seconds)
+    # 最小間隔（秒単位）
+    min_date_diff = meta["min_diff"]
 
     # 最初と最後の日付の差を計算（秒単位）
     max_date_diff = (end_date - start_date) / np.timedelta64(1, 's')
@@ -218,18 +247,26 @@ def datetime_widget(df, column, ss_name):
     return df
 
 
-def text_widget(df, column, ss_name):
-    temp_df = df.dropna(subset=[column])
-    temp_df = temp_df.astype(str)
-    
-    # 欠損値を除外してソート
-    options = sorted(temp_df[column].unique().tolist())
-
-    # None（欠損値）をリストの最初に追加
-    if df[column].isna().any():
+def text_meta(series):
+    # 選択肢（文字列にした値を並べたもの。欠損値があれば先頭にNaN）
+    # 文字列への変換は重複を除いた値だけに行う。カテゴリ型の列は使われているカテゴリから作る
+    if category_column(series):
+        codes = series.cat.codes.to_numpy()
+        used = np.bincount(codes[codes >= 0], minlength=len(series.cat.categories)) > 0
+        values = series.cat.categories[used].astype(str).to_numpy(dtype=object)
+    else:
+        values = series.dropna().drop_duplicates().astype(str).to_numpy(dtype=object)
+    options = np.unique(values).tolist()
+    if series.isna().any():
         options.insert(0, np.nan)
+    return {"options": options}
+
+
+def text_widget(df, column, ss_name, meta=None):
+    if meta is None:
+        meta = text_meta(df[column])
+    options = meta["options"]
 
-       
     temp_input = st.sidebar.multiselect(f"{column.title()}", options=options, default=list(),  key=ss_name)
     all_widgets.append((ss_name, "text", column))
     # temp_df = df.dropna(subset=[column])
@@ -249,24 +286,87 @@ def text_widget(df, column, ss_name):
     # all_widgets.append((ss_name, "text", column))
 
 
-def create_widgets(df, create_data={}):
+def data_cache(key, length):
+    # 同じデータ（keyと行数が同じ）の間は、ウィジェットの選択肢・列の統計・ウィジェットごとのマスクを使い回す
+    # keyがなければその回だけの入れ物を返す
+    if key is None:
+        return {"meta": dict(), "stats": dict(), "masks": dict()}
+    cache = st.session_state.get("spk_cache")
+    if cache is None or cache["key"] != (key, length):
+        cache = {"key": (key, length), "meta": dict(), "stats": dict(), "masks": dict()}
+        st.session_state["spk_cache"] = cache
+    return cache
+
+
+def column_meta(cache, df, column, kind):
+    # 列の型が変わったとき（日付型に変換されたときなど）は作り直す
+    meta_key = (column, kind, str(df[column].dtype))
+    if meta_key not in cache["meta"]:
+        make_meta = {"text": text_meta, "number": number_meta, "datetime": datetime_meta}[kind]
+        cache["meta"][meta_key] = make_meta(df[column])
+    return cache["meta"][meta_key]
+
+
+def create_widgets(df, create_data={}, key=None):
+    """
+    key => an id of the data (e.g. a hash of the uploaded file). When given, the options
+           and ranges of the widgets are computed once and kept in st.session_state.
+    """
     global all_widgets
     all_widgets = []
+    cache = data_cache(key, len(df))
     for ctype, column in zip(df.dtypes, df.columns):
         if column in create_data:
+            text_widget(df, column, column.lower(), column_meta(cache, df, column, "text"))
             if create_data[column] == "number":
-
-                text_widget(df, column, column.lower())
-                number_widget(df, column, column.lower())
+                number_widget(df, column, column.lower(), column_meta(cache, df, column, "number"))
             elif create_data[column] == "datetime":
-                text_widget(df, column, column.lower())
-                datetime_widget(df, column, column.lower())
-            elif create_data[column] == "text":
-                text_widget(df, column, column.lower())
+                datetime_widget(df, column, column.lower(), column_meta(cache, df, column, "datetime"))
     return all_widgets
 
 
-def filter_df(df, all_widgets):
+def datetime_value(value):
+    # 日時をナノ秒の整数にする（タイムゾーン付きはUTCにそろえる）
+    return pd.Timestamp(value).value
+
+
+def column_stats(df, column, ctype):
+    # 列を比較用のnumpy配列にして、欠損でない値の最小値・最大値と一緒に返す
+    if ctype == "datetime":
+        series = pd.to_datetime(df[column], errors="coerce")
+        valid = series.notna().to_numpy()
+        if series.dt.tz is not None:
+            series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+        values = series.to_numpy(dtype="datetime64[ns]").view(np.int64)
+    else:
+        values = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = ~np.isnan(values)
+    if not valid.any():
+        return {"values": values, "min": None, "max": None}
+    return {"values": values, "min": values[valid].min(), "max": values[valid].max()}
+
+
+def widget_mask(df, stats, ctype, column, data):
+    # ウィジェットの値で残す行のマスクを作る。絞り込まない設定ならNone
+    if ctype == "text":
+        if len(data) == 0:
+            return None
+        return text_mask(df[column], data)
+
+    min_value, max_value = data
+    if ctype == "datetime":
+        min_value, max_value = datetime_value(min_value), datetime_value(max_value)
+    if stats["min"] is None or (min_value == stats["min"] and max_value == stats["max"]):
+        return None
+    # 欠損値（NaN・NaT）は範囲の比較でFalseになる
+    values = stats["values"]
+    mask = (values >= min_value) & (values <= max_value)
+    if ctype == "datetime":
+        mask &= values != pd.NaT.value
+    return mask
+
+
+def filter_df(df, all_widgets, key=None):
     """
     This function will take the input dataframe and all the widgets generated from
     Streamlit Pandas. It will then return a filtered DataFrame based on the changes
@@ -274,30 +374,31 @@ def filter_df(df, all_widgets):
 
     df => the original Pandas DataFrame
     all_widgets => the widgets created by the function create_widgets().
+    key => an id of the data (e.g. a hash of the uploaded file). When given, the column
+           statistics and the mask of each widget are kept in st.session_state, and only
+           the masks of the widgets whose values changed are recomputed on a rerun.
     """
-    res = df.copy()
+    cache = data_cache(key, len(df))
+    masks = []
 
     for widget in all_widgets:
         ss_name, ctype, column = widget
         data = st.session_state[ss_name]
-        if ctype == "number":
-            min_value, max_value = data
-            temp_df = df.dropna(subset=[column])
-            if (float(max(temp_df[column].unique())) == max_value) & (float(min(temp_df[column].unique())) == min_value):
-                pass
-            else:
-                res = res.loc[(res[column] >= min_value) & (res[column] <= max_value)]
-            # res[column] = res[column].astype('object')
-        elif ctype == "datetime":
-            min_value, max_value = data
-            temp_df = df.dropna(subset=[column])
-            first_date = temp_df[column].min().to_pydatetime()
-            last_date = temp_df[column].max().to_pydatetime()
-            if (last_date == max_value) & (first_date == min_value):
-                pass
-            else:
-                res = res.loc[(res[column] >= min_value) & (res[column] <= max_value)]
-            # res[column] = res[column].astype('object')
-        elif ctype == "text":
-            res = filter_string(res, column, data)
-    return res
+        signature = (column, str(df[column].dtype), tuple(data))
+        cached = cache["masks"].get(ss_name)
+        if cached is None or cached[0] != signature:
+            stats = None
+            if ctype in ("number", "datetime"):
+                stats_key = (column, ctype)
+                if stats_key not in cache["stats"]:
+                    cache["stats"][stats_key] = column_stats(df, column, ctype)
+                stats = cache["stats"][stats_key]
+            cached = (signature, widget_mask(df, stats, ctype, column, data))
+            cache["masks"][ss_name] = cached
+        if cached[1] is not None:
+            masks.append(cached[1])
+
+    # 全ウィジェットのマスクをまとめて1回だけ行を取り出す
+    if len(masks) == 0:
+        return df
+    return df[np.logical_and.reduce(masks)]
@@ -0,0 +1,126 @@
+import io
+import time
+import codecs
+import logging
+
+import pandas as pd
+
+# 文字コードの判定に使う先頭のバイト数
+SNIFF_BYTES = 64 * 1024
+# この行数以上のファイルは、読み込みにかかった時間と行数を表示する
+REPORT_ROWS = 100000
+# チャンクごとに読むときの1チャンクの行数
+CHUNK_ROWS = 100000
+# 試す文字コード（先頭を読めたものから試す）
+ENCODINGS = ("utf-8", "shift-jis")
+
+logger = logging.getLogger(__name__)
+
+
+def sniff_encoding(file_data, encodings=ENCODINGS, sniff_bytes=SNIFF_BYTES):
+    # 先頭だけをデコードしてみて、最初に読めた文字コードを返す
+    # 途中で切れたマルチバイト文字はエラーにならないよう、incrementalなデコーダーを使う
+    prefix = file_data[:sniff_bytes]
+    final = len(prefix) == len(file_data)
+    for encoding in encodings:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(prefix, final=final)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    return encodings[0]
+
+
+def settled_dtype(dtypes):
+    # チャンクごとに推定された型から列の型を決める（整数と小数ならfloat64、それ以外が混ざれば文字列）
+    if all(pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype) for dtype in dtypes):
+        return "float64"
+    return str
+
+
+def chunk_dtypes(file_data, encoding, engine, **kwargs):
+    # 1回目はチャンクごとに推定された型だけを集め、チャンクによって型が違う列の型を決める
+    # 1チャンクに収まるファイルは読み直さないように、そのチャンクも返す（2チャンク以上ならNone）
+    seen, first, n_chunks = dict(), None, 0
+    with pd.read_csv(io.BytesIO(file_data), encoding=encoding, engine=engine, chunksize=CHUNK_ROWS, **kwargs) as reader:
+        for chunk in reader:
+            first = chunk if n_chunks == 0 else None
+            n_chunks += 1
+            for name, dtype in chunk.dtypes.items():
+                seen.setdefault(name, set()).add(dtype)
+    dtypes = {name: settled_dtype(kinds) for name, kinds in seen.items() if len(kinds) > 1}
+    return dtypes, first if n_chunks == 1 else None, n_chunks
+
+
+def parse_csv(file_data, encoding, engine, combine=None, **kwargs):
+    # combineがあれば、CHUNK_ROWS行ずつ読んだチャンクのイテレータをcombineに渡してまとめる
+    # Cエンジンは内部で区切って型を推定すると、同じ列に数値と文字列が混ざるので区切らない
+    if engine == "c":
+        kwargs.setdefault("low_memory", False)
+    if combine is None:
+        return pd.read_csv(io.BytesIO(file_data), encoding=encoding, engine=engine, **kwargs)
+
+    # チャンクごとに型を推定すると同じ列に数値と文字列が混ざるので、先に全体で列の型を決めてから読む
+    dtypes, first, n_chunks = chunk_dtypes(file_data, encoding, engine, **kwargs)
+    if n_chunks <= 1:
+        return combine(iter([] if first is None else [first]))
+    if callable(kwargs.get("on_bad_lines")):
+        # 読み飛ばした行は1回目で数えている
+        kwargs["on_bad_lines"] = "skip"
+    if isinstance(kwargs.get("dtype"), dict):
+        dtypes.update(kwargs["dtype"])
+    if dtypes:
+        kwargs["dtype"] = dtypes
+    with pd.read_csv(io.BytesIO(file_data), encoding=encoding, engine=engine, chunksize=CHUNK_ROWS, **kwargs) as reader:
+        return combine(reader)
+
+
+def parse_csv_fallback(file_data, encoding, **kwargs):
+    # Cエンジンで読み、Cエンジンが読めない行があるときだけpythonエンジンで読み直す
+    # pythonエンジンでも読めない行（列の数が多すぎる行など）は飛ばし、飛ばした行を返す
+    try:
+        return parse_csv(file_data, encoding, "c", **kwargs), "c", []
+    except pd.errors.ParserError:
+        skipped = []
+        kwargs.setdefault("on_bad_lines", lambda line: skipped.append(line))
+        return parse_csv(file_data, encoding, "python", **kwargs), "python", skipped
+
+
+def read_csv(file_data, encodings=ENCODINGS, combine=None, **kwargs):
+    """
+    Read an uploaded CSV (bytes) into a DataFrame and return (df, encoding, info).
+    The encoding is sniffed from the first bytes, and the other encodings are tried
+    only when the whole file cannot be decoded with it.
+    combine => a function that takes an iterator of chunks and returns (DataFrame, report)
+               (e.g. dtype_optimizer.optimize_chunks). When given, the file is read in
+               chunks of CHUNK_ROWS rows.
+    info => a dict of the seconds taken, the engine, the number of skipped lines, a
+            message for the page to show (None when there is nothing to report) and
+            the report returned by combine (None without combine).
+    """
+    start = time.perf_counter()
+    first = sniff_encoding(file_data, encodings)
+    error = None
+    for encoding in [first] + [encoding for encoding in encodings if encoding != first]:
+        try:
+            df, engine, skipped = parse_csv_fallback(file_data, encoding, combine=combine, **kwargs)
+            break
+        except UnicodeDecodeError as decode_error:
+            error = decode_error
+    else:
+        raise error
+    report = None
+    if combine is not None:
+        df, report = df
+
+    seconds = time.perf_counter() - start
+    messages = []
+    if len(df) >= REPORT_ROWS:
+        messages.append(f"{len(df):,}行 × {len(df.columns)}列を{seconds:.2f}秒で読み込みました（{encoding}、{engine}エンジン）")
+    if len(skipped) != 0:
+        messages.append(f"列の数が合わない{len(skipped):,}行を読み飛ばしました")
+    message = " ".join(messages) if messages else None
+    if message is not None:
+        logger.info(message)
+    return df, encoding, {"seconds": seconds, "engine": engine, "skipped": len(skipped), "message": message,
+                            "report": report}
@@ -17,6 +17,7 @@ from scipy import stats
 from scipy.stats import kruskal, shapiro
 import scikit_posthocs as sp
 import streamlit as st
+import csv_loader
 
 
 # Streamlit ページの設定
@@ -58,15 +59,14 @@ def display_summary(df, categories, grades):
 
 def upload_csv():
     # csvがアップロードされたとき
+    st.session_state["load_message"] = None
     if st.session_state['upload_csvfile'] is not None:
         # アップロードされたファイルデータを読み込む
         file_data = st.session_state['upload_csvfile'].read()
-        try:
-            # Shift-JISで読み込みを試みる
-            df = pd.read_csv(io.BytesIO(file_data), encoding="shift-jis", engine="python")
-        except UnicodeDecodeError:
-            # Shift-JISで失敗したらUTF-8で再試行
-            df = pd.read_csv(io.BytesIO(file_data), encoding="utf-8", engine="python") 
+        # 文字コードは先頭の部分から判定する（Shift-JISで読めなければUTF-8）
+        df, encoding, info = csv_loader.read_csv(file_data, encodings=("shift-jis", "utf-8"))
+        # 読み込みのメッセージはコールバックの中で表示すると次の再実行で消えるので、保存しておいてページで表示する
+        st.session_state["load_message"] = info["message"]
                 
 
         # 各カテゴリごとに平均を算出
@@ -82,15 +82,14 @@ def upload_csv():
 
 def upload_csv2():
     # csvがアップロードされたとき
+    st.session_state["load_message2"] = None
     if st.session_state['upload_csvfile2'] is not None:
         # アップロードされたファイルデータを読み込む
         file_data = st.session_state['upload_csvfile2'].read()
-        try:
-            # Shift-JISで読み込みを試みる
-            df = pd.read_csv(io.BytesIO(file_data), encoding="shift-jis", engine="python")
-        except UnicodeDecodeError:
-            # Shift-JISで失敗したらUTF-8で再試行
-            df = pd.read_csv(io.BytesIO(file_data), encoding="utf-8", engine="python") 
+        # 文字コードは先頭の部分から判定する（Shift-JISで読めなければUTF-8）
+        df, encoding, info = csv_loader.read_csv(file_data, encodings=("shift-jis", "utf-8"))
+        # 読み込みのメッセージはコールバックの中で表示すると次の再実行で消えるので、保存しておいてページで表示する
+        st.session_state["load_message2"] = info["message"]
 
         st.session_state['question_df'] = df
     else:
@@ -301,6 +300,9 @@ st.file_uploader("集計結果（5件法）のcsvをアップロード",
                        key="upload_csvfile",
                        on_change=upload_csv
                        )
+# 読み込みに時間がかかったときや読み飛ばした行があるときは表示する
+if st.session_state.get("load_message") is not None:
+    st.caption(st.session_state["load_message"])
 
 # 設問文のファイルアップロード
 st.file_uploader("設問文のcsvをアップロード",
@@ -308,6 +310,9 @@ st.file_uploader("設問文のcsvをアップロード",
                        key="upload_csvfile2",
                        on_change=upload_csv2
                        )
+# 読み込みに時間がかかったときや読み飛ばした行があるときは表示する
+if st.session_state.get("load_message2") is not None:
+    st.caption(st.session_state["load_message2"])
 
 # データフレームを空にするボタン
 # csvがアップロードされたとき
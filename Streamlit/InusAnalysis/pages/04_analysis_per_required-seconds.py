@@ -14,6 +14,7 @@ from scipy import stats
 from scipy.stats import kruskal, shapiro
 import scikit_posthocs as sp
 import streamlit as st
+import csv_loader
 
 
 # Streamlit ページの設定
@@ -55,10 +56,13 @@ def display_summary(df, categories, grades):
 
 def upload_csv():
     # csvがアップロードされたとき
+    st.session_state["load_message"] = None
     if st.session_state['upload_csvfile'] is not None:
         # アップロードされたファイルデータを読み込む
         file_data = st.session_state['upload_csvfile'].read()
-        df = pd.read_csv(io.BytesIO(file_data), encoding="shift-jis", engine="python")  
+        df, encoding, info = csv_loader.read_csv(file_data, encodings=("shift-jis",))
+        # 読み込みのメッセージはコールバックの中で表示すると次の再実行で消えるので、保存しておいてページで表示する
+        st.session_state["load_message"] = info["message"]
 
         # 各カテゴリごとに平均を算出
         df['オンライン・コラボレーション力'] = df[df.columns[6:21]].mean(axis=1)  # オンライン・コラボレーション力
@@ -206,6 +210,9 @@ st.file_uploader("集計結果（5件法）のcsvをアップロード",
                        key="upload_csvfile",
                        on_change=upload_csv
                        )
+# 読み込みに時間がかかったときや読み飛ばした行があるときは表示する
+if st.session_state.get("load_message") is not None:
+    st.caption(st.session_state["load_message"])
 
 # データフレームを空にするボタン
 # csvがアップロードされたとき
@@ -0,0 +1,48 @@
+"""CIST-FASSのゲート通過判定をブラウザなしで実行する
+
+CSVファイル（複数可）にゲートのGeoJSONを当てはめ、ファイルごとの通過のCSVと
+全ファイルの通過人数の表（summary.csv）を出力先のフォルダに書き出す。
+
+    python batch.py data/*.csv --gates gates.geojson --out result
+    python batch.py data/*.csv --gates gates.geojson --out result --bin-width 15分 --workers 4
+    python batch.py data/*.csv --gates gates.geojson --out result --clean --cache
+
+前処理（--clean）と読み込みのキャッシュ（--cache）は指定したときだけ使う（既定は --no-clean --no-cache）。
+"""
+import argparse
+import glob
+import os
+import sys
+
+from utils.analysis_manager import BIN_WIDTHS
+from utils.batch_manager import BatchManager, load_gate_file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CIST-FASSのゲート通過判定のバッチ処理")
+    parser.add_argument("csv", nargs="+", help="GPSデータのCSVファイル（ワイルドカード可）")
+    parser.add_argument("--gates", required=True, help="ゲートのGeoJSONファイル（LineStringまたはPolygon）")
+    parser.add_argument("--out", required=True, help="結果を書き出すフォルダ")
+    parser.add_argument("--bin-width", choices=list(BIN_WIDTHS.keys()), help="通過人数の時系列を集計する間隔")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="ファイルを並列に処理するプロセス数")
+    parser.add_argument("--clean", action=argparse.BooleanOptionalAction, default=False,
+                        help="判定の前にGPSデータの前処理をする（既定は --no-clean で元のデータのまま）")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=False,
+                        help="読み込んだ配列をキャッシュに保存・再利用する（既定は --no-cache で使わない）")
+    args = parser.parse_args(argv)
+
+    paths = sorted({path for pattern in args.csv for path in (glob.glob(pattern) or [pattern])})
+    gate_list = load_gate_file(args.gates)
+    if len(gate_list) == 0:
+        print("ゲートがありません", file=sys.stderr)
+        return 1
+
+    batch_manager = BatchManager(gate_list, bin_seconds=BIN_WIDTHS.get(args.bin_width), workers=args.workers,
+                                 clean=args.clean, cache=args.cache)
+    summary = batch_manager.run(paths, args.out)
+    print(summary.to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
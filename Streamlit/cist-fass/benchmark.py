@@ -0,0 +1,194 @@
+"""CIST-FASSの解析処理のベンチマーク
+
+合成したGPS軌跡で、読み込み・線分の作成・ゲートの判定・滞在区間・グラフの集計の
+処理時間とピークメモリを測る。Streamlitのサーバーを起動せずに実行できる。
+
+    python benchmark.py --users 2000 --points 500 --gates 8
+    python benchmark.py --json result.json
+    python benchmark.py --baseline result.json --tolerance 1.5
+"""
+import argparse
+import io
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from utils.analysis_manager import AnalysisManager, BIN_WIDTHS, window_counts
+from utils.data_manager import DataManager, DATETIME_FORMAT
+
+# 地図の初期表示位置を軌跡の中心にする
+CENTER_LAT = 42.79355312
+CENTER_LON = 141.695872412
+# 緯度1度あたりのおおよその距離（メートル）
+METERS_PER_DEGREE = 111000
+# 点の間隔（秒）。読み込むCSVの時刻は分単位
+POINT_SECONDS = 60
+START_TIME = "2018-09-05"
+
+STAGES = ("load", "segments", "gates", "zones", "histogram")
+
+
+def generate_csv(users, points, spread, seed=0):
+    # ユーザーごとに範囲内のランダムな位置と時刻から始まるランダムウォークを作る
+    rng = np.random.default_rng(seed)
+    spread_lat = spread / METERS_PER_DEGREE
+    spread_lon = spread_lat / np.cos(np.radians(CENTER_LAT))
+
+    start_lat = CENTER_LAT + (rng.random(users) - 0.5) * spread_lat
+    start_lon = CENTER_LON + (rng.random(users) - 0.5) * spread_lon
+    steps = rng.normal(0, 1 / 50, (2, users, points))
+    steps[:, :, 0] = 0
+    lat = start_lat[:, None] + np.cumsum(steps[0], axis=1) * spread_lat
+    lon = start_lon[:, None] + np.cumsum(steps[1], axis=1) * spread_lon
+
+    start = pd.Timestamp(START_TIME).value // 10 ** 9 + rng.integers(0, 86400 // POINT_SECONDS, users) * POINT_SECONDS
+    times = start[:, None] + np.arange(points) * POINT_SECONDS
+
+    # 実際のデータと同じように、全ユーザーの点を時刻順に並べる
+    order = np.argsort(times.ravel(), kind="stable")
+    df = pd.DataFrame({
+        "userid": np.repeat(np.char.add("U", np.arange(users).astype(str)), points)[order],
+        "datetime": pd.to_datetime(times.ravel()[order], unit="s").strftime(DATETIME_FORMAT),
+        "latitude": lat.ravel()[order],
+        "longitude": lon.ravel()[order]
+    })
+    return df.to_csv(index=False).encode()
+
+
+def generate_gates(count, spread, seed=0):
+    # 3つに1つはポリゴン、それ以外はラインのゲートにする（座標は[経度, 緯度]）
+    rng = np.random.default_rng(seed + 1)
+    spread_lat = spread / METERS_PER_DEGREE
+    spread_lon = spread_lat / np.cos(np.radians(CENTER_LAT))
+    gates = []
+    for idx in range(count):
+        lon = CENTER_LON + (rng.random() - 0.5) * spread_lon
+        lat = CENTER_LAT + (rng.random() - 0.5) * spread_lat
+        size_lon, size_lat = spread_lon / 10, spread_lat / 10
+        if idx % 3 == 2:
+            gates.append([[lon, lat], [lon + size_lon, lat], [lon + size_lon, lat + size_lat],
+                          [lon, lat + size_lat], [lon, lat]])
+        else:
+            angle = rng.random() * np.pi
+            gates.append([[lon - size_lon * np.cos(angle), lat - size_lat * np.sin(angle)],
+                          [lon + size_lon * np.cos(angle), lat + size_lat * np.sin(angle)]])
+    return gates
+
+
+def run_once(csv_data, gates, parallel, cache=False):
+    # 読み込みから集計までの段階を、順に呼び出す関数として返す（時間とメモリの計測で共通に使う）
+    data_manager = DataManager()
+    data_manager.parallel_manager.enabled = parallel
+    # 2回目以降の読み込みが保存済みのデータを使わないように、既定では保存しない
+    data_manager.cache_manager.enabled = cache
+    analysis_manager = AnalysisManager()
+    results = dict()
+
+    def load():
+        data_manager.load_data(io.BytesIO(csv_data))
+
+    def segments():
+        data_manager.make_line_features(True)
+
+    def judge():
+        results["tuuka_list"] = data_manager.cross_manager.judge_all(gates, data_manager.parallel_manager)
+
+    def zones():
+        for polygon in [gate for gate in gates if gate[0] == gate[-1]]:
+            data_manager.zone_manager.intervals(polygon)
+
+    def histogram():
+        tuuka_list = results["tuuka_list"]
+        selected_ids = [str(idx + 1) for idx in range(len(tuuka_list)) if len(tuuka_list[idx]) > 0]
+        analysis_manager.select_graph(selected_ids, tuuka_list)
+        for idx in selected_ids:
+            data = analysis_manager.graph_data[idx]
+            start, end = analysis_manager.time_range([idx])
+            for bin_seconds in BIN_WIDTHS.values():
+                window_counts(data, start, end, bin_seconds)
+
+    return data_manager, dict(zip(STAGES, (load, segments, judge, zones, histogram)))
+
+
+def measure(csv_data, gates, repeat, parallel, cache=False):
+    timings = {stage: [] for stage in STAGES}
+    for _ in range(repeat):
+        data_manager, stages = run_once(csv_data, gates, parallel, cache)
+        for stage, func in stages.items():
+            start = time.perf_counter()
+            func()
+            timings[stage].append(time.perf_counter() - start)
+        data_manager.parallel_manager.close()
+
+    # tracemallocは処理を遅くするので、ピークメモリは別の1回で測る
+    peaks = dict()
+    data_manager, stages = run_once(csv_data, gates, parallel, cache)
+    tracemalloc.start()
+    for stage, func in stages.items():
+        tracemalloc.reset_peak()
+        func()
+        peaks[stage] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rows = len(data_manager.trajectories.lon)
+    data_manager.parallel_manager.close()
+
+    return rows, {stage: {"median": statistics.median(timings[stage]), "min": min(timings[stage]),
+                          "peak_mb": peaks[stage] / 2 ** 20} for stage in STAGES}
+
+
+def compare(results, baseline, tolerance):
+    # 基準の結果より中央値がtolerance倍を超えて遅くなった段階を返す
+    regressions = []
+    for stage, result in results.items():
+        if stage in baseline and result["median"] > baseline[stage]["median"] * tolerance:
+            regressions.append((stage, baseline[stage]["median"], result["median"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CIST-FASSの解析処理のベンチマーク")
+    parser.add_argument("--users", type=int, default=1000, help="ユーザー数")
+    parser.add_argument("--points", type=int, default=200, help="ユーザーあたりの点数")
+    parser.add_argument("--gates", type=int, default=6, help="ゲートの数（3つに1つはポリゴン）")
+    parser.add_argument("--spread", type=float, default=2000, help="軌跡を生成する範囲の一辺（メートル）")
+    parser.add_argument("--repeat", type=int, default=3, help="処理時間を測る回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--parallel", action="store_true", help="ゲートの判定を複数のプロセスで行う")
+    parser.add_argument("--cache", action="store_true", help="読み込んだデータの保存と再利用を有効にする")
+    parser.add_argument("--json", help="結果を保存するJSONファイル")
+    parser.add_argument("--baseline", help="比較する基準の結果（--jsonで保存したファイル）")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="基準より何倍遅くなったら失敗にするか")
+    args = parser.parse_args(argv)
+
+    csv_data = generate_csv(args.users, args.points, args.spread, args.seed)
+    gates = generate_gates(args.gates, args.spread, args.seed)
+    rows, results = measure(csv_data, gates, args.repeat, args.parallel, args.cache)
+
+    print(f"users={args.users} points={args.points} rows={rows} gates={args.gates} "
+          f"csv={len(csv_data) / 2 ** 20:.1f}MB repeat={args.repeat}")
+    print(f"{'stage':<10} {'median[s]':>10} {'min[s]':>10} {'peak[MB]':>10}")
+    for stage, result in results.items():
+        print(f"{stage:<10} {result['median']:>10.4f} {result['min']:>10.4f} {result['peak_mb']:>10.1f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"params": {key: value for key, value in vars(args).items() if key not in ("json", "baseline")},
+                       "rows": rows, "results": results}, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for stage, before, after in regressions:
+            print(f"regression: {stage} {before:.4f}s -> {after:.4f}s", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
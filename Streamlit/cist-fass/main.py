@@ -1,14 +1,23 @@
 import streamlit as st
 from streamlit_folium import st_folium
-from folium.plugins import Draw, TimestampedGeoJson
+from folium.plugins import Draw
 import os
+import time
 from PIL import Image
 from utils.data_manager import DataManager
+from utils.dataset_registry import DatasetRegistry
 from utils.map_manager import MapManager
 from utils.shape_manager import ShapeManager
-from utils.analysis_manager import AnalysisManager
+from utils.analysis_manager import AnalysisManager, BIN_WIDTHS
+from utils.od_manager import OdManager
+from utils.trajectory_store import TrajectoryStore
+from utils.playback_manager import FRAME_SECONDS
+from utils.stay_manager import STAY_DISTANCE, STAY_SECONDS
 import pandas as pd
 
+# 自動再生で次のフレームに進むまでの間隔（秒）
+PLAYBACK_INTERVAL = 1.0
+
 # 画像ファイルのパス
 image_path = os.path.join(os.path.dirname(__file__), 'icon_image.png')
 
@@ -30,116 +39,124 @@ hide_menu_style = """
 """
 st.markdown(hide_menu_style, unsafe_allow_html=True)
 
-data_manager = DataManager()
-map_manager = MapManager()
-shape_manager = ShapeManager(map_manager)
-analysis_manager = AnalysisManager()
+@st.cache_resource
+def dataset_registry():
+    # 同じCSVを開いたセッションの間で、読み込んだデータを1つだけ持つ
+    return DatasetRegistry()
+
+# ゲートの判定結果や地図のレイヤーを再実行後も使い回すためにセッションに保持する
+if "managers" not in st.session_state:
+    data_manager = DataManager(dataset_registry())
+    map_manager = MapManager()
+    st.session_state["managers"] = (data_manager, map_manager, ShapeManager(map_manager), AnalysisManager(), OdManager())
+
+data_manager, map_manager, shape_manager, analysis_manager, od_manager = st.session_state["managers"]
 
 # csvのuploaderの状態が変化したときに呼ばれるcallback関数
 def upload_csv():
     if st.session_state["upload_csvfile"] is not None:
-        file_data = st.session_state["upload_csvfile"].read()
-        data_manager.load_data(file_data)
-        map_manager.add_timestamped_geojson(data_manager)
+        progress_bar = st.progress(0.0, text="CSVファイルを読み込み中")
+        data_manager.load_data(st.session_state["upload_csvfile"],
+                               progress=lambda rate: progress_bar.progress(rate, text="CSVファイルを読み込み中"))
+        progress_bar.empty()
         data_manager.make_line_features(True)
+        map_manager.playback_frame = 0
+        map_manager.add_points_layer(data_manager)
+        map_manager.add_shape_data(data_manager)
+        stay_draw()
     else:
-        data_manager.df = pd.DataFrame()
-        data_manager.df_new = pd.DataFrame()
-        data_manager.sorted_df = pd.DataFrame()
-        data_manager.kiseki_data = dict()
+        data_manager.clear_data()
         analysis_manager.graph_data = dict()
 
-        layers_to_remove = []
-        for key, value in map_manager.map._children.items():
-            if isinstance(value, TimestampedGeoJson):
-                layers_to_remove.append(key)
-        for key in layers_to_remove:
-            del map_manager.map._children[key]
+        map_manager.remove_points_layers()
 
-        line_layers_to_remove = []
-        for key, value in map_manager.map._children.items():
-            if isinstance(value, folium.features.GeoJson):
-                line_layers_to_remove.append(key)
-        for key in line_layers_to_remove:
-            del map_manager.map._children[key]
+        data_manager.make_line_features(True)
+        map_manager.add_shape_data(data_manager)
 
-        if len(map_manager.draw_data) != 0:
-            for idx, sdata in enumerate(map_manager.draw_data):
-                if len(data_manager.df_new) != 0:
-                    append_list = [dict() for _ in range(len(map_manager.draw_data))]
-                    map_manager.tuuka_list = append_list
-
-                    for idx1, gates in enumerate(map_manager.gate_data):
-                        for key, values in data_manager.kiseki_data.items():
-                            if gates[0] == gates[-1]:
-                                if map_manager.ingate(values[0]["座標"][0], gates):
-                                    map_manager.tuuka_list[idx1][key] = values[0]["日時"]
-                                    continue
-                            kekka = map_manager.cross_judge(gates, values)
-                            if kekka[0]:
-                                map_manager.tuuka_list[idx1][key] = values[kekka[1]]["日時"]
-                                continue
-
-                    tooltip_html = f'<div style="font-size: 16px;">gateid：{idx + 1}</div>'
-                    popup_html = f'<div style="font-size: 16px; font-weight: bold; width: 110px; height: 20px;  color: #27b9cc;">通過人数：{len(map_manager.tuuka_list[idx])}人</div>'
-                    folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html)).add_to(map_manager.map)
-
-                else:
-                    tooltip_html = f'<div style="font-size: 16px;">gateid：{idx + 1}</div>'
-                    folium.GeoJson(sdata, tooltip=tooltip_html).add_to(map_manager.map)
-
-        line_layers_to_remove = []
-        for key, value in map_manager.map._children.items():
-            if isinstance(value, folium.vector_layers.PolyLine):
-                line_layers_to_remove.append(key)
-        for key in line_layers_to_remove:
-            del map_manager.map._children[key]
+        map_manager.remove_kiseki_layers()
+        stay_draw()
 
 def select_data():
     selected_values = st.session_state["select_data_id"]
-    data_manager.select_data(selected_values)
-    map_manager.add_timestamped_geojson(data_manager)
-    map_manager.polylines_maker(data_manager)
+    # 期間が全体のままのときは期間で絞り込まない
+    window = tuple(int(pd.Timestamp(value).timestamp()) for value in st.session_state["select_data_window"])
+    if window == data_time_range():
+        window = None
+    data_manager.select_data(selected_values, window)
+    map_manager.add_points_layer(data_manager)
     data_manager.make_line_features(False)
 
     if map_manager.kiseki_flag:
         map_manager.polylines_maker(data_manager)
 
-    for idx, sdata in enumerate(map_manager.draw_data):
-        if len(data_manager.df_new) != 0:
-            append_list = [dict() for _ in range(len(map_manager.draw_data))]
-            map_manager.tuuka_list = append_list
-
-            for idx1, gates in enumerate(map_manager.gate_data):
-                for key, values in data_manager.kiseki_data.items():
-                    if gates[0] == gates[-1]:
-                        if map_manager.ingate(values[0]["座標"][0], gates):
-                            map_manager.tuuka_list[idx1][key] = values[0]["日時"]
-                            continue
-                    kekka = map_manager.cross_judge(gates, values)
-                    if kekka[0]:
-                        map_manager.tuuka_list[idx1][key] = values[kekka[1]]["日時"]
-                        continue
-
-            tooltip_html = f'<div style="font-size: 16px;">gateid：{idx + 1}</div>'
-            popup_html = f'<div style="font-size: 16px; font-weight: bold; width: 110px; height: 20px;  color: #27b9cc;">通過人数：{len(map_manager.tuuka_list[idx])}人</div>'
-            folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html)).add_to(map_manager.map)
-
-        else:
-            tooltip_html = f'<div style="font-size: 16px;">gateid：{idx + 1}</div>'
-            folium.GeoJson(sdata, tooltip=tooltip_html).add_to(map_manager.map)
+    map_manager.add_shape_data(data_manager)
+    stay_draw()
+
+def data_time_range():
+    summary = data_manager.trajectories.summary
+    return int(summary["first_time"].min()), int(summary["last_time"].max())
 
 def select_graph():
     analysis_manager.select_graph(st.session_state["select_graph_ids"], map_manager.tuuka_list)
 
 def kiseki_draw():
-    map_manager.toggle_kiseki()
+    map_manager.kiseki_flag = st.session_state["kiseki_flag"]
+    map_manager.toggle_kiseki(data_manager)
+
+def playback_mode():
+    map_manager.playback_flag = st.session_state["playback_flag"]
+    map_manager.toggle_playback(data_manager)
+
+def playback_frame_time(frame):
+    return pd.Timestamp(data_manager.playback_manager.frame_time(frame), unit="s").to_pydatetime()
+
+def playback_auto():
+    return map_manager.playback_flag and st.session_state.get("playback_auto", False)
+
+def stay_settings():
+    return st.session_state.get("stay_distance", STAY_DISTANCE), st.session_state.get("stay_minutes", STAY_SECONDS // 60) * 60
+
+def selected_stays():
+    # 滞在と移動の表を、選択中のユーザーだけに絞る
+    stays, trips = data_manager.stay_manager.detect(*stay_settings())
+    selected = stays["userid"].cat.codes.isin(data_manager.selected_users).to_numpy()
+    return stays[selected], trips[trips["from_stay"].isin(stays.index[selected]).to_numpy()]
+
+def stay_draw():
+    map_manager.stay_flag = st.session_state.get("stay_flag", False)
+    if map_manager.stay_flag and len(data_manager.df) != 0:
+        map_manager.add_stay_layer(selected_stays()[0])
+    else:
+        map_manager.remove_stay_layer()
+
+def clean_mode():
+    data_manager.clean_manager.enabled = st.session_state["clean_flag"]
+    # 読み込み済みのデータは前処理の設定を変えて読み込み直す
+    if st.session_state["upload_csvfile"] is not None:
+        upload_csv()
+
+def resample_mode():
+    data_manager.clean_manager.resampling = st.session_state["resample_flag"]
+    # リサンプリングは前処理をするときだけ行う
+    if data_manager.clean_manager.enabled and st.session_state["upload_csvfile"] is not None:
+        upload_csv()
+
+def parallel_mode():
+    data_manager.parallel_manager.enabled = st.session_state["parallel_flag"]
 
 def select_shape():
     shape_manager.select_shape(st.session_state["select_shape_id"])
 
 def delete_shape():
-    shape_manager.delete_shape(st.session_state["delete_shape_id"])
+    shape_manager.delete_shape(st.session_state["delete_shape_id"], data_manager)
+
+# 自動再生中は再実行のたびに次のフレームへ進め、最後のフレームで止める
+if playback_auto() and len(data_manager.df) != 0:
+    first, last = data_manager.playback_manager.frame_range(data_manager.window)
+    if map_manager.playback_frame >= last:
+        st.session_state["playback_auto"] = False
+    else:
+        map_manager.add_playback_frame(data_manager, map_manager.playback_frame + 1)
 
 # 表示する地図
 st_data = st_folium(map_manager.map, width=800, height=800, zoom=map_manager.zoom_level, center=map_manager.center)
@@ -147,11 +164,15 @@ st_data = st_folium(map_manager.map, width=800, height=800, zoom=map_manager.zoo
 # 地図のデータをコピー
 st.session_state["data"] = st_data
 
-# shape_manager.handle_draw_data(data_manager, st.session_state["data"]["all_drawings"])
+# ズームや表示範囲が変わったら、それに合わせた詳細度でプロットと軌跡を描き直す
+if map_manager.update_view(st_data):
+    map_manager.refresh_lod(data_manager)
+
+# shape_manager.handle_draw_data(st.session_state["data"], data_manager)
 # st.write(map_manager.gate_data)
 
 try:
-    shape_manager.handle_draw_data(st.session_state["data"]["all_drawings"])
+    shape_manager.handle_draw_data(st.session_state["data"], data_manager)
     st_folium(map_manager.map, width=800, height=800, zoom=map_manager.zoom_level, center=map_manager.center)
 except Exception as e:
     st.write(st.session_state["data"]["all_drawings"])
@@ -169,7 +190,59 @@ try:
             on_change=select_graph
         )
 
-        analysis_manager.display_graph(st.session_state["select_graph_ids"])
+        if len(st.session_state["select_graph_ids"]) != 0:
+            # 集計の間隔と表示する期間を選ぶ（累積人数から求めるので再集計はしない）
+            st.selectbox("集計の間隔", list(BIN_WIDTHS.keys()), index=2, key="graph_bin_width")
+            start, end = analysis_manager.time_range(st.session_state["select_graph_ids"])
+            window = st.slider("表示する期間",
+                               min_value=pd.Timestamp(start, unit="s").to_pydatetime(),
+                               max_value=pd.Timestamp(end, unit="s").to_pydatetime(),
+                               value=(pd.Timestamp(start, unit="s").to_pydatetime(), pd.Timestamp(end, unit="s").to_pydatetime()),
+                               step=pd.Timedelta(hours=1).to_pytimedelta(),
+                               format="MM/DD HH:mm")
+
+            analysis_manager.display_graph(st.session_state["select_graph_ids"],
+                                           BIN_WIDTHS[st.session_state["graph_bin_width"]],
+                                           tuple(int(pd.Timestamp(value).timestamp()) for value in window))
+except Exception as e:
+    st.error(e)
+
+try:
+    if len(data_manager.df) != 0 and len(map_manager.gate_data) >= 2:
+        # ゲート間の移動人数（ゲートかデータが変わったときだけ集計し直し、追加されたゲートの交差だけを新たに判定する）
+        od_manager.update(data_manager.cross_manager, map_manager.gate_data)
+        labels = [f"図形{value}" for value in range(1, len(map_manager.gate_data) + 1)]
+        st.write("ゲート間の移動人数（行：出発、列：到着）")
+        st.dataframe(pd.DataFrame(od_manager.matrix, index=labels, columns=labels))
+
+        od_origin = st.selectbox("出発する図形", labels, key="od_origin")
+        od_destination = st.selectbox("到着する図形", labels, index=1, key="od_destination")
+        od_manager.display_travel_times(labels.index(od_origin), labels.index(od_destination))
+except Exception as e:
+    st.error(e)
+
+try:
+    polygon_ids = [str(value) for value in range(1, len(map_manager.gate_data) + 1)
+                   if map_manager.gate_data[value - 1][0] == map_manager.gate_data[value - 1][-1]]
+    if len(data_manager.df) != 0 and len(polygon_ids) != 0:
+        # ポリゴンの図形ごとの滞在時間と在域人数
+        zone_id = st.selectbox("滞在時間を表示する図形のIDを選択してください", polygon_ids, key="zone_id")
+        data_manager.zone_manager.display_dwell(map_manager.gate_data[int(zone_id) - 1])
+except Exception as e:
+    st.error(e)
+
+try:
+    if len(data_manager.df) != 0:
+        # 止まっていた地点（滞在）と、滞在の間の移動
+        with st.expander("滞在地点と移動"):
+            st.number_input("止まっているとみなす点の間の距離[m]", min_value=1.0, value=float(STAY_DISTANCE),
+                            key="stay_distance", on_change=stay_draw)
+            st.number_input("滞在とみなす時間[分]", min_value=1, value=STAY_SECONDS // 60,
+                            key="stay_minutes", on_change=stay_draw)
+            stays, trips = selected_stays()
+            st.write(f"滞在：{len(stays)}件　移動：{len(trips)}件")
+            st.dataframe(stays)
+            st.dataframe(trips)
 except Exception as e:
     st.error(e)
 
@@ -177,6 +250,11 @@ with st.sidebar:
     tab1, tab2, tab3, tab4 = st.tabs(["Uploader", "Data_info", "Gate_info", "Kiseki_info"])
 
     with tab1:
+        st.checkbox("外れ値の除去・重複の統合をする", key="clean_flag",
+                    value=data_manager.clean_manager.enabled, on_change=clean_mode)
+        if data_manager.clean_manager.enabled:
+            st.checkbox(f"{data_manager.clean_manager.resample_seconds}秒ごとにリサンプリングする", key="resample_flag",
+                        value=data_manager.clean_manager.resampling, on_change=resample_mode)
         st.file_uploader("CSVファイルをアップロード", type=["csv"], key="upload_csvfile", on_change=upload_csv)
         st.write(st.session_state["upload_csvfile"])
 
@@ -185,12 +263,16 @@ with st.sidebar:
             st.write(data_manager.df_new)
 
             if len(data_manager.df) != 0:
-                st.multiselect("選択してください", data_manager.df.iloc[:, 0].unique(), key="select_data_id",
+                st.multiselect("選択してください", data_manager.trajectories.user_keys, key="select_data_id",
                                on_change=select_data)
-                data_manager.sorted_df = data_manager.sorted_df.sort_values(by=data_manager.sorted_df.columns[1])
-                csv_file = data_manager.sorted_df.to_csv(index=False)
+                start, end = (pd.Timestamp(value, unit="s").to_pydatetime() for value in data_time_range())
+                st.slider("期間で絞り込む", min_value=start, max_value=end, value=(start, end),
+                          step=pd.Timedelta(minutes=1).to_pytimedelta(), format="MM/DD HH:mm",
+                          key="select_data_window", on_change=select_data)
 
+                # sorted_dfは時刻順に並んでいる
                 if len(st.session_state["select_data_id"]) != 0:
+                    csv_file = data_manager.sorted_df.to_csv(index=False)
                     st.download_button(label="Download CSV", data=csv_file, file_name='sorted.csv')
 
     with tab3:
@@ -205,11 +287,36 @@ with st.sidebar:
                          key="delete_shape_id",
                          on_change=delete_shape)
 
+            st.checkbox("ゲートの判定を複数のプロセスで行う", key="parallel_flag",
+                        value=data_manager.parallel_manager.enabled, on_change=parallel_mode)
+
             st.write("ゲートと通過時刻")
-            st.write(map_manager.tuuka_list)
+            st.write([{key: TrajectoryStore.format_time(value) for key, value in tuuka.items()}
+                      for tuuka in map_manager.tuuka_list])
             st.write(map_manager.selected_shape_type)
             st.write(map_manager.selected_shape)
 
     with tab4:
         if len(data_manager.df) != 0:
             st.checkbox(label='軌跡の表示', key='kiseki_flag', on_change=kiseki_draw)
+            st.checkbox(label='滞在地点の表示', key='stay_flag', on_change=stay_draw)
+
+            # 再生モードではスライダーの時刻のフレームだけを地図に送る
+            st.checkbox(label='再生モード', key='playback_flag', on_change=playback_mode)
+            if map_manager.playback_flag:
+                first, last = data_manager.playback_manager.frame_range(data_manager.window)
+                current = playback_frame_time(map_manager.playback_frame)
+                playback_time = st.slider("再生時刻", min_value=playback_frame_time(first), max_value=playback_frame_time(last),
+                                          value=current, step=pd.Timedelta(seconds=FRAME_SECONDS).to_pytimedelta(),
+                                          format="MM/DD HH:mm")
+                st.checkbox("自動再生", key="playback_auto")
+
+                if playback_time != current:
+                    map_manager.add_playback_frame(data_manager,
+                                                   data_manager.playback_manager.frame_of(pd.Timestamp(playback_time).timestamp()))
+                    st.experimental_rerun()
+
+# 自動再生中は少し待ってから次のフレームを表示する
+if playback_auto() and len(data_manager.df) != 0:
+    time.sleep(PLAYBACK_INTERVAL)
+    st.experimental_rerun()
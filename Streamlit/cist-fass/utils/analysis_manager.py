@@ -1,70 +1,65 @@
-import plotly.graph_objs as go
-import json
-from collections import defaultdict
-from datetime import datetime
+import numpy as np
+import pandas as pd
 
-class AnalysisManager:
-    def __init__(self):
-        self.graph_data = dict()
+# 累積人数を持つ時間の幅（秒）
+BASE_SECONDS = 60
+DAY_SECONDS = 86400
+# グラフで選べる集計の幅（秒）
+BIN_WIDTHS = {"5分": 300, "15分": 900, "1時間": 3600, "1日": DAY_SECONDS}
 
-    def select_graph(self, selected_ids, tuuka_list):
-        self.graph_data = dict()
-        if len(selected_ids) != 0:
-            for idx in selected_ids:
-                data = tuuka_list[int(idx) - 1]
-                dates = data.values()
-                first_date_str = next(iter(dates))
-                start_date = datetime.strptime(first_date_str, '%Y/%m/%d %H:%M').date()
-
-                hourly_counts = defaultdict(lambda: defaultdict(int))
 
-                for date_str in dates:
-                    dt = datetime.strptime(date_str, '%Y/%m/%d %H:%M')
-                    date = dt.date()
-                    hour = dt.hour
-                    hourly_counts[date][hour] += 1
+def cumulative_counts(times, base_seconds=BASE_SECONDS):
+    # 通過のあった base_seconds ごとの区間(bins)だけについて、cumulative[i]は bins[i] より前に通過した人数
+    # 外れた時刻があっても、通過のない区間の分の配列は作らない
+    # 集計範囲(origin, end)は最初の通過日の0時から最後の通過日の翌日0時まで
+    times = np.asarray(times, dtype=np.int64)
+    if len(times) == 0:
+        return {"origin": 0, "end": 0, "bins": np.zeros(0, dtype=np.int64), "cumulative": np.zeros(1, dtype=np.int64)}
+    origin = int(times.min()) // DAY_SECONDS * DAY_SECONDS
+    end = (int(times.max()) // DAY_SECONDS + 1) * DAY_SECONDS
+    bins, counts = np.unique((times - origin) // base_seconds, return_counts=True)
+    return {"origin": origin, "end": end, "bins": bins, "cumulative": np.concatenate(([0], np.cumsum(counts)))}
 
-                counts_dict = dict()
-                for date, counts in hourly_counts.items():
-                    for hour in range(24):
-                        counts_dict[f"{date.strftime('%m/%d')} {hour:02d}時"] = counts[hour]
 
-                sorted_data = sorted(counts_dict.items())
+def window_counts(graph, start, end, bin_seconds, base_seconds=BASE_SECONDS):
+    # start から end までを bin_seconds ごとに区切り、区間の人数を累積人数の差で求める
+    edges = np.append(np.arange(start, end, bin_seconds, dtype=np.int64), end)
+    idx = np.searchsorted(graph["bins"], -(-(edges - graph["origin"]) // base_seconds))
+    return edges[:-1], np.diff(graph["cumulative"][idx])
 
-                trace = go.Scatter(x=[f"{start_date.strftime('%m/%d')} {hour:02d}:00" for hour in range(24)],
-                                   y=[counts for hour, counts in sorted_data],
-                                   mode='lines', name='通過人数[人]')
 
-                layout = go.Layout(
-                    title='通過人数',
-                    xaxis=dict(title='日時'),
-                    yaxis=dict(
-                        title='通過人数[人]',
-                        tickvals=list(range(max([counts for hour, counts in sorted_data]) + 1)),
-                        tickformat='d',
-                    )
-                )
+class AnalysisManager:
+    def __init__(self):
+        self.graph_data = dict()
 
-                fig = go.Figure(data=[trace], layout=layout)
+    def select_graph(self, selected_ids, tuuka_list):
+        # 図形ごとに累積人数の配列を作っておき、集計の幅を変えても作り直さない
+        self.graph_data = dict()
+        for idx in selected_ids:
+            data = tuuka_list[int(idx) - 1]
+            self.graph_data[idx] = cumulative_counts(np.fromiter(data.values(), dtype=np.int64, count=len(data)))
 
-                graph_json = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+    def time_range(self, selected_graph_ids):
+        # 選択された図形全体の集計範囲
+        start = min(self.graph_data[idx]["origin"] for idx in selected_graph_ids)
+        end = max(self.graph_data[idx]["end"] for idx in selected_graph_ids)
+        return int(start), int(end)
 
-                self.graph_data[idx] = graph_json
+    def display_graph(self, selected_graph_ids, bin_seconds=3600, window=None):
+        # 集計だけならStreamlitとplotlyなしで使えるように、表示するときに読み込む
+        import plotly.graph_objs as go
+        import streamlit as st
 
-    def display_graph(self, selected_graph_ids):
         if len(selected_graph_ids) != 0:
+            # 全ての図形で同じ区切りを使って重ねる
+            start, end = self.time_range(selected_graph_ids) if window is None else window
             fig = go.Figure()
-            diff = len(tuuka_list) - len(selected_graph_ids)
-            y_values = []
+            max_y_value = 0
             for idx in selected_graph_ids:
-                graph_json = self.graph_data[idx]
-                fig_dict = json.loads(graph_json)
-                y_values.extend(trace['y'] for trace in fig_dict['data'])
-                for trace in fig_dict['data']:
-                    name = f"図形{idx}"
-                    fig.add_trace(go.Scatter(x=trace['x'], y=trace['y'], mode=trace['mode'], name=name))
-
-            max_y_value = max(max(y) for y in y_values)
+                graph = self.graph_data[idx]
+                bins, counts = window_counts(graph, start, end, bin_seconds)
+                max_y_value = max(max_y_value, int(counts.max(initial=0)))
+                fig.add_trace(go.Scatter(x=pd.to_datetime(bins, unit="s"), y=counts, mode='lines', name=f"図形{idx}"))
 
             if max_y_value > 5:
                 dtick_value = 5
@@ -73,7 +68,7 @@ class AnalysisManager:
 
             layout = go.Layout(
                 title='通過人数',
-                xaxis=dict(title='日時', dtick=6),
+                xaxis=dict(title='日時', tickformat='%m/%d %H:%M'),
                 yaxis=dict(
                     title='通過人数[人]',
                     tickvals=list(range(0, max_y_value + 1, dtick_value)) + [max_y_value],
@@ -0,0 +1,98 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from utils.analysis_manager import cumulative_counts, window_counts
+from utils.cross_manager import gate_coordinates
+from utils.data_manager import DataManager, DATETIME_FORMAT
+
+
+def load_gate_file(path):
+    # GeoJSONファイル（FeatureCollection・Feature・geometry）からゲートの座標のリストを読み込む
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    features = data["features"] if data.get("type") == "FeatureCollection" else [data]
+    return [gate_coordinates(feature) for feature in features]
+
+
+def _analyze_file(path, gate_list, bin_seconds, clean, cache, parallel):
+    return BatchManager(gate_list, bin_seconds=bin_seconds, clean=clean, cache=cache).analyze(path, parallel)
+
+
+class BatchManager:
+    def __init__(self, gate_list, bin_seconds=None, workers=1, clean=False, cache=False):
+        # バッチでは指定がなければ前処理をせず元のデータのまま判定し、読み込みのキャッシュも使わない
+        self.gate_list = gate_list
+        self.bin_seconds = bin_seconds
+        self.workers = workers
+        self.clean = clean
+        self.cache = cache
+
+    def analyze(self, path, parallel=True):
+        # 1つのCSVを読み込み、ゲートごとの通過（ユーザーと通過時刻）と通過人数の時系列を返す
+        data_manager = DataManager()
+        data_manager.clean_manager.enabled = self.clean
+        data_manager.cache_manager.enabled = self.cache and data_manager.cache_manager.enabled
+        data_manager.parallel_manager.enabled = parallel and data_manager.parallel_manager.enabled
+        try:
+            with open(path, "rb") as f:
+                data_manager.load_data(f)
+            data_manager.make_line_features(True)
+            tuuka_list = data_manager.cross_manager.judge_all(self.gate_list, data_manager.parallel_manager)
+        finally:
+            data_manager.parallel_manager.close()
+
+        passes = pd.DataFrame({
+            "gateid": np.repeat(np.arange(1, len(tuuka_list) + 1), [len(tuuka) for tuuka in tuuka_list]),
+            "userid": [user_id for tuuka in tuuka_list for user_id in tuuka.keys()],
+            "datetime": pd.to_datetime([epoch for tuuka in tuuka_list for epoch in tuuka.values()], unit="s")
+        })
+        passes["datetime"] = passes["datetime"].dt.strftime(DATETIME_FORMAT)
+
+        counts = None
+        if self.bin_seconds is not None:
+            counts = self.time_series(tuuka_list)
+        return passes, counts
+
+    def time_series(self, tuuka_list):
+        # 全てのゲートで同じ区切りを使い、通過人数をゲートごとの列に並べる
+        columns = [f"gate{idx}" for idx in range(1, len(tuuka_list) + 1)]
+        graphs = [cumulative_counts(np.fromiter(tuuka.values(), dtype=np.int64, count=len(tuuka))) for tuuka in tuuka_list]
+        passed = [graph for graph, tuuka in zip(graphs, tuuka_list) if len(tuuka) != 0]
+        if not passed:
+            return pd.DataFrame(columns=["datetime"] + columns)
+        start = min(graph["origin"] for graph in passed)
+        end = max(graph["end"] for graph in passed)
+
+        counts = {column: window_counts(graph, start, end, self.bin_seconds)[1] for column, graph in zip(columns, graphs)}
+        bins = np.arange(start, end, self.bin_seconds, dtype=np.int64)
+        return pd.DataFrame({"datetime": pd.to_datetime(bins, unit="s").strftime(DATETIME_FORMAT), **counts})
+
+    def run(self, paths, out_dir):
+        # ファイルごとに通過のCSV（と時系列のCSV）を書き出し、全ファイルの通過人数の表を返す
+        os.makedirs(out_dir, exist_ok=True)
+        if self.workers > 1 and len(paths) > 1:
+            # ファイルごとにプロセスを分けるので、ファイルの中ではゲートの判定を並列にしない
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results = executor.map(_analyze_file, paths, [self.gate_list] * len(paths), [self.bin_seconds] * len(paths),
+                                       [self.clean] * len(paths), [self.cache] * len(paths), [False] * len(paths))
+                results = list(results)
+        else:
+            results = [self.analyze(path) for path in paths]
+
+        summary = []
+        for path, (passes, counts) in zip(paths, results):
+            name = os.path.splitext(os.path.basename(path))[0]
+            passes.to_csv(os.path.join(out_dir, f"{name}_passes.csv"), index=False)
+            if counts is not None:
+                counts.to_csv(os.path.join(out_dir, f"{name}_counts.csv"), index=False)
+            pass_counts = passes["gateid"].value_counts()
+            summary.append({"file": os.path.basename(path),
+                            **{f"gate{idx}": int(pass_counts.get(idx, 0)) for idx in range(1, len(self.gate_list) + 1)}})
+
+        summary = pd.DataFrame(summary, columns=["file"] + [f"gate{idx}" for idx in range(1, len(self.gate_list) + 1)])
+        summary.to_csv(os.path.join(out_dir, "summary.csv"), index=False)
+        return summary
@@ -0,0 +1,91 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# 読み込んだデータを保存するフォルダ
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "cist-fass-cache")
+# 保存するデータの合計の上限（バイト）。超えたら最後に使ってから長いものから消す
+CACHE_BYTES = 2 * 1024 ** 3
+# 保存する配列の形式を変えたら上げる（古い形式のデータは使われなくなる）
+CACHE_VERSION = b"3"
+HASH_BLOCK = 1 << 20
+
+
+class CacheManager:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = max_bytes > 0
+
+    def key(self, file_data):
+        # ファイルの中身のハッシュをキーにするので、同じCSVなら誰がアップロードしても同じキーになる
+        digest = hashlib.sha256(CACHE_VERSION)
+        file_data.seek(0)
+        for block in iter(lambda: file_data.read(HASH_BLOCK), b""):
+            digest.update(block)
+        file_data.seek(0)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        # 配列はメモリマップで開くので、読み込みはほぼファイルを開くだけで済む
+        path = self.path(key)
+        try:
+            arrays = {os.path.splitext(name)[0]: np.load(os.path.join(path, name), mmap_mode="r")
+                      for name in os.listdir(path) if name.endswith(".npy")}
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        # 別の名前のフォルダに書いてから名前を変え、書きかけのデータを読まないようにする
+        # 保存できなくても（書き込めない・容量不足など）読み込み自体は続ける
+        path = self.path(key)
+        if os.path.isdir(path):
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = tempfile.mkdtemp(prefix=f".{key}-", dir=self.cache_dir)
+        except OSError:
+            return
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(temp_path, f"{name}.npy"), np.asarray(array))
+            os.rename(temp_path, path)
+        except OSError:
+            # 他のセッションが同じデータを先に保存したときなど
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return
+        self.evict(keep=key)
+
+    def entries(self):
+        # (最後に使った時刻, 大きさ, キー) のリスト
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = self.path(key)
+            if key.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.stat(path).st_mtime, size, key))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self, keep=None):
+        # 合計が上限を超えている間、最後に使ってから長いものから消す
+        entries = sorted(self.entries())
+        total = sum(size for used, size, key in entries)
+        for used, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            # 開いているセッションのメモリマップは、消した後も閉じるまで読める
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,107 @@
+import numpy as np
+
+# これより速い移動（m/s）で行って戻る点は測位の飛びとみなして除く
+MAX_SPEED = 50.0
+# リサンプリングの間隔（秒）
+RESAMPLE_SECONDS = 60
+# これより長く点がない区間は補間しない（秒）
+MAX_GAP_SECONDS = 600
+# リサンプリングで1ユーザーに作る点の上限（超えるユーザーは間隔を広げる）
+MAX_RESAMPLE_POINTS = 10000
+EARTH_RADIUS = 6371000.0
+
+
+def distances(lon1, lat1, lon2, lat2):
+    # 正距円筒図法の近似による2点間の距離（メートル）
+    x = np.radians(lon2 - lon1) * np.cos(np.radians((lat1 + lat2) / 2))
+    y = np.radians(lat2 - lat1)
+    return EARTH_RADIUS * np.hypot(x, y)
+
+
+class CleanManager:
+    def __init__(self, max_speed=MAX_SPEED, resample_seconds=RESAMPLE_SECONDS, max_gap=MAX_GAP_SECONDS,
+                 max_points=MAX_RESAMPLE_POINTS):
+        # 既定では前処理をせず、読み込んだ点をそのまま使う（ゲートの判定は元の点で行う）
+        # 前処理をするときも、点を増やすリサンプリングは別に選ばれたときだけ行う
+        self.enabled = False
+        self.resampling = False
+        self.max_speed = max_speed
+        self.resample_seconds = resample_seconds
+        self.max_gap = max_gap
+        self.max_points = max_points
+
+    def signature(self):
+        # 前処理の設定が違えば別のデータとして保存する
+        if not self.enabled:
+            return "raw"
+        if not self.resampling:
+            return f"clean-{self.max_speed}"
+        return f"clean-{self.max_speed}-{self.resample_seconds}-{self.max_gap}-{self.max_points}"
+
+    def clean(self, offsets, times, lon, lat):
+        # ユーザーごと・時刻順に並んだ配列をまとめて処理し、同じ並びの配列とoffsetsを返す
+        users = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+        users, times, lon, lat = self.merge_duplicates(users, times, lon, lat)
+        users, times, lon, lat = self.remove_spikes(users, times, lon, lat)
+        if self.resampling:
+            users, times, lon, lat = self.resample(users, times, lon, lat)
+        counts = np.bincount(users, minlength=len(offsets) - 1)
+        return np.concatenate(([0], np.cumsum(counts))).astype(np.int64), times, lon, lat
+
+    def merge_duplicates(self, users, times, lon, lat):
+        # 同じユーザーの同じ時刻・同じ位置の点（まったく同じ行）は1点にする
+        # 時刻は分までしかないので、同じ時刻でも位置が違う点はそのまま残す
+        if len(times) == 0:
+            return users, times, lon, lat
+        first = np.ones(len(times), dtype=bool)
+        first[1:] = (users[1:] != users[:-1]) | (times[1:] != times[:-1]) | (lon[1:] != lon[:-1]) | (lat[1:] != lat[:-1])
+        return users[first], times[first], lon[first], lat[first]
+
+    def remove_spikes(self, users, times, lon, lat):
+        # 前の点から来る速さと次の点へ行く速さがどちらも上限を超える点を除く
+        # 別のユーザーの点との間や、時刻が同じ点の間は速さを求めない
+        if len(times) < 3:
+            return users, times, lon, lat
+        elapsed = times[1:] - times[:-1]
+        valid = (users[1:] == users[:-1]) & (elapsed > 0)
+        speed = np.zeros(len(elapsed), dtype=np.float64)
+        speed[valid] = distances(lon[:-1][valid], lat[:-1][valid], lon[1:][valid], lat[1:][valid]) / elapsed[valid]
+        fast = valid & (speed > self.max_speed)
+        spike = np.zeros(len(times), dtype=bool)
+        spike[1:-1] = fast[:-1] & fast[1:]
+        keep = ~spike
+        return users[keep], times[keep], lon[keep], lat[keep]
+
+    def resample(self, users, times, lon, lat):
+        # 各ユーザーの最初の点の時刻から最後まで、間隔ごとの時刻の位置を前後の点から線形補間する
+        # 点が上限を超えるユーザー（時刻の外れ値があるときなど）は、上限に収まるまで間隔を広げる
+        if len(times) == 0:
+            return users, times, lon, lat
+        n_users = int(users.max()) + 1
+        starts = np.searchsorted(users, np.arange(n_users), side="left")
+        stops = np.searchsorted(users, np.arange(n_users), side="right")
+        has_points = stops > starts
+        starts, stops = starts[has_points], stops[has_points]
+        first = times[starts]
+        duration = times[stops - 1] - first
+        interval = np.maximum(self.resample_seconds, -(-duration // max(self.max_points - 1, 1)))
+        counts = duration // interval + 1
+
+        grid_users = np.repeat(users[starts], counts)
+        grid_times = np.repeat(first, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) * np.repeat(interval, counts)
+
+        # ユーザー番号と時刻を1つの整数にまとめ、全ユーザーの補間元の点を1回の二分探索で求める
+        base = int(times.min()) - 1
+        span = int(times.max()) - base + 1
+        left = np.searchsorted(users * span + (times - base), grid_users * span + (grid_times - base), side="right") - 1
+        user_start, user_last = np.repeat(starts, counts), np.repeat(stops - 1, counts)
+        left = np.clip(left, user_start, user_last)
+        right = np.minimum(left + 1, user_last)
+
+        gap = times[right] - times[left]
+        frac = np.clip((grid_times - times[left]) / np.maximum(gap, 1), 0, 1)
+        # 点のない時間が長い区間には点を作らない（区間の両端の点は残る）
+        keep = (gap <= self.max_gap) | (grid_times <= times[left])
+        left, right, frac = left[keep], right[keep], frac[keep]
+        return (grid_users[keep], grid_times[keep],
+                lon[left] + (lon[right] - lon[left]) * frac, lat[left] + (lat[right] - lat[left]) * frac)
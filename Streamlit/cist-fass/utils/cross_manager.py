@@ -0,0 +1,180 @@
+import numpy as np
+from utils.grid_index import GridIndex
+from utils.trajectory_store import TrajectoryStore
+
+# 一度に判定する軌跡線分の数（ゲート辺数 × CHUNK_SIZE の配列を作る）
+CHUNK_SIZE = 1 << 18
+
+
+def gate_key(gates):
+    # ゲートの座標から結果キャッシュのキーを作る
+    return tuple(tuple(point) for point in gates)
+
+
+def gate_coordinates(feature):
+    # GeoJSONの図形（Featureまたはgeometry）からゲートの座標を取り出す。ポリゴンは外周を使う
+    geometry = feature.get("geometry", feature)
+    if geometry["type"] == "Polygon":
+        return geometry["coordinates"][0]
+    return geometry["coordinates"]
+
+
+def points_in_polygon(x, y, polygon):
+    # レイキャスティング法で点ごとにポリゴンの内側かどうかを判定する
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    ring = np.asarray(polygon, dtype=np.float64)
+    if len(ring) and (ring[0] != ring[-1]).any():
+        ring = np.vstack((ring, ring[:1]))
+
+    inside = np.zeros(len(x), dtype=bool)
+    if len(ring) < 4:
+        return inside
+    # 外接矩形の外にある点は判定しない
+    idx = np.flatnonzero((x >= ring[:, 0].min()) & (x <= ring[:, 0].max()) &
+                         (y >= ring[:, 1].min()) & (y <= ring[:, 1].max()))
+    px, py = x[idx], y[idx]
+    result = np.zeros(len(idx), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+        # 点から右に伸ばした半直線と辺が交差する回数の偶奇を数える
+        crosses = np.flatnonzero((y1 > py) != (y2 > py))
+        result[crosses] ^= px[crosses] < (x2 - x1) * (py[crosses] - y1) / (y2 - y1) + x1
+    inside[idx] = result
+    return inside
+
+
+class CrossManager:
+    def __init__(self):
+        self.load(TrajectoryStore())
+
+    def load(self, trajectories, grid_index=None):
+        # 線分は軌跡の座標配列のビューとして扱う（grid_indexを渡せば格子を作り直さない）
+        self.user_keys = trajectories.user_keys
+        self.offsets = trajectories.offsets
+        self.x1, self.y1, self.x2, self.y2 = trajectories.segments()
+        self.times = trajectories.times
+        self.seg_user = trajectories.point_user()[:-1]
+        if grid_index is None:
+            grid_index = GridIndex(self.x1, self.y1, self.x2, self.y2, trajectories.segment_valid())
+        self.grid_index = grid_index
+        self.results = dict()
+        self.events = dict()
+
+    def candidates(self, gates):
+        # ゲートの外接矩形と重なる線分だけを候補にする
+        gate = np.asarray(gates, dtype=np.float64)
+        return self.grid_index.query(gate[:, 0].min(), gate[:, 1].min(), gate[:, 0].max(), gate[:, 1].max())
+
+    def edge_hits(self, gates, segs):
+        # ゲートの辺 × 軌跡の線分の交差判定をまとめて行う
+        gate = np.asarray(gates, dtype=np.float64)
+        ax, ay = gate[:-1, 0, None], gate[:-1, 1, None]
+        bx, by = gate[1:, 0, None], gate[1:, 1, None]
+        cx, cy = self.x1[segs], self.y1[segs]
+        dx, dy = self.x2[segs], self.y2[segs]
+
+        # x座標、y座標による判定
+        hit = (np.maximum(ax, bx) >= np.minimum(cx, dx)) & (np.minimum(ax, bx) <= np.maximum(cx, dx))
+        hit &= (np.maximum(ay, by) >= np.minimum(cy, dy)) & (np.minimum(ay, by) <= np.maximum(cy, dy))
+
+        tc1 = (ax - bx) * (cy - ay) + (ay - by) * (ax - cx)
+        tc2 = (ax - bx) * (dy - ay) + (ay - by) * (ax - dx)
+        td1 = (cx - dx) * (ay - cy) + (cy - dy) * (cx - ax)
+        td2 = (cx - dx) * (by - cy) + (cy - dy) * (cx - bx)
+        hit &= (tc1 * tc2 <= 0) & (td1 * td2 <= 0)
+        return hit
+
+    def cross_judge(self, gates, candidates=None):
+        # ユーザーごとに最初に交差した線分の番号を返す（交差なしは-1）
+        # 元の判定と同じく、番号の小さいゲート辺を優先し、その辺で最初に交差した線分を選ぶ
+        n_segments = len(self.x1)
+        first = np.full(len(self.user_keys), -1, dtype=np.int64)
+        if n_segments == 0 or len(gates) < 2:
+            return first
+        if candidates is None:
+            candidates = self.candidates(gates)
+
+        best = np.full(len(self.user_keys), np.iinfo(np.int64).max, dtype=np.int64)
+        for start in range(0, len(candidates), CHUNK_SIZE):
+            segs = candidates[start:start + CHUNK_SIZE]
+            edge_idx, local_idx = np.nonzero(self.edge_hits(gates, segs))
+            seg_idx = segs[local_idx]
+            np.minimum.at(best, self.seg_user[seg_idx], edge_idx * n_segments + seg_idx)
+
+        found = best != np.iinfo(np.int64).max
+        first[found] = best[found] % n_segments - self.offsets[:-1][found]
+        return first
+
+    def crossings(self, gates):
+        # ゲートの辺と線分の全ての交差を、線分の番号と線分上の交差位置（0〜1）の順に並べて返す
+        # 判定済みのゲートはキャッシュを使う
+        key = gate_key(gates)
+        if key not in self.events:
+            candidates = self.candidates(gates) if len(gates) >= 2 else np.zeros(0, dtype=np.int64)
+            gate = np.asarray(gates, dtype=np.float64)
+            hit_segs, hit_pos = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float64)]
+            for start in range(0, len(candidates), CHUNK_SIZE):
+                segs = candidates[start:start + CHUNK_SIZE]
+                edge_idx, local_idx = np.nonzero(self.edge_hits(gates, segs))
+                seg_idx = segs[local_idx]
+                ax, ay = gate[edge_idx, 0], gate[edge_idx, 1]
+                bx, by = gate[edge_idx + 1, 0], gate[edge_idx + 1, 1]
+                cx, cy = self.x1[seg_idx], self.y1[seg_idx]
+                dx, dy = self.x2[seg_idx], self.y2[seg_idx]
+                denom = (dx - cx) * (by - ay) - (dy - cy) * (bx - ax)
+                numer = (ax - cx) * (by - ay) - (ay - cy) * (bx - ax)
+                # 平行に重なっているときは線分の始点で交差したとみなす
+                safe = np.where(denom != 0, denom, 1.0)
+                hit_segs.append(seg_idx)
+                hit_pos.append(np.clip(np.where(denom != 0, numer / safe, 0.0), 0.0, 1.0))
+
+            segs, pos = np.concatenate(hit_segs), np.concatenate(hit_pos)
+            order = np.lexsort((pos, segs))
+            self.events[key] = (segs[order], pos[order])
+        return self.events[key]
+
+    def judge(self, gates):
+        # 判定済みのゲートはキャッシュした結果を返す
+        key = gate_key(gates)
+        if key not in self.results:
+            self.results[key] = self.evaluate(gates)
+        return self.results[key]
+
+    def judge_all(self, gate_list, parallel_manager=None):
+        # 未判定のゲートだけをまとめて判定する（parallel_managerがあればプロセスに分けて判定する）
+        pending = {gate_key(gates): gates for gates in gate_list if gate_key(gates) not in self.results}
+        if pending:
+            if parallel_manager is None:
+                results = [self.evaluate(gates) for gates in pending.values()]
+            else:
+                results = parallel_manager.evaluate(list(pending.values()), self)
+            self.results.update(zip(pending.keys(), results))
+        return [self.results[gate_key(gates)] for gates in gate_list]
+
+    def forget(self, gates):
+        self.results.pop(gate_key(gates), None)
+        self.events.pop(gate_key(gates), None)
+
+    def evaluate(self, gates, users=None):
+        # ゲートを通過したユーザーと通過時刻の辞書を作る
+        # usersに(開始, 終了)を渡すと、その範囲の番号のユーザーだけを判定する
+        candidates = self.candidates(gates)
+        if users is not None:
+            in_block = (self.seg_user[candidates] >= users[0]) & (self.seg_user[candidates] < users[1])
+            candidates = candidates[in_block]
+        first = self.cross_judge(gates, candidates)
+
+        # ポリゴンゲートのときは、初期座標がゲートの外接矩形と重なるユーザーだけまとめて内外判定する
+        inside = set()
+        if gates[0] == gates[-1]:
+            first_segs = candidates[candidates == self.offsets[:-1][self.seg_user[candidates]]]
+            in_gate = points_in_polygon(self.x1[first_segs], self.y1[first_segs], gates)
+            inside = set(self.seg_user[first_segs[in_gate]].tolist())
+
+        tuuka = dict()
+        for user in sorted(inside.union(np.flatnonzero(first >= 0).tolist())):
+            start = self.offsets[user]
+            if user in inside:
+                tuuka[self.user_keys[user]] = int(self.times[start])
+            else:
+                tuuka[self.user_keys[user]] = int(self.times[start + first[user]])
+        return tuuka
@@ -1,44 +1,222 @@
 import pandas as pd
+import numpy as np
 import io
+import weakref
+
+from utils.cache_manager import CacheManager
+from utils.clean_manager import CleanManager
+from utils.cross_manager import CrossManager
+from utils.dataset_registry import Dataset
+from utils.grid_index import GridIndex
+from utils.parallel_manager import ParallelManager
+from utils.playback_manager import PlaybackManager
+from utils.stay_manager import StayManager
+from utils.zone_manager import ZoneManager
+from utils.trajectory_store import TrajectoryStore
+
+COLUMNS = ['userid', 'datetime', 'latitude', 'longitude']
+DTYPES = {'userid': str, 'datetime': str, 'latitude': np.float64, 'longitude': np.float64}
+DATETIME_FORMAT = '%Y/%m/%d %H:%M'
+CHUNK_ROWS = 500000
+
+
+def parse_datetime(values):
+    # 決まった書式なら書式指定で高速に変換し、違う書式のときは推定に任せる
+    try:
+        return pd.to_datetime(values, format=DATETIME_FORMAT)
+    except ValueError:
+        return pd.to_datetime(values)
 
-from datetime import datetime
 
 class DataManager:
-    def __init__(self):
+    def __init__(self, registry=None):
+        # registryを渡すと、同じCSVを開いた他のセッションと読み込んだデータを共有する
+        self.registry = registry
+        self.release = None
+        self.dataset = None
         self.df = pd.DataFrame()
         self.df_new = pd.DataFrame()
         self.sorted_df = pd.DataFrame()
-        self.kiseki_data = dict()
+        self.trajectories = TrajectoryStore()
+        self.raw_trajectories = self.trajectories
+        self.grid_index = None
+        self.selected_users = np.zeros(0, dtype=np.int64)
+        self.window = None
+        self.cache_manager = CacheManager()
+        self.clean_manager = CleanManager()
+        self.cross_manager = CrossManager()
+        self.parallel_manager = ParallelManager()
+        self.zone_manager = ZoneManager()
+        self.playback_manager = PlaybackManager()
+        self.stay_manager = StayManager()
+
+    def load_data(self, file_data, progress=None):
+        if isinstance(file_data, bytes):
+            file_data = io.BytesIO(file_data)
+
+        if self.registry is None:
+            self.use_dataset(self.read_dataset(file_data, progress))
+            return
+
+        key = self.dataset_key(file_data)
+        self.use_dataset(self.registry.acquire(key, lambda: self.read_dataset(file_data, progress, key)))
+        # セッションが終わってDataManagerが消えたときにも参照数を戻す
+        self.release = weakref.finalize(self, self.registry.release, key)
+
+    def read_dataset(self, file_data, progress=None, key=None):
+        # 同じ中身のCSVを読み込んだことがあれば、保存しておいた配列をメモリマップで使う
+        if not self.cache_manager.enabled:
+            return self.make_dataset(self.parse_data(file_data, progress))
+        if key is None:
+            key = self.dataset_key(file_data)
+        arrays = self.cache_manager.get(key)
+        if arrays is None:
+            arrays = self.parse_data(file_data, progress)
+            self.cache_manager.put(key, arrays)
+        return self.make_dataset(arrays)
+
+    def dataset_key(self, file_data):
+        # 同じCSVでも前処理の設定が違えば別のデータになる
+        return f"{self.cache_manager.key(file_data)}-{self.clean_manager.signature()}"
+
+    def parse_data(self, file_data, progress=None):
+        # CSVを読み込み、ユーザーごと・時刻順に並べた配列と線分の格子を作る
+        file_data.seek(0)
+        # アップロードされたファイルはsize、BytesIOはバッファの長さを全体の大きさにする
+        total_size = getattr(file_data, "size", None)
+        if total_size is None and hasattr(file_data, "getbuffer"):
+            total_size = len(file_data.getbuffer())
+
+        # チャンクごとにIDを番号に変換し、列ごとの配列として貯める
+        user_ids = dict()
+        codes, times, lat, lon = [], [], [], []
+        reader = pd.read_csv(file_data, header=0, names=COLUMNS, dtype=DTYPES, chunksize=CHUNK_ROWS)
+        for chunk in reader:
+            # IDが空欄・欠損の行は番号が-1になるので読み飛ばす
+            chunk_ids = chunk["userid"].str.strip()
+            chunk_codes, chunk_uniques = pd.factorize(chunk_ids.mask(chunk_ids == ""))
+            valid = chunk_codes >= 0
+            chunk = chunk[valid]
+            mapping = np.array([user_ids.setdefault(user_id, len(user_ids)) for user_id in chunk_uniques], dtype=np.int64)
+            codes.append(mapping[chunk_codes[valid]])
+            times.append(parse_datetime(chunk["datetime"]).to_numpy(dtype="datetime64[s]").astype(np.int64))
+            lat.append(chunk["latitude"].to_numpy())
+            lon.append(chunk["longitude"].to_numpy())
+            if progress is not None and total_size:
+                progress(min(file_data.tell() / total_size, 1.0))
+
+        codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64)
+        times = np.concatenate(times) if times else np.zeros(0, dtype=np.int64)
+        lat = np.concatenate(lat) if lat else np.zeros(0, dtype=np.float64)
+        lon = np.concatenate(lon) if lon else np.zeros(0, dtype=np.float64)
 
-    def load_data(self, file_data):
-        self.df = pd.read_csv(io.BytesIO(file_data))
-        self.df.columns = ['userid', 'datetime', 'latitude', 'longitude']
-        self.df['datetime'] = pd.to_datetime(self.df['datetime'])
-        self.df.sort_values(by=[self.df.columns[1]], inplace=True)
+        # 通過時間でソートし、IDの番号を時刻順の初出順に振り直す
+        order = np.argsort(times, kind="stable")
+        first_seen = np.full(len(user_ids), len(order), dtype=np.int64)
+        np.minimum.at(first_seen, codes[order], np.arange(len(order)))
+        rank = np.empty(len(user_ids), dtype=np.int64)
+        rank[np.argsort(first_seen, kind="stable")] = np.arange(len(user_ids))
+        codes = rank[codes]
+        keys = np.empty(len(user_ids), dtype=object)
+        keys[rank] = list(user_ids.keys())
 
-        unique_values = self.df.iloc[:, 0].unique()
-        self.df_new = pd.DataFrame(unique_values, columns=["newid"])
-        self.df_new.index = range(1, len(self.df_new) + 1)
+        trajectories = TrajectoryStore()
+        # 時刻順のi番目の点が、ユーザーごとに並べた配列の何番目にあるか
+        position = np.empty(len(order), dtype=np.int64)
+        position[trajectories.load_arrays(keys, codes, times, lon, lat)] = np.arange(len(order))
+        # 表示・ダウンロードするデータフレームは、前処理をしていない点を時刻順に並べて作る
+        arrays = {"time_order": position[order]}
+        if self.clean_manager.enabled:
+            # 外れ値の除去・重複の統合（・リサンプリング）をした点で線分を作り、元の点は別に残す
+            arrays.update({f"raw_{name}": getattr(trajectories, name) for name in ("offsets", "lon", "lat", "times")})
+            offsets, times, lon, lat = self.clean_manager.clean(trajectories.offsets, trajectories.times,
+                                                                trajectories.lon, trajectories.lat)
+            trajectories = TrajectoryStore()
+            trajectories.load_sorted(keys, offsets, lon, lat, times)
+        grid_index = GridIndex(*trajectories.segments(), trajectories.segment_valid())
 
-        self.sorted_df = self.df.copy()
-        self.kiseki_data = {str(itr): [] for itr in unique_values}
+        arrays.update({
+            "user_keys": np.array(keys, dtype=str),
+            "offsets": trajectories.offsets,
+            "lon": trajectories.lon,
+            "lat": trajectories.lat,
+            "times": trajectories.times
+        })
+        arrays.update({f"grid_{name}": array for name, array in grid_index.state().items()})
+        return arrays
+
+    def make_dataset(self, arrays):
+        trajectories = TrajectoryStore()
+        trajectories.load_sorted(arrays["user_keys"].tolist(), arrays["offsets"], arrays["lon"], arrays["lat"], arrays["times"])
+        trajectories.freeze()
+        grid_index = GridIndex(*trajectories.segments(),
+                               state={name[5:]: array for name, array in arrays.items() if name.startswith("grid_")})
+
+        # 前処理をしたときは、表示・ダウンロード用に前処理の前の点も軌跡として読み込む
+        raw_trajectories = trajectories
+        if "raw_offsets" in arrays:
+            raw_trajectories = TrajectoryStore()
+            raw_trajectories.load_sorted(trajectories.user_keys, arrays["raw_offsets"], arrays["raw_lon"],
+                                         arrays["raw_lat"], arrays["raw_times"])
+            raw_trajectories.freeze()
+
+        time_order = arrays["time_order"]
+        keys = trajectories.user_keys
+        df = pd.DataFrame({
+            "userid": pd.Categorical.from_codes(raw_trajectories.point_user()[time_order], categories=pd.Index(keys, dtype=object)),
+            "datetime": raw_trajectories.times[time_order].astype("datetime64[s]"),
+            "latitude": raw_trajectories.lat[time_order],
+            "longitude": raw_trajectories.lon[time_order]
+        })
+
+        df_new = pd.DataFrame(keys, columns=["newid"])
+        df_new.index = range(1, len(df_new) + 1)
+        return Dataset(trajectories, grid_index, df, df_new, raw_trajectories)
+
+    def use_dataset(self, dataset):
+        self.release_dataset()
+        self.dataset = dataset
+        self.trajectories = dataset.trajectories
+        self.raw_trajectories = dataset.raw_trajectories
+        self.grid_index = dataset.grid_index
+        self.df = dataset.df
+        self.df_new = dataset.df_new
+
+        self.sorted_df = self.df
+        self.selected_users = np.arange(len(self.trajectories), dtype=np.int64)
+        self.window = None
+
+    def release_dataset(self):
+        if self.release is not None:
+            self.release()
+            self.release = None
+
+    def clear_data(self):
+        self.release_dataset()
+        self.dataset = None
+        self.df = pd.DataFrame()
+        self.df_new = pd.DataFrame()
+        self.sorted_df = pd.DataFrame()
+        self.trajectories = TrajectoryStore()
+        self.raw_trajectories = self.trajectories
+        self.grid_index = None
+        self.selected_users = np.zeros(0, dtype=np.int64)
+        self.window = None
 
-    def select_data(self, selected_values):
-        if len(selected_values) == 0:
+    def select_data(self, selected_values, window=None):
+        # ユーザーごとの要約表で絞り込み、選ばれたユーザーの点の範囲だけを取り出す
+        # 表示・ダウンロードするデータフレームは前処理の前の点から作る
+        self.selected_users = self.trajectories.select(selected_values, window)
+        self.window = window
+        if len(selected_values) == 0 and window is None:
             self.sorted_df = self.df
         else:
-            self.sorted_df = self.df[self.df.iloc[:, 0].isin(selected_values)]
-            self.sorted_df = self.sorted_df.reset_index(drop=True)
-            self.sorted_df.sort_values(by=[self.sorted_df.columns[1]], inplace=True)
+            self.sorted_df = self.raw_trajectories.frame(self.selected_users, window)
 
     def make_line_features(self, kiseki):
-        for itr, group in self.sorted_df.groupby(self.sorted_df.columns[0]):
-            rows = list(group.iterrows())
-            for i, (index, zahyou) in enumerate(rows):
-                if i < len(rows) - 1:
-                    next_index, next_zahyou = rows[i + 1]
-                    if kiseki:
-                        self.kiseki_data[str(itr)].append(
-                            {'座標': [[zahyou["longitude"], zahyou["latitude"]], [next_zahyou["longitude"], next_zahyou["latitude"]]], '日時': datetime.strptime(str(zahyou["datetime"]), '%Y-%m-%d %H:%M:%S').strftime('%Y/%m/%d %H:%M')})
-                    else:
-                        pass
+        if kiseki:
+            self.cross_manager.load(self.trajectories, self.grid_index)
+            self.parallel_manager.load(self.trajectories, self.grid_index)
+            self.zone_manager.load(self.trajectories)
+            self.playback_manager.load(self.trajectories, self.dataset)
+            self.stay_manager.load(self.trajectories, self.dataset)
@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+# 使っているセッションがなくなったデータを、次に開かれるときのために残しておく数
+MAX_IDLE_DATASETS = 2
+
+
+class Dataset:
+    # 読み込んだデータ一式。セッションの間で共有するので書き換えない
+    # raw_trajectoriesは前処理をする前の軌跡（前処理をしていなければtrajectoriesと同じ）
+    def __init__(self, trajectories, grid_index, df, df_new, raw_trajectories=None):
+        self.trajectories = trajectories
+        self.grid_index = grid_index
+        self.df = df
+        self.df_new = df_new
+        self.raw_trajectories = trajectories if raw_trajectories is None else raw_trajectories
+        self.lock = threading.Lock()
+        self.derived = dict()
+
+    def derive(self, key, builder):
+        # 読み込みのあとで必要になったときに初めて求める値（再生のフレームなど）。求めた値はセッションの間で共有する
+        with self.lock:
+            if key not in self.derived:
+                self.derived[key] = builder()
+            return self.derived[key]
+
+
+class DatasetEntry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dataset = None
+        self.refs = 0
+
+
+class DatasetRegistry:
+    # プロセス全体で1つだけ作り（st.cache_resource）、同じCSVを開いたセッションに同じデータを渡す
+    def __init__(self, max_idle=MAX_IDLE_DATASETS):
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def acquire(self, key, loader):
+        # 参照数を増やしてからデータを返す。まだなければloaderで読み込む（同じキーの読み込みは1回だけ）
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = DatasetEntry()
+            entry.refs += 1
+            self.entries.move_to_end(key)
+
+        with entry.lock:
+            if entry.dataset is None:
+                try:
+                    entry.dataset = loader()
+                except Exception:
+                    self.release(key)
+                    raise
+        return entry.dataset
+
+    def release(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.refs -= 1
+            self.evict()
+
+    def evict(self):
+        # 使われていないデータは、最後に使われたものからmax_idle個だけ残す
+        idle = [key for key, entry in self.entries.items() if entry.refs <= 0]
+        for key in idle[:max(len(idle) - self.max_idle, 0)]:
+            del self.entries[key]
+
@@ -0,0 +1,104 @@
+import math
+import numpy as np
+
+# 1本の線分が登録されるセルの上限（これを超える長い線分は常に候補にする）
+MAX_CELLS_PER_SEGMENT = 16
+# 検索範囲の列数がこれを超えるときは全線分を候補にする
+MAX_QUERY_COLUMNS = 4096
+
+
+class GridIndex:
+    def __init__(self, x1, y1, x2, y2, valid=None, cell_size=None, state=None):
+        self.min_x, self.max_x = np.minimum(x1, x2), np.maximum(x1, x2)
+        self.min_y, self.max_y = np.minimum(y1, y2), np.maximum(y1, y2)
+        if state is not None:
+            # 保存しておいたグリッドをそのまま使う
+            self.set_state(state)
+            return
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.items = np.zeros(0, dtype=np.int64)
+        self.large = np.zeros(0, dtype=np.int64)
+        self.origin_x, self.origin_y = 0.0, 0.0
+        self.cell_size = 1.0
+        self.n_columns, self.n_rows = 0, 0
+
+        # validがFalseの線分は登録しない
+        self.indexed = np.arange(len(self.min_x)) if valid is None else np.flatnonzero(valid)
+        if len(self.indexed) == 0:
+            return
+
+        min_x, max_x = self.min_x[self.indexed], self.max_x[self.indexed]
+        min_y, max_y = self.min_y[self.indexed], self.max_y[self.indexed]
+        self.origin_x, self.origin_y = float(min_x.min()), float(min_y.min())
+        if cell_size is None:
+            # 線分の典型的な長さの2倍をセルの大きさにする
+            cell_size = 2 * float(np.median(np.maximum(max_x - min_x, max_y - min_y)))
+            if cell_size <= 0:
+                span = max(float(max_x.max()) - self.origin_x, float(max_y.max()) - self.origin_y)
+                cell_size = span / math.sqrt(len(self.indexed)) if span > 0 else 1.0
+        self.cell_size = cell_size
+
+        ix0 = np.floor((min_x - self.origin_x) / cell_size).astype(np.int64)
+        ix1 = np.floor((max_x - self.origin_x) / cell_size).astype(np.int64)
+        iy0 = np.floor((min_y - self.origin_y) / cell_size).astype(np.int64)
+        iy1 = np.floor((max_y - self.origin_y) / cell_size).astype(np.int64)
+        self.n_columns, self.n_rows = int(ix1.max()) + 1, int(iy1.max()) + 1
+
+        # 線分が重なるセルを全て列挙する
+        nx, ny = ix1 - ix0 + 1, iy1 - iy0 + 1
+        cells = nx * ny
+        small = cells <= MAX_CELLS_PER_SEGMENT
+        self.large = self.indexed[~small]
+
+        seg = np.repeat(np.flatnonzero(small), cells[small])
+        local = np.arange(len(seg)) - np.repeat(np.cumsum(cells[small]) - cells[small], cells[small])
+        cell_x = ix0[seg] + local // ny[seg]
+        cell_y = iy0[seg] + local % ny[seg]
+
+        # セル番号順に並べて疎なグリッドにする
+        keys = cell_x * self.n_rows + cell_y
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.items = self.indexed[seg[order]]
+
+    def state(self):
+        # グリッドを作り直さずに復元するための配列
+        return {
+            "keys": self.keys,
+            "items": self.items,
+            "large": self.large,
+            "indexed": self.indexed,
+            "params": np.array([self.origin_x, self.origin_y, self.cell_size, self.n_columns, self.n_rows], dtype=np.float64)
+        }
+
+    def set_state(self, state):
+        self.keys, self.items = state["keys"], state["items"]
+        self.large, self.indexed = state["large"], state["indexed"]
+        origin_x, origin_y, cell_size, n_columns, n_rows = state["params"].tolist()
+        self.origin_x, self.origin_y, self.cell_size = origin_x, origin_y, cell_size
+        self.n_columns, self.n_rows = int(n_columns), int(n_rows)
+
+    def query(self, min_x, min_y, max_x, max_y):
+        # 外接矩形が検索範囲と重なる線分の番号を昇順で返す
+        if len(self.indexed) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        ix0 = max(math.floor((min_x - self.origin_x) / self.cell_size), 0)
+        ix1 = min(math.floor((max_x - self.origin_x) / self.cell_size), self.n_columns - 1)
+        iy0 = max(math.floor((min_y - self.origin_y) / self.cell_size), 0)
+        iy1 = min(math.floor((max_y - self.origin_y) / self.cell_size), self.n_rows - 1)
+
+        if ix1 - ix0 + 1 > MAX_QUERY_COLUMNS:
+            candidates = self.indexed
+        else:
+            parts = [self.large]
+            if ix0 <= ix1 and iy0 <= iy1:
+                columns = np.arange(ix0, ix1 + 1, dtype=np.int64) * self.n_rows
+                lows = np.searchsorted(self.keys, columns + iy0, side="left")
+                highs = np.searchsorted(self.keys, columns + iy1, side="right")
+                parts.extend(self.items[low:high] for low, high in zip(lows, highs) if low < high)
+            candidates = np.unique(np.concatenate(parts))
+
+        overlap = (self.max_x[candidates] >= min_x) & (self.min_x[candidates] <= max_x)
+        overlap &= (self.max_y[candidates] >= min_y) & (self.min_y[candidates] <= max_y)
+        return candidates[overlap]
@@ -0,0 +1,145 @@
+import weakref
+
+import numpy as np
+
+# このズームレベル未満では軌跡の代わりにヒートマップを表示する
+HEATMAP_ZOOM = 13
+# 1回の描画で地図に送る頂点数の上限
+MAX_VERTICES = 50000
+# 地図の最大ズーム。これより細かい曲がりはどのズームでも描画に影響しない
+MAX_ZOOM = 18
+
+
+def degrees_per_pixel(zoom):
+    # ズーム0で世界全体（360度）が256ピクセル
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def retention_tolerances(x, y, tolerance=0.0):
+    # Douglas-Peuckerを1回だけ行い、点ごとに「許容誤差がこの値未満なら残る」値を返す
+    # 点が残るのは分割の経路上の距離がすべて許容誤差を超えるときなので、経路上の最小値になる
+    # tolerance以下の距離では分割しない（その先の点はどの許容誤差でも残らないので0のまま）
+    n_points = len(x)
+    retention = np.zeros(n_points, dtype=np.float64)
+    if n_points == 0:
+        return retention
+    retention[0] = retention[-1] = np.inf
+
+    stack = [(0, n_points - 1, np.inf)]
+    while stack:
+        start, end, limit = stack.pop()
+        if end - start < 2:
+            continue
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        norm = np.hypot(dx, dy)
+        dist = np.hypot(px, py) if norm == 0 else np.abs(dx * py - dy * px) / norm
+
+        farthest = int(np.argmax(dist))
+        if dist[farthest] > tolerance:
+            mid = start + 1 + farthest
+            retention[mid] = min(dist[farthest], limit)
+            stack.append((start, mid, retention[mid]))
+            stack.append((mid, end, retention[mid]))
+    return retention
+
+
+def douglas_peucker(x, y, tolerance):
+    # 残す点の番号を返す
+    return np.flatnonzero(retention_tolerances(x, y, tolerance) > tolerance)
+
+
+class LodManager:
+    def __init__(self, max_vertices=MAX_VERTICES, heatmap_zoom=HEATMAP_ZOOM):
+        self.max_vertices = max_vertices
+        self.heatmap_zoom = heatmap_zoom
+        self.source = None
+        self.window = None
+        self.cache = dict()
+
+    def use_heatmap(self, zoom):
+        return zoom < self.heatmap_zoom
+
+    def visible_users(self, trajectories, users, bounds):
+        # 外接矩形が表示範囲と重なるユーザーだけを残す（外接矩形は読み込み時に求めてある）
+        users = np.asarray(users, dtype=np.int64)
+        if bounds is None or len(users) == 0 or len(trajectories.lon) == 0:
+            return users
+        return users[trajectories.in_bounds(bounds)[users]]
+
+    def retentions(self, trajectories, users, window=None):
+        # 点ごとの値はズームに依らないので、データと表示期間が同じ間はユーザーごとに1回だけ求めて使い回す
+        source = self.source() if self.source is not None else None
+        if source is not trajectories or self.window != window:
+            self.source = weakref.ref(trajectories)
+            self.window = window
+            self.cache = dict()
+
+        tolerance = degrees_per_pixel(MAX_ZOOM)
+        parts = []
+        for user in users:
+            user = int(user)
+            if user not in self.cache:
+                part = trajectories.user_slice(user, window)
+                self.cache[user] = (part, retention_tolerances(trajectories.lon[part], trajectories.lat[part], tolerance))
+            part, retention = self.cache[user]
+            if part.start < part.stop:
+                parts.append((user, part, retention))
+        return parts
+
+    def simplify(self, trajectories, users, zoom, window=None):
+        # 1ピクセル未満の曲がりを省き、頂点数が上限を超えるときは上限に収まるまで許容誤差を広げる
+        tolerance = degrees_per_pixel(zoom)
+        parts = self.retentions(trajectories, users, window)
+
+        # 点ごとの値の大きい方から上限の数だけ残るように許容誤差を1回で決める
+        values = np.concatenate([retention for user, part, retention in parts]) if parts else np.zeros(0)
+        if np.count_nonzero(values > tolerance) > self.max_vertices:
+            tolerance = max(tolerance, np.partition(values, len(values) - self.max_vertices - 1)[len(values) - self.max_vertices - 1])
+
+        kept = dict()
+        total = 0
+        for user, part, retention in parts:
+            # 許容誤差を広げきっても収まらないときは、上限に達するまでのユーザーの端点だけ描画する
+            idx = np.flatnonzero(np.isinf(retention) if np.isinf(tolerance) else retention > tolerance)
+            total += len(idx)
+            if total > self.max_vertices:
+                break
+            kept[int(user)] = idx + part.start
+        return kept
+
+    def points(self, trajectories, users, window=None):
+        # 時刻つきの点は間引くとアニメーションから点が消えるので、ユーザー単位で上限までそのまま返す
+        kept = dict()
+        total = 0
+        for user in users:
+            part = trajectories.user_slice(int(user), window)
+            if part.start >= part.stop:
+                continue
+            total += part.stop - part.start
+            if total > self.max_vertices:
+                break
+            kept[int(user)] = np.arange(part.start, part.stop)
+        return kept
+
+    def heatmap(self, trajectories, users, zoom, bounds, window=None):
+        # 点を画面上の数ピクセル四方のセルに集計して [緯度, 経度, 点数] のリストにする
+        mask = np.zeros(len(trajectories), dtype=bool)
+        mask[np.asarray(users, dtype=np.int64)] = True
+        points = mask[trajectories.point_user()]
+        if window is not None:
+            points &= (trajectories.times >= window[0]) & (trajectories.times <= window[1])
+        if bounds is not None:
+            (south, west), (north, east) = bounds
+            points &= (trajectories.lon >= west) & (trajectories.lon <= east)
+            points &= (trajectories.lat >= south) & (trajectories.lat <= north)
+
+        cell_size = 4 * degrees_per_pixel(zoom)
+        cells = np.stack((np.floor(trajectories.lat[points] / cell_size),
+                          np.floor(trajectories.lon[points] / cell_size)), axis=1)
+        cells, counts = np.unique(cells, axis=0, return_counts=True)
+        if len(counts) > self.max_vertices:
+            top = np.argsort(counts)[-self.max_vertices:]
+            cells, counts = cells[top], counts[top]
+        centers = (cells + 0.5) * cell_size
+        return np.column_stack((centers, counts / max(counts.max(), 1) if len(counts) else counts)).tolist()
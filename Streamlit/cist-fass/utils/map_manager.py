@@ -1,8 +1,10 @@
-import streamlit as st
 from streamlit_folium import st_folium
 import folium
-from folium.plugins import TimestampedGeoJson
+from folium.plugins import TimestampedGeoJson, HeatMap
+import numpy as np
 import json
+from utils.cross_manager import gate_key, gate_coordinates
+from utils.lod_manager import LodManager
 
 class MapManager:
     def __init__(self):
@@ -12,33 +14,70 @@ class MapManager:
         self.draw.add_to(self.map)
         self.center = {"lat": 42.79355312, "lng": 141.695872412}
         self.zoom_level = 16
+        self.bounds = None
+        self.lod_manager = LodManager()
         self.draw_data = []
         self.gate_data = []
         self.tuuka_list = []
         self.selected_shape = []
         self.selected_shape_type = "ゲート情報"
         self.kiseki_flag = False
+        self.playback_flag = False
+        self.playback_frame = 0
+        self.playback_layer = None
+        self.stay_flag = False
+        self.stay_layer = None
         self.line_geojson = None
+        self.gate_layers = dict()
 
     def display_map(self, width=800, height=800):
         st_data = st_folium(self.map, width=width, height=height, zoom=self.zoom_level, center=self.center)
         return dict(st_data)
 
+    def update_view(self, st_data):
+        try:
+            zoom = st_data["zoom"]
+            south_west, north_east = st_data["bounds"]["_southWest"], st_data["bounds"]["_northEast"]
+            # 少しパンしても軌跡が途切れないように表示範囲を半分ずつ広げる
+            pad_lat = (north_east["lat"] - south_west["lat"]) / 2
+            pad_lng = (north_east["lng"] - south_west["lng"]) / 2
+            bounds = ((south_west["lat"] - pad_lat, south_west["lng"] - pad_lng),
+                      (north_east["lat"] + pad_lat, north_east["lng"] + pad_lng))
+            center = {"lat": st_data["center"]["lat"], "lng": st_data["center"]["lng"]}
+        except (KeyError, TypeError):
+            return False
+
+        changed = (zoom, bounds) != (self.zoom_level, self.bounds)
+        self.zoom_level, self.bounds, self.center = zoom, bounds, center
+        return changed
+
+    def refresh_lod(self, data_manager):
+        if len(data_manager.df) == 0:
+            return
+        self.add_points_layer(data_manager)
+        if self.kiseki_flag:
+            self.polylines_maker(data_manager)
+
+    def selected_users(self, data_manager):
+        return self.lod_manager.visible_users(data_manager.trajectories, data_manager.selected_users, self.bounds)
+
     def features_maker(self, data_manager):
         features = []
-        max_id_length = max(len(str(user_id)) for user_id in data_manager.sorted_df["userid"].unique())
+        trajectories = data_manager.trajectories
+        users = self.selected_users(data_manager)
+        max_id_length = max((len(trajectories.user_keys[user]) for user in users), default=0)
         popup_width = max_id_length * 14
 
-        for user_id, user_data in data_manager.sorted_df.groupby("userid"):
-            popup_html = f'<div style="font-size: 14px; font-weight: bold; width: {int(popup_width)}px; height: 15px; color: black;">UserID：{user_id}</div>'
+        for user, idx in self.lod_manager.points(trajectories, users, data_manager.window).items():
+            popup_html = f'<div style="font-size: 14px; font-weight: bold; width: {int(popup_width)}px; height: 15px; color: black;">UserID：{trajectories.user_keys[user]}</div>'
             feature = {
                 "type": "Feature",
                 "geometry": {
                     "type": "MultiPoint",
-                    "coordinates": user_data[['longitude', 'latitude']].values.tolist()
+                    "coordinates": np.column_stack((trajectories.lon[idx], trajectories.lat[idx])).tolist()
                 },
                 "properties": {
-                    "times": user_data["datetime"].dt.strftime("%Y-%m-%dT%H:%M:%S").tolist(),
+                    "times": np.datetime_as_string(trajectories.times[idx].astype("datetime64[s]")).tolist(),
                     "icon": "circle",
                     "iconstyle": {
                         "color": "#4169e1",
@@ -52,6 +91,13 @@ class MapManager:
             features.append(feature)
         return features
 
+    def add_points_layer(self, data_manager):
+        # 再生モードでは現在のフレームの点だけを地図に送る
+        if self.playback_flag:
+            self.add_playback_frame(data_manager)
+        else:
+            self.add_timestamped_geojson(data_manager)
+
     def add_timestamped_geojson(self, data_manager):
         features = self.features_maker(data_manager)
         geojson = {"type": "FeatureCollection", "features": features}
@@ -64,104 +110,115 @@ class MapManager:
             transition_time=500
         )
 
+        self.remove_points_layers()
+        timestamped_geojson.add_to(self.map)
+
+    def add_playback_frame(self, data_manager, frame=None):
+        trajectories = data_manager.trajectories
+        playback_manager = data_manager.playback_manager
+        if frame is not None:
+            self.playback_frame = frame
+        # 期間で絞り込んでいるときはその期間のフレームだけを再生する
+        first, last = playback_manager.frame_range(data_manager.window)
+        self.playback_frame = int(np.clip(self.playback_frame, first, last))
+        points, age = playback_manager.frame(self.playback_frame, self.selected_users(data_manager))
+        users = np.searchsorted(trajectories.offsets, points, side="right") - 1
+
+        features = []
+        for idx, (point, user, point_age) in enumerate(zip(points.tolist(), users.tolist(), age.tolist())):
+            features.append({
+                "type": "Feature",
+                "id": idx,
+                "geometry": {"type": "Point", "coordinates": [trajectories.lon[point], trajectories.lat[point]]},
+                "properties": {"userid": trajectories.user_keys[user], "age": point_age}
+            })
+
+        # 前のフレームほど小さく薄く表示する
+        trail = playback_manager.trail_frames + 1
+        layer = folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            marker=folium.CircleMarker(radius=3, color="#4169e1", fill_color="#01bfff", weight=2),
+            style_function=lambda feature: {
+                "radius": 3 if feature["properties"]["age"] == 0 else 2,
+                "opacity": 1 - feature["properties"]["age"] / trail,
+                "fillOpacity": 0.9 * (1 - feature["properties"]["age"] / trail)
+            },
+            tooltip=folium.GeoJsonTooltip(fields=["userid"], aliases=["UserID："])
+        )
+
+        self.remove_points_layers()
+        layer.add_to(self.map)
+        self.playback_layer = layer
+
+    def remove_points_layers(self):
         layers_to_remove = []
         for key, value in self.map._children.items():
             if isinstance(value, TimestampedGeoJson):
                 layers_to_remove.append(key)
         for key in layers_to_remove:
             del self.map._children[key]
-
-        timestamped_geojson.add_to(self.map)
+        if self.playback_layer is not None:
+            self.map._children.pop(self.playback_layer.get_name(), None)
+            self.playback_layer = None
 
     def polylines_maker(self, data_manager):
-        max_id_length = max(len(str(user_id)) for user_id in data_manager.sorted_df["userid"].unique())
+        self.remove_kiseki_layers()
+        trajectories = data_manager.trajectories
+        users = self.selected_users(data_manager)
+
+        if self.lod_manager.use_heatmap(self.zoom_level):
+            HeatMap(self.lod_manager.heatmap(trajectories, users, self.zoom_level, self.bounds, data_manager.window),
+                    radius=12, blur=15, min_opacity=0.3).add_to(self.map)
+            return
+
+        max_id_length = max((len(trajectories.user_keys[user]) for user in users), default=0)
         popup_width = max_id_length * 14
 
-        for user_id, user_data in data_manager.sorted_df.groupby("userid"):
-            popup_html = f'<div style="font-size: 14px; font-weight: bold; width: {int(popup_width)}px; height: 15px; color: black;">UserID：{user_id}</div>'
-            folium.PolyLine(locations=user_data[['latitude', 'longitude']].values.tolist(), color='#01bfff', weight=3, opacity=0.9,
+        for user, idx in self.lod_manager.simplify(trajectories, users, self.zoom_level, data_manager.window).items():
+            popup_html = f'<div style="font-size: 14px; font-weight: bold; width: {int(popup_width)}px; height: 15px; color: black;">UserID：{trajectories.user_keys[user]}</div>'
+            folium.PolyLine(locations=np.column_stack((trajectories.lat[idx], trajectories.lon[idx])).tolist(), color='#01bfff', weight=3, opacity=0.9,
                             popup=folium.Popup(popup_html)).add_to(self.map)
 
-    def add_shape_data(self, data_manager):
+    def remove_kiseki_layers(self):
         line_layers_to_remove = []
         for key, value in self.map._children.items():
-            if isinstance(value, folium.features.GeoJson):
+            if isinstance(value, (folium.vector_layers.PolyLine, HeatMap)):
                 line_layers_to_remove.append(key)
         for key in line_layers_to_remove:
             del self.map._children[key]
 
-        gate_append_list = []
-        for idx, sdata in enumerate(self.draw_data):
-            if sdata["geometry"]["coordinates"][0][0] == sdata["geometry"]["coordinates"][0][-1]:
-                gate_append_list.append(sdata["geometry"]["coordinates"][0])
-            else:
-                gate_append_list.append(sdata["geometry"]["coordinates"])
-
-        self.gate_data = gate_append_list
+    def add_shape_data(self, data_manager):
+        self.gate_data = [gate_coordinates(sdata) for sdata in self.draw_data]
 
         self.tuuka_list = [dict() for _ in range(len(self.draw_data))]
+        if len(data_manager.df_new) != 0:
+            self.tuuka_list = data_manager.cross_manager.judge_all(self.gate_data, data_manager.parallel_manager)
 
-        for idx, sdata in enumerate(self.draw_data):
-            if len(data_manager.df_new) != 0:
-                for idx1, gates in enumerate(self.gate_data):
-                    for key, values in data_manager.kiseki_data.items():
-                        if gates[0] == gates[-1]:
-                            if self.ingate(values[0]["座標"][0], gates):
-                                self.tuuka_list[idx1][key] = values[0]["日時"]
-                                continue
-                        kekka = self.cross_judge(gates, values)
-                        if kekka[0]:
-                            self.tuuka_list[idx1][key] = values[kekka[1]]["日時"]
-                            continue
-
-                tooltip_html = f'<div style="font-size: 16px;">gateid：{idx + 1}</div>'
-                popup_html = f'<div style="font-size: 16px; font-weight: bold; width: 110px; height: 20px;  color: #27b9cc;">通過人数：{len(self.tuuka_list[idx])}人</div>'
-                folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html)).add_to(self.map)
+        self.update_gate_layers(len(data_manager.df_new) != 0)
 
+    def update_gate_layers(self, show_count):
+        wanted = dict()
+        for idx, sdata in enumerate(self.draw_data):
+            count = len(self.tuuka_list[idx]) if show_count else None
+            wanted[gate_key(self.gate_data[idx])] = (idx, count, sdata)
+
+        for key in list(self.gate_layers.keys()):
+            layer, label = self.gate_layers[key]
+            if key not in wanted or wanted[key][:2] != label:
+                self.map._children.pop(layer.get_name(), None)
+                del self.gate_layers[key]
+
+        for key, (idx, count, sdata) in wanted.items():
+            if key in self.gate_layers:
+                continue
+            tooltip_html = f'<div style="font-size: 16px;">gateid：{idx + 1}</div>'
+            if count is not None:
+                popup_html = f'<div style="font-size: 16px; font-weight: bold; width: 110px; height: 20px;  color: #27b9cc;">通過人数：{count}人</div>'
+                layer = folium.GeoJson(sdata, tooltip=tooltip_html, popup=folium.Popup(popup_html))
             else:
-                tooltip_html = f'<div style="font-size: 16px;">gateid：{idx + 1}</div>'
-                folium.GeoJson(sdata, tooltip=tooltip_html).add_to(self.map)
-
-    def max_min_cross(self, p1, p2, p3, p4):
-        min_ab, max_ab = min(p1, p2), max(p1, p2)
-        min_cd, max_cd = min(p3, p4), max(p3, p4)
-
-        if min_ab > max_cd or max_ab < min_cd:
-            return False
-
-        return True
-
-    def cross_judge(self, gates, values):
-        flag = False
-        idx = -1
-        for idx1 in range(len(gates) - 1):
-            line1 = [(gates[idx1][0], gates[idx1][1]), (gates[idx1 + 1][0], gates[idx1 + 1][1])]
-            for idx2 in range(len(values)):
-                line2 = [(values[idx2]["座標"][0][0], values[idx2]["座標"][0][1]), (values[idx2]["座標"][1][0], values[idx2]["座標"][1][1])]
-                (a, b, c, d) = (line1[0], line1[1], line2[0], line2[1])
-
-                if not self.max_min_cross(a[0], b[0], c[0], d[0]):
-                    continue
-
-                if not self.max_min_cross(a[1], b[1], c[1], d[1]):
-                    continue
-
-                tc1 = (a[0] - b[0]) * (c[1] - a[1]) + (a[1] - b[1]) * (a[0] - c[0])
-                tc2 = (a[0] - b[0]) * (d[1] - a[1]) + (a[1] - b[1]) * (a[0] - d[0])
-                td1 = (c[0] - d[0]) * (a[1] - c[1]) + (c[1] - d[1]) * (c[0] - a[0])
-                td2 = (c[0] - d[0]) * (b[1] - c[1]) + (c[1] - d[1]) * (c[0] - b[0])
-                if tc1 * tc2 <= 0 and td1 * td2 <= 0:
-                    flag = True
-                    idx = idx2
-                    break
-            if flag:
-                break
-        return (flag, idx)
-
-    def ingate(self, plot_point, gate_polygon):
-        point = Feature(geometry=Point(plot_point))
-        polygon = Polygon([gate_polygon])
-        return boolean_point_in_polygon(point, polygon)
+                layer = folium.GeoJson(sdata, tooltip=tooltip_html)
+            layer.add_to(self.map)
+            self.gate_layers[key] = (layer, (idx, count))
 
     def select_shape(self, shape_id):
         if shape_id != "":
@@ -178,48 +235,69 @@ class MapManager:
             self.selected_shape_type = "ゲート情報"
             self.selected_shape = []
 
-    def delete_shape(self, shape_id):
+    def delete_shape(self, shape_id, data_manager):
         if shape_id != "":
             delete_shape_id = int(shape_id)
             delete_shape = self.draw_data[delete_shape_id - 1]
 
-            keys_to_remove = []
-            for key, value in self.map._children.items():
-                if isinstance(value, folium.features.GeoJson) and value.data == delete_shape:
-                    keys_to_remove.append(key)
-
-            for key in keys_to_remove:
-                del self.map._children[key]
-
             self.draw_data.remove(delete_shape)
-            self.gate_data.pop(delete_shape_id - 1)
+            gates = self.gate_data.pop(delete_shape_id - 1)
+            data_manager.cross_manager.forget(gates)
+            data_manager.zone_manager.forget(gates)
             if len(self.tuuka_list) != 0:
                 self.tuuka_list.pop(delete_shape_id - 1)
             if len(self.selected_shape) != 0:
                 self.selected_shape.pop(delete_shape_id - 1)
 
-            self.add_shape_data(data_manager)
+            self.update_gate_layers(len(data_manager.df_new) != 0)
 
-    def add_draw_data(self, data_manager):
-        if self.draw_data is not None and isinstance(self.draw_data, list) and len(self.draw_data) > 0:
-            if "last_circle_polygon" in st.session_state["data"] and st.session_state["data"]["last_circle_polygon"] is not None:
-                self.draw_data[0]["geometry"]["type"] = "Polygon"
-                self.draw_data[0]["geometry"]["coordinates"] = st.session_state["data"]["last_circle_polygon"]["coordinates"]
-                center_list = st.session_state["data"]["last_active_drawing"]["geometry"]["coordinates"]
+    def add_draw_data(self, st_data, data_manager):
+        all_drawings = st_data["all_drawings"]
+        if all_drawings is not None and isinstance(all_drawings, list) and len(all_drawings) > 0:
+            if "last_circle_polygon" in st_data and st_data["last_circle_polygon"] is not None:
+                all_drawings[0]["geometry"]["type"] = "Polygon"
+                all_drawings[0]["geometry"]["coordinates"] = st_data["last_circle_polygon"]["coordinates"]
+                center_list = st_data["last_active_drawing"]["geometry"]["coordinates"]
                 center_dict = {"lat": center_list[0], "lng": center_list[1]}
-                self.draw_data[0]["properties"]["center"] = center_dict
+                all_drawings[0]["properties"]["center"] = center_dict
 
-            if self.draw_data[0] not in self.draw_data or len(self.draw_data) == 0:
-                self.draw_data.append(self.draw_data[0])
+            if all_drawings[0] not in self.draw_data or len(self.draw_data) == 0:
+                self.draw_data.append(all_drawings[0])
                 self.add_shape_data(data_manager)
 
-    def toggle_kiseki(self):
+    def toggle_playback(self, data_manager):
+        if len(data_manager.df) != 0:
+            self.add_points_layer(data_manager)
+
+    def add_stay_layer(self, stays):
+        # 滞在地点を滞在時間が長いほど大きな円で表示する（多いときは長いものから上限まで）
+        self.remove_stay_layer()
+        stays = stays.nlargest(self.lod_manager.max_vertices, "minutes") if len(stays) > self.lod_manager.max_vertices else stays
+        features = []
+        for idx, row in enumerate(stays.itertuples(index=False)):
+            features.append({
+                "type": "Feature",
+                "id": idx,
+                "geometry": {"type": "Point", "coordinates": [row.longitude, row.latitude]},
+                "properties": {"userid": str(row.userid), "minutes": round(float(row.minutes)),
+                               "start": str(row.start), "end": str(row.end)}
+            })
+        self.stay_layer = folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            marker=folium.CircleMarker(radius=4, color="#ff8c00", fill_color="#ffa500", weight=1),
+            style_function=lambda feature: {"radius": 4 + min(feature["properties"]["minutes"] / 30, 12), "fillOpacity": 0.6},
+            tooltip=folium.GeoJsonTooltip(fields=["userid", "minutes", "start", "end"],
+                                          aliases=["UserID：", "滞在時間[分]：", "開始：", "終了："])
+        )
+        self.stay_layer.add_to(self.map)
+
+    def remove_stay_layer(self):
+        if self.stay_layer is not None:
+            self.map._children.pop(self.stay_layer.get_name(), None)
+            self.stay_layer = None
+
+    def toggle_kiseki(self, data_manager):
         if self.kiseki_flag:
             self.polylines_maker(data_manager)
         else:
-            line_layers_to_remove = []
-            for key, value in self.map._children.items():
-                if isinstance(value, folium.vector_layers.PolyLine):
-                    line_layers_to_remove.append(key)
-            for key in line_layers_to_remove:
-                del self.map._children[key]
+            self.remove_kiseki_layers()
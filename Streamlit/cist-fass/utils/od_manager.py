@@ -0,0 +1,67 @@
+import numpy as np
+from utils.cross_manager import gate_key
+
+
+class OdManager:
+    def __init__(self):
+        self.matrix = np.zeros((0, 0), dtype=np.int64)
+        self.origin = np.zeros(0, dtype=np.int64)
+        self.destination = np.zeros(0, dtype=np.int64)
+        self.travel = np.zeros(0, dtype=np.float64)
+        # 最後に集計したデータ（軌跡の時刻の配列）とゲートの組。同じなら集計し直さない
+        self.source = None
+        self.gate_keys = None
+
+    def update(self, cross_manager, gate_list):
+        gate_keys = tuple(gate_key(gates) for gates in gate_list)
+        if cross_manager.times is self.source and gate_keys == self.gate_keys:
+            return
+        self.source, self.gate_keys = cross_manager.times, gate_keys
+
+        # 全ゲートの交差イベントを線分の順（ユーザーごと・時刻順）、線分内では交差位置の順に並べる
+        # ゲートごとの交差はcross_managerにキャッシュされるので、追加されたゲートだけ判定される
+        n_gates = len(gate_list)
+        events = [cross_manager.crossings(gates) for gates in gate_list]
+        seg = np.concatenate([segs for segs, pos in events]) if events else np.zeros(0, dtype=np.int64)
+        pos = np.concatenate([pos for segs, pos in events]) if events else np.zeros(0, dtype=np.float64)
+        gate = np.repeat(np.arange(n_gates, dtype=np.int64), [len(segs) for segs, pos in events])
+        order = np.lexsort((gate, pos, seg))
+        seg, pos, gate = seg[order], pos[order], gate[order]
+        user = cross_manager.seg_user[seg]
+        # 交差した時刻は線分の両端の時刻から補間する
+        times = cross_manager.times[seg] + pos * (cross_manager.times[seg + 1] - cross_manager.times[seg])
+
+        # 同じゲートを続けて交差したとき（ポリゴンの出入りなど）は1回の通過にまとめる
+        new_run = np.ones(len(seg), dtype=bool)
+        new_run[1:] = (user[1:] != user[:-1]) | (gate[1:] != gate[:-1])
+        first = np.flatnonzero(new_run)
+        last = np.append(first[1:] - 1, len(seg) - 1)
+
+        # 同じユーザーの連続した通過をゲート間の移動とし、移動時間は前のゲートを最後に通過してから次のゲートまで
+        same_user = user[first[1:]] == user[first[:-1]]
+        self.origin = gate[first[:-1]][same_user]
+        self.destination = gate[first[1:]][same_user]
+        self.travel = times[first[1:]][same_user] - times[last[:-1]][same_user]
+        self.matrix = np.bincount(self.origin * n_gates + self.destination,
+                                  minlength=n_gates * n_gates).reshape(n_gates, n_gates)
+
+    def travel_times(self, origin, destination):
+        # 出発ゲートから到着ゲートまでの移動時間（秒）
+        return self.travel[(self.origin == origin) & (self.destination == destination)]
+
+    def display_travel_times(self, origin, destination):
+        # plotlyとStreamlitは表示するときだけ使う
+        import plotly.graph_objs as go
+        import streamlit as st
+
+        minutes = self.travel_times(origin, destination) / 60
+
+        fig = go.Figure(go.Histogram(x=minutes, name=f"図形{origin + 1}→図形{destination + 1}"))
+        layout = go.Layout(
+            title=f'図形{origin + 1}から図形{destination + 1}までの移動時間',
+            xaxis=dict(title='移動時間[分]'),
+            yaxis=dict(title='移動回数[回]', tickformat='d')
+        )
+        fig.update_layout(layout)
+
+        st.plotly_chart(fig)
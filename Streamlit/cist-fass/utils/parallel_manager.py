@@ -0,0 +1,175 @@
+import os
+import atexit
+import threading
+import weakref
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from utils.cross_manager import CrossManager
+from utils.grid_index import GridIndex
+from utils.trajectory_store import TrajectoryStore
+
+# 並列に判定するときのワーカー数
+WORKERS = os.cpu_count() or 1
+# これより点数が少ないデータはプロセスを起動する方が遅いので並列にしない
+MIN_POINTS = 200000
+# 共有メモリに置く軌跡の配列（格子は grid_ を付けた名前で一緒に置く）
+SHARED_ARRAYS = ("offsets", "lon", "lat", "times")
+# ワーカープロセスが読み込んだままにしておく軌跡の数（古いものから閉じる）
+WORKER_DATASETS = 2
+
+# ワーカープロセスごとの、共有メモリの名前をキーにした判定器と共有メモリ
+_worker = OrderedDict()
+
+# プロセス全体で1つだけ作るワーカーのプールと、軌跡ごとに1つだけ作る共有メモリ
+# 共有メモリは軌跡（同じCSVを開いたセッションで共有するデータ）が使われなくなったときに解放する
+_pool = dict()
+_shared = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _attach(specs):
+    # 共有メモリ上の配列をコピーせずに軌跡として読み込む（同じ軌跡は読み込み直さない）
+    key = tuple(shm_name for shm_name, shape, dtype in specs.values())
+    if key not in _worker:
+        shared, arrays = [], dict()
+        for name, (shm_name, shape, dtype) in specs.items():
+            shm = SharedMemory(name=shm_name)
+            shared.append(shm)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        store = TrajectoryStore()
+        store.load_sorted(arrays["user_keys"].tolist(), arrays["offsets"], arrays["lon"], arrays["lat"], arrays["times"])
+        # 格子も共有メモリから復元し、ワーカーごとに作り直さない
+        grid_index = None
+        state = {name[5:]: array for name, array in arrays.items() if name.startswith("grid_")}
+        if state:
+            grid_index = GridIndex(*store.segments(), state=state)
+        cross_manager = CrossManager()
+        cross_manager.load(store, grid_index)
+        _worker[key] = (shared, cross_manager)
+
+        while len(_worker) > WORKER_DATASETS:
+            shared, cross_manager = _worker.popitem(last=False)[1]
+            del cross_manager
+            for shm in shared:
+                try:
+                    shm.close()
+                except BufferError:
+                    # 配列がまだ残っているときは、プロセスの終了時に閉じる
+                    pass
+    _worker.move_to_end(key)
+    return _worker[key][1]
+
+
+def _evaluate(specs, gates, users):
+    return _attach(specs).evaluate(gates, users)
+
+
+def _unlink(shared):
+    for shm in shared:
+        shm.close()
+        shm.unlink()
+
+
+class SharedTrajectories:
+    # 1つの軌跡の配列（と格子）を置いた共有メモリ。軌跡がなくなったら解放する
+    def __init__(self, trajectories, grid_index=None):
+        self.shared = []
+        self.specs = dict()
+        arrays = {name: getattr(trajectories, name) for name in SHARED_ARRAYS}
+        arrays["user_keys"] = np.array(trajectories.user_keys, dtype=str)
+        if grid_index is not None:
+            arrays.update({"grid_" + name: array for name, array in grid_index.state().items()})
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+            self.shared.append(shm)
+            self.specs[name] = (shm.name, array.shape, array.dtype.str)
+        weakref.finalize(trajectories, _unlink, self.shared)
+
+
+def shared_specs(trajectories, grid_index=None):
+    # 軌跡の配列を共有メモリにコピーする（同じ軌跡は全てのセッションで1回だけ）
+    with _lock:
+        if trajectories not in _shared:
+            _shared[trajectories] = SharedTrajectories(trajectories, grid_index)
+        return _shared[trajectories].specs
+
+
+def executor(workers=WORKERS):
+    # Streamlitはスレッドを使うので、forkではなくspawnでワーカーを起動する
+    with _lock:
+        if "executor" not in _pool:
+            _pool["executor"] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _pool["executor"]
+
+
+def shutdown():
+    with _lock:
+        pool = _pool.pop("executor", None)
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+atexit.register(shutdown)
+
+
+class ParallelManager:
+    def __init__(self, workers=WORKERS, min_points=MIN_POINTS):
+        self.workers = workers
+        self.min_points = min_points
+        self.enabled = workers > 1
+        self.specs = dict()
+        self.trajectories = TrajectoryStore()
+        self.grid_index = None
+        self.user_keys = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def load(self, trajectories, grid_index=None):
+        # 共有メモリへのコピーは並列に判定するときまで遅らせる
+        self.close()
+        self.trajectories = trajectories
+        self.grid_index = grid_index
+        self.user_keys = list(trajectories.user_keys)
+        self.offsets = trajectories.offsets
+
+    def share(self):
+        self.specs = shared_specs(self.trajectories, self.grid_index)
+
+    def close(self):
+        # 共有メモリは軌跡と一緒に解放されるので、ここでは参照を手放すだけ
+        self.specs = dict()
+
+    def active(self):
+        return self.enabled and int(self.offsets[-1]) >= self.min_points
+
+    def user_blocks(self, n_blocks):
+        # 点数がほぼ等しくなるようにユーザーの番号を区切る
+        bounds = np.searchsorted(self.offsets, np.linspace(0, self.offsets[-1], n_blocks + 1), side="left")
+        bounds = np.unique(np.clip(bounds, 0, len(self.user_keys)))
+        bounds[0], bounds[-1] = 0, len(self.user_keys)
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    def evaluate(self, gate_list, cross_manager):
+        # ゲートの数がワーカー数より少ないときは、ゲートごとにユーザーを区切って分担する
+        if not self.active() or len(gate_list) == 0:
+            return [cross_manager.evaluate(gates) for gates in gate_list]
+
+        if len(self.specs) == 0:
+            self.share()
+        pool = executor(self.workers)
+
+        blocks = self.user_blocks(-(-self.workers // len(gate_list)))
+        futures = [[pool.submit(_evaluate, self.specs, gates, users) for users in blocks] for gates in gate_list]
+
+        # ユーザーの番号順に区切っているので、区切り順に結合すれば直列に判定したときと同じ順になる
+        results = []
+        for gate_futures in futures:
+            tuuka = dict()
+            for future in gate_futures:
+                tuuka.update(future.result())
+            results.append(tuuka)
+        return results
@@ -0,0 +1,91 @@
+import numpy as np
+from utils.trajectory_store import TrajectoryStore
+
+# 1フレームの長さ（秒）。TimestampedGeoJsonのperiod="PT1M"に合わせる
+FRAME_SECONDS = 60
+# 現在のフレームと一緒に表示する直前のフレーム数（移動の向きが分かるように残像として表示する）
+TRAIL_FRAMES = 5
+
+
+class PlaybackFrames:
+    # 点をフレームに振り分け、ユーザーとフレームごとに最後の点だけを残してフレーム順に並べたもの
+    # 点のあるフレームの番号(values)ごとに点の範囲(offsets)を持つので、点のないフレームの分の配列は作らない
+    def __init__(self, trajectories, frame_seconds):
+        times = trajectories.times
+        if len(times) == 0:
+            self.origin = 0
+            self.values = np.zeros(0, dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.points = np.zeros(0, dtype=np.int64)
+            return
+
+        self.origin = int(times.min()) // frame_seconds * frame_seconds
+        frames = (times - self.origin) // frame_seconds
+        users = trajectories.point_user()
+        # 軌跡はユーザーごと・時刻順に並んでいるので、次の点とユーザーかフレームが違えばその点が最後の点
+        last = np.ones(len(times), dtype=bool)
+        last[:-1] = (users[1:] != users[:-1]) | (frames[1:] != frames[:-1])
+        points = np.flatnonzero(last)
+        points = points[np.lexsort((users[points], frames[points]))]
+
+        point_frames = frames[points]
+        starts = np.flatnonzero(np.concatenate(([True], point_frames[1:] != point_frames[:-1])))
+        self.values = point_frames[starts].astype(np.int64)
+        self.offsets = np.append(starts, len(points)).astype(np.int64)
+        self.points = points
+
+
+class PlaybackManager:
+    def __init__(self, frame_seconds=FRAME_SECONDS, trail_frames=TRAIL_FRAMES):
+        self.frame_seconds = frame_seconds
+        self.trail_frames = trail_frames
+        self.load(TrajectoryStore())
+
+    def load(self, trajectories, dataset=None):
+        # フレームは再生モードで初めて使うときに作る。datasetを渡すと同じデータを開いたセッションと共有する
+        self.trajectories = trajectories
+        self.dataset = dataset
+        self.built = None
+
+    @property
+    def frames(self):
+        if self.built is None:
+            build = lambda: PlaybackFrames(self.trajectories, self.frame_seconds)
+            self.built = build() if self.dataset is None else self.dataset.derive(("playback", self.frame_seconds), build)
+        return self.built
+
+    def __len__(self):
+        values = self.frames.values
+        return int(values[-1]) + 1 if len(values) else 0
+
+    def frame_time(self, frame):
+        return self.frames.origin + int(frame) * self.frame_seconds
+
+    def frame_of(self, epoch):
+        return int(np.clip((int(epoch) - self.frames.origin) // self.frame_seconds, 0, max(len(self) - 1, 0)))
+
+    def frame_range(self, window=None):
+        # 再生できるフレームの範囲（期間で絞り込んでいればその期間）
+        if window is None:
+            return 0, max(len(self) - 1, 0)
+        return self.frame_of(window[0]), self.frame_of(window[1])
+
+    def frame(self, frame, users=None):
+        # 現在のフレームと残像のフレームの点の番号と、現在から何フレーム前の点か
+        # フレームの点は連続して並んでいるので、配列を切り出すだけで済む
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        frames = self.frames
+        frame = int(np.clip(frame, 0, len(self) - 1))
+        first = np.searchsorted(frames.values, frame - self.trail_frames)
+        stop = np.searchsorted(frames.values, frame, side="right")
+        offsets = frames.offsets[first:stop + 1]
+        points = frames.points[offsets[0]:offsets[-1]]
+        age = frame - np.repeat(frames.values[first:stop], np.diff(offsets))
+
+        if users is not None:
+            mask = np.zeros(len(self.trajectories), dtype=bool)
+            mask[np.asarray(users, dtype=np.int64)] = True
+            keep = mask[np.searchsorted(self.trajectories.offsets, points, side="right") - 1]
+            points, age = points[keep], age[keep]
+        return points, age
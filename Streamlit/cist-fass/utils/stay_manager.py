@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+from utils.clean_manager import EARTH_RADIUS
+from utils.trajectory_store import TrajectoryStore
+
+# 連続する点の間の距離がこれ以下なら、その間は止まっていたとみなす（メートル）
+STAY_DISTANCE = 30.0
+# 止まっていた時間がこれ以上続いたら滞在とする（秒）
+STAY_SECONDS = 15 * 60
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    # 2点間の大円距離（メートル）
+    lon1, lat1, lon2, lat2 = (np.radians(value) for value in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def step_distances(trajectories):
+    # 連続する点の間の距離（ユーザーの境目の線分はsegment_validで除く）
+    lon, lat = trajectories.lon, trajectories.lat
+    return haversine(lon[:-1], lat[:-1], lon[1:], lat[1:])
+
+
+class StayManager:
+    def __init__(self):
+        self.load(TrajectoryStore())
+
+    def load(self, trajectories, dataset=None):
+        # 連続する点の間の距離は設定によらないので、滞在を初めて求めるときに一度だけ求める
+        # datasetを渡すと同じデータを開いたセッションと共有する
+        self.trajectories = trajectories
+        self.dataset = dataset
+        self.results = dict()
+        self.built = None
+
+    @property
+    def steps(self):
+        if self.built is None:
+            build = lambda: step_distances(self.trajectories)
+            self.built = build() if self.dataset is None else self.dataset.derive("stay_steps", build)
+        return self.built
+
+    def detect(self, distance=STAY_DISTANCE, seconds=STAY_SECONDS):
+        # 滞在と移動の表を設定ごとにキャッシュする
+        key = (float(distance), int(seconds))
+        if key not in self.results:
+            self.results[key] = self.segment(distance, seconds)
+        return self.results[key]
+
+    def segment(self, distance, seconds):
+        trajectories = self.trajectories
+        times = trajectories.times
+
+        # 止まっていた区間（距離が閾値以下の線分が続く区間）の最初と最後の線分
+        still = np.zeros(len(self.steps) + 2, dtype=bool)
+        still[1:-1] = trajectories.segment_valid() & (self.steps <= distance)
+        first_step = np.flatnonzero(still[1:-1] & ~still[:-2])
+        last_step = np.flatnonzero(still[1:-1] & ~still[2:])
+
+        # 区間の点は first_step から last_step + 1 まで。続いた時間が閾値以上の区間を滞在とする
+        start, stop = first_step, last_step + 2
+        stay = times[stop - 1] - times[start] >= seconds
+        start, stop = start[stay], stop[stay]
+        users = np.searchsorted(trajectories.offsets, start, side="right") - 1
+
+        # 同じユーザーの続く2つの滞在の間を移動とする
+        same_user = users[1:] == users[:-1]
+        trip_from = np.flatnonzero(same_user)
+        return self.stay_table(start, stop, users), self.trip_table(trip_from, start, stop, users)
+
+    def stay_table(self, start, stop, users):
+        # 滞在ごとの位置は区間の点の平均（累積和の差で求める）
+        trajectories = self.trajectories
+        lon_sum = np.concatenate(([0.0], np.cumsum(trajectories.lon)))
+        lat_sum = np.concatenate(([0.0], np.cumsum(trajectories.lat)))
+        points = stop - start
+        return pd.DataFrame({
+            "userid": pd.Categorical.from_codes(users, categories=pd.Index(trajectories.user_keys, dtype=object)),
+            "start": trajectories.times[start].astype("datetime64[s]"),
+            "end": trajectories.times[stop - 1].astype("datetime64[s]"),
+            "minutes": (trajectories.times[stop - 1] - trajectories.times[start]) / 60,
+            "longitude": (lon_sum[stop] - lon_sum[start]) / np.maximum(points, 1),
+            "latitude": (lat_sum[stop] - lat_sum[start]) / np.maximum(points, 1),
+            "points": points
+        })
+
+    def trip_table(self, trip_from, start, stop, users):
+        # 移動は前の滞在の最後の点から次の滞在の最初の点まで。距離は線分の長さの合計
+        trajectories = self.trajectories
+        step_sum = np.concatenate(([0.0], np.cumsum(self.steps)))
+        depart, arrive = stop[trip_from] - 1, start[trip_from + 1]
+        return pd.DataFrame({
+            "userid": pd.Categorical.from_codes(users[trip_from], categories=pd.Index(trajectories.user_keys, dtype=object)),
+            "from_stay": trip_from,
+            "to_stay": trip_from + 1,
+            "start": trajectories.times[depart].astype("datetime64[s]"),
+            "end": trajectories.times[arrive].astype("datetime64[s]"),
+            "minutes": (trajectories.times[arrive] - trajectories.times[depart]) / 60,
+            "meters": step_sum[arrive] - step_sum[depart]
+        })
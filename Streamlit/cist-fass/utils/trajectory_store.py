@@ -0,0 +1,151 @@
+import time
+import numpy as np
+import pandas as pd
+
+
+class TrajectoryStore:
+    def __init__(self):
+        self.load_sorted([], np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.float64),
+                         np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.int64))
+
+    def load(self, df):
+        # IDは初出順（時刻順）に番号を振る
+        codes, uniques = pd.factorize(df["userid"])
+        times = df["datetime"].to_numpy(dtype="datetime64[s]").astype(np.int64)
+        self.load_arrays([str(user_id) for user_id in uniques], codes, times,
+                         df["longitude"].to_numpy(dtype=np.float64), df["latitude"].to_numpy(dtype=np.float64))
+
+    def load_arrays(self, user_keys, codes, times, lon, lat):
+        # ユーザーごと・時刻順に点を並べ、元の点が何番目に並んだかの並べ替えを返す
+        order = np.lexsort((times, codes))
+
+        counts = np.bincount(codes, minlength=len(user_keys))
+        self.load_sorted(user_keys, np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+                         np.ascontiguousarray(lon[order]), np.ascontiguousarray(lat[order]), times[order])
+        return order
+
+    def load_sorted(self, user_keys, offsets, lon, lat, times):
+        # 並べ替え済みの配列（保存しておいたものなど）をコピーせずに使う
+        self.user_keys = list(user_keys)
+        self.offsets = offsets
+        self.lon = lon
+        self.lat = lat
+        self.times = times
+        self.users_of_points = None
+        self.summarize()
+
+    def freeze(self):
+        # セッションの間で共有するときは、配列を書き換えられないようにする
+        for array in (self.offsets, self.lon, self.lat, self.times, self.point_user()):
+            array.setflags(write=False)
+
+    def summarize(self):
+        # ユーザーごとの外接矩形、最初と最後の時刻、点数、点の範囲を表にしておく
+        starts, stops = self.offsets[:-1], self.offsets[1:]
+        if len(self.lon) == 0:
+            bounds = [np.zeros(len(starts), dtype=np.float64)] * 4
+        else:
+            bounds = [func.reduceat(values, starts) for values in (self.lon, self.lat) for func in (np.minimum, np.maximum)]
+        self.summary = pd.DataFrame({
+            "userid": self.user_keys,
+            "min_lon": bounds[0],
+            "max_lon": bounds[1],
+            "min_lat": bounds[2],
+            "max_lat": bounds[3],
+            "first_time": self.times[starts] if len(self.times) else np.zeros(len(starts), dtype=np.int64),
+            "last_time": self.times[stops - 1] if len(self.times) else np.zeros(len(starts), dtype=np.int64),
+            "points": stops - starts,
+            "start": starts,
+            "stop": stops
+        })
+        self.user_index = {key: user for user, key in enumerate(self.user_keys)}
+
+    def __len__(self):
+        return len(self.user_keys)
+
+    def point_user(self):
+        # 点ごとのユーザー番号（配列は読み込み後に変わらないので、一度作ったものを使い回す）
+        if self.users_of_points is None:
+            self.users_of_points = np.repeat(np.arange(len(self.user_keys), dtype=np.int64), np.diff(self.offsets))
+        return self.users_of_points
+
+    def segments(self):
+        # 線分iは点iから点i+1までで、配列のコピーは作らない
+        return self.lon[:-1], self.lat[:-1], self.lon[1:], self.lat[1:]
+
+    def segment_valid(self):
+        # ユーザーの最後の点から次のユーザーの最初の点への線分は使わない
+        valid = np.ones(max(len(self.lon) - 1, 0), dtype=bool)
+        last = self.offsets[1:] - 1
+        valid[last[(last >= 0) & (last < len(valid))]] = False
+        return valid
+
+    def in_bounds(self, bounds):
+        # 外接矩形が表示範囲と重なるユーザー
+        (south, west), (north, east) = bounds
+        summary = self.summary
+        return ((summary["max_lon"].to_numpy() >= west) & (summary["min_lon"].to_numpy() <= east) &
+                (summary["max_lat"].to_numpy() >= south) & (summary["min_lat"].to_numpy() <= north))
+
+    def select(self, user_keys=None, window=None, bounds=None):
+        # ID・期間・表示範囲で絞り込んだユーザーの番号を、点を走査せずに要約表だけで求める
+        if user_keys:
+            users = np.array(sorted({self.user_index[str(key)] for key in user_keys if str(key) in self.user_index}), dtype=np.int64)
+        else:
+            users = np.arange(len(self.user_keys), dtype=np.int64)
+        if window is not None:
+            start, end = window
+            keep = (self.summary["first_time"].to_numpy()[users] <= end) & (self.summary["last_time"].to_numpy()[users] >= start)
+            users = users[keep]
+        if bounds is not None:
+            users = users[self.in_bounds(bounds)[users]]
+        return users
+
+    def bisect(self, lows, highs, value, right=False):
+        # 各ユーザーの範囲 [lows, highs) の中で時刻がvalue以上（rightならvalueより後）になる最初の点を同時に二分探索する
+        lows, highs = lows.copy(), highs.copy()
+        while (lows < highs).any():
+            active = lows < highs
+            mids = (lows + highs) // 2
+            times = self.times[np.minimum(mids, len(self.times) - 1)]
+            before = (times <= value) if right else (times < value)
+            lows = np.where(active & before, mids + 1, lows)
+            highs = np.where(active & ~before, mids, highs)
+        return lows
+
+    def ranges(self, users, window=None):
+        # ユーザーごとの点の範囲（offsets）を、期間があればその期間に切り詰める
+        users = np.asarray(users, dtype=np.int64)
+        starts, stops = self.offsets[users], self.offsets[users + 1]
+        if window is not None:
+            starts, stops = self.bisect(starts, stops, window[0]), self.bisect(starts, stops, window[1], right=True)
+        return starts, stops
+
+    def rows(self, users, window=None):
+        # ユーザーの点の範囲をつなげた点の番号と、点ごとのユーザー番号
+        starts, stops = self.ranges(users, window)
+        lengths = stops - starts
+        rows = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return rows, np.repeat(np.asarray(users, dtype=np.int64), lengths)
+
+    def frame(self, users, window=None):
+        # 選んだユーザーの点を時刻順のデータフレームにする
+        rows, codes = self.rows(users, window)
+        order = np.argsort(self.times[rows], kind="stable")
+        rows, codes = rows[order], codes[order]
+        return pd.DataFrame({
+            "userid": pd.Categorical.from_codes(codes, categories=pd.Index(self.user_keys, dtype=object)),
+            "datetime": self.times[rows].astype("datetime64[s]"),
+            "latitude": self.lat[rows],
+            "longitude": self.lon[rows]
+        })
+
+    def user_slice(self, user, window=None):
+        if window is None:
+            return slice(self.offsets[user], self.offsets[user + 1])
+        starts, stops = self.ranges([user], window)
+        return slice(int(starts[0]), int(stops[0]))
+
+    @staticmethod
+    def format_time(epoch):
+        return time.strftime('%Y/%m/%d %H:%M', time.gmtime(int(epoch)))
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+from utils.cross_manager import gate_key, points_in_polygon
+from utils.trajectory_store import TrajectoryStore
+
+# 在域人数を集計する時間の幅（秒）
+OCCUPANCY_SECONDS = 600
+
+
+class ZoneManager:
+    def __init__(self):
+        self.load(TrajectoryStore())
+
+    def load(self, trajectories):
+        self.trajectories = trajectories
+        self.point_user = trajectories.point_user()
+        self.zones = dict()
+
+    def intervals(self, gates):
+        # ポリゴンの内側にいた区間（ユーザー番号、入った時刻、出た時刻）をゲートごとにキャッシュする
+        # 区間は内側にある連続した点の最初の点から最後の点まで
+        key = gate_key(gates)
+        if key not in self.zones:
+            trajectories = self.trajectories
+            labels = points_in_polygon(trajectories.lon, trajectories.lat, gates)
+            starts, ends = trajectories.offsets[:-1], trajectories.offsets[1:] - 1
+            starts, ends = starts[starts <= ends], ends[starts <= ends]
+
+            prev = np.zeros(len(labels), dtype=bool)
+            prev[1:] = labels[:-1]
+            prev[starts] = False
+            after = np.zeros(len(labels), dtype=bool)
+            after[:-1] = labels[1:]
+            after[ends] = False
+
+            enter = np.flatnonzero(labels & ~prev)
+            leave = np.flatnonzero(labels & ~after)
+            self.zones[key] = (self.point_user[enter], trajectories.times[enter], trajectories.times[leave])
+        return self.zones[key]
+
+    def forget(self, gates):
+        self.zones.pop(gate_key(gates), None)
+
+    def dwell(self, gates):
+        # ユーザーごとの滞在時間の合計（秒）と滞在回数
+        users, enter, leave = self.intervals(gates)
+        n_users = len(self.trajectories)
+        seconds = np.bincount(users, weights=leave - enter, minlength=n_users).astype(np.int64)
+        visits = np.bincount(users, minlength=n_users)
+        return seconds, visits
+
+    def occupancy(self, gates, bin_seconds=OCCUPANCY_SECONDS):
+        # 区間の両端で+1と-1を足し込み、累積和で時間ごとに内側にいる人数を求める
+        users, enter, leave = self.intervals(gates)
+        if len(users) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        origin = enter.min() // bin_seconds * bin_seconds
+        first, last = (enter - origin) // bin_seconds, (leave - origin) // bin_seconds
+        n_bins = int(last.max()) + 1
+        delta = np.bincount(first, minlength=n_bins + 1) - np.bincount(last + 1, minlength=n_bins + 1)
+        return origin + bin_seconds * np.arange(n_bins, dtype=np.int64), np.cumsum(delta[:-1])
+
+    def display_dwell(self, gates):
+        import plotly.graph_objs as go
+        import streamlit as st
+
+        seconds, visits = self.dwell(gates)
+        users = np.flatnonzero(visits)
+        st.dataframe(pd.DataFrame({
+            "userid": [self.trajectories.user_keys[user] for user in users],
+            "滞在回数[回]": visits[users],
+            "滞在時間[分]": seconds[users] / 60
+        }))
+
+        bins, counts = self.occupancy(gates)
+        fig = go.Figure(go.Scatter(x=pd.to_datetime(bins, unit="s"), y=counts, mode='lines', name='在域人数[人]'))
+        layout = go.Layout(
+            title='在域人数',
+            xaxis=dict(title='日時', tickformat='%m/%d %H:%M'),
+            yaxis=dict(title='在域人数[人]', tickformat='d')
+        )
+        fig.update_layout(layout)
+
+        st.plotly_chart(fig)
@@ -2,6 +2,7 @@ import itertools
 import numpy as np
 import pandas as pd
 import streamlit as st
+import csv_loader
 import io
 
 # Streamlit ページの設定
@@ -21,18 +22,17 @@ st.markdown(hide_menu_style, unsafe_allow_html=True)
 
 def upload_csv():
     # csvがアップロードされたとき
+    st.session_state["load_message"] = None
     if st.session_state['upload_csvfile'] is not None:
         # アップロードされたファイルデータを読み込む
         file_data = st.session_state['upload_csvfile'].read()
         st.session_state['upload_name'] = st.session_state['upload_csvfile'].name
         # バイナリデータからPandas DataFrameを作成
-        try:
-            df = pd.read_csv(io.BytesIO(file_data), encoding="shift-jis", engine="python")
-            st.session_state["ja_honyaku"] = False
-        except UnicodeDecodeError:
-            # Shift-JISで読み取れない場合はutf-8エンコーディングで再試行
-            df = pd.read_csv(io.BytesIO(file_data), encoding="utf-8", engine="python")
-            st.session_state["ja_honyaku"] = True
+        # 文字コードは先頭の部分から判定する（Shift-JISで読めなければUTF-8）
+        df, encoding, info = csv_loader.read_csv(file_data, encodings=("shift-jis", "utf-8"))
+        # 読み込みのメッセージはコールバックの中で表示すると次の再実行で消えるので、保存しておいてページで表示する
+        st.session_state["load_message"] = info["message"]
+        st.session_state["ja_honyaku"] = encoding != "shift-jis"
 
         st.session_state['before_df'] = df
     else:
@@ -63,6 +63,9 @@ st.file_uploader("CSVファイルをアップロード",
                   key="upload_csvfile",
                   on_change=upload_csv
                   )
+# 読み込みに時間がかかったときや読み飛ばした行があるときは表示する
+if st.session_state.get("load_message") is not None:
+    st.caption(st.session_state["load_message"])
 
 # csvがアップロードされたとき
 if len(st.session_state['before_df']) != 0: